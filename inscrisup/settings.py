@@ -131,3 +131,70 @@ PARCOURSUP_PASS = 'mot_de_passe_parcoursup'
 PARCOURSUP_REST_LOGIN = 'identifiant_rest'
 PARCOURSUP_REST_PASSWORD = 'mot_de_passe_rest'
 PARCOURSUP_UAI_ETABLISSEMENT = 'UAI établissement gestionnaire'
+
+# Client HTTP de l'API REST Parcoursup : nombre de connexions conservées
+# ouvertes, délais d'attente (connexion, lecture) en secondes, nombre de
+# nouvelles tentatives en cas d'erreur réseau ou d'erreur 5xx et facteur
+# d'attente entre ces tentatives.
+PARCOURSUP_REST_POOL = 10
+PARCOURSUP_REST_TIMEOUT = (5, 120)
+PARCOURSUP_REST_TENTATIVES = 3
+PARCOURSUP_REST_BACKOFF = 0.5
+
+# Nombre de pages téléchargées simultanément lors de l'extraction des
+# données du site web de Parcoursup
+PARCOURSUP_WEB_PARALLELISME = 4
+
+# Analyseur des pages HTML de Parcoursup : 'html.parser' (BeautifulSoup
+# avec l'analyseur de Python), 'lxml' (BeautifulSoup avec lxml, qui doit
+# alors être installé) ou 'flux' (analyse au fil de l'eau, sans arbre)
+PARCOURSUP_ANALYSEUR_HTML = 'html.parser'
+
+# Lorsque ce réglage vaut True, les messages d'admission envoyés par
+# Parcoursup sont seulement validés et mis en file d'attente. Ils sont
+# appliqués ensuite par la commande "manage.py traite_admissions".
+PARCOURSUP_ADMISSION_ASYNCHRONE = False
+
+# Alias de la base de données de production, dans laquelle la commande
+# "manage.py rejoue_messages_recus" refuse d'appliquer les messages
+PARCOURSUP_BASE_PRODUCTION = 'default'
+
+# Durée (en secondes) pendant laquelle une identification réussie de
+# Parcoursup est conservée dans le cache de Django, pour éviter de
+# vérifier le mot de passe à chaque appel (0 pour désactiver)
+PARCOURSUP_IDENTIFICATION_CACHE = 300
+
+# Durée de conservation (en jours) des messages reçus de Parcoursup, et
+# dossier où la commande "manage.py archive_messages_recus" écrit les
+# messages plus anciens avant de les supprimer de la base de données
+PARCOURSUP_JOURNAL_CONSERVATION = 90
+PARCOURSUP_JOURNAL_ARCHIVES = os.path.join(BASE_DIR, 'archives')
+
+# Dossier où sont conservés les exports (listes de classes, adresses)
+# tant que les données ne changent pas (None pour désactiver ce cache),
+# et taille maximale (en octets) de ce dossier
+PARCOURSUP_EXPORTS_CACHE = os.path.join(BASE_DIR, 'cache_exports')
+PARCOURSUP_EXPORTS_CACHE_TAILLE = 200 * 1024 * 1024
+
+# Lorsque ce réglage vaut True, les exports absents du cache ne sont pas
+# produits pendant la requête : ils sont demandés à la commande
+# "manage.py traite_exports", qui les écrit dans le dossier
+# PARCOURSUP_EXPORTS_TACHES et les y conserve pendant
+# PARCOURSUP_EXPORTS_TACHES_CONSERVATION heures.
+PARCOURSUP_EXPORTS_ARRIERE_PLAN = False
+PARCOURSUP_EXPORTS_TACHES = os.path.join(BASE_DIR, 'exports')
+PARCOURSUP_EXPORTS_TACHES_CONSERVATION = 24
+# Durée (en minutes) au-delà de laquelle un export toujours en cours est
+# considéré comme interrompu (processus arrêté pendant l'export) : il est
+# alors marqué en échec et une nouvelle demande peut être faite.
+PARCOURSUP_EXPORTS_TACHES_DUREE_MAX = 30
+
+# Nombre de processus entre lesquels sont réparties les pages des PDF
+# d'adresses et d'étiquettes (1 pour tout produire dans le processus
+# qui traite la demande). Le rendu en parallèle est expérimental et
+# désactivé par défaut : il n'apporte rien sur une machine à un seul
+# cœur, et l'assemblage des pages, fait sans bibliothèque PDF, suppose
+# la structure des PDF de la version de reportlab fixée dans
+# requirements.txt (en cas d'échec, le PDF est produit dans un seul
+# processus). Ne pas le modifier sans vérifier les documents produits.
+PARCOURSUP_PDF_PROCESSUS = 1
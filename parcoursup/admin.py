@@ -22,15 +22,99 @@ from django.contrib import admin
 
 from parcoursup.models import Etudiant, Classe, Proposition, Action, \
 		ParcoursupUser, ParcoursupMessageRecuLog, \
-		ParcoursupMessageEnvoyeLog, Commune
+		ParcoursupMessageEnvoyeLog, Commune, TacheExport
 
-admin.site.register(Classe)
+class CompteursClassesMixin:
+	"""
+	Ajuste les compteurs d'admissions des classes après chaque
+	modification faite depuis l'interface d'administration, qui ne passe
+	pas par les méthodes de Etudiant et Proposition : les propositions
+	des étudiants concernés sont comptées avant et après la
+	modification, et seule la différence est reportée sur les compteurs
+	(voir ClasseManager.ajuste_compteurs).
+	"""
+	# Attribut des objets administrés qui donne le numéro de dossier de
+	# l'étudiant concerné
+	champ_etudiant = 'pk'
+
+	def etudiants_concernes(self, objets):
+		"""
+		Numéros de dossier des étudiants concernés par les objets
+		donnés, avant (valeur enregistrée) comme après (valeur en
+		mémoire) leur modification.
+		"""
+		etudiants = {getattr(objet, self.champ_etudiant) for objet in objets}
+		etudiants.update(self.model.objects.filter(
+			pk__in=[objet.pk for objet in objets if objet.pk is not None]
+			).values_list(self.champ_etudiant, flat=True))
+		etudiants.discard(None)
+		return etudiants
+
+	def compteurs(self, etudiants):
+		return Classe.objects.compteurs_base(
+				Proposition.objects.filter(etudiant__in=etudiants))
+
+	def save_model(self, request, obj, form, change):
+		etudiants = self.etudiants_concernes([obj])
+		request.compteurs_classes = (etudiants, self.compteurs(etudiants))
+		super().save_model(request, obj, form, change)
+
+	def save_related(self, request, form, formsets, change):
+		super().save_related(request, form, formsets, change)
+		etudiants, avant = request.compteurs_classes
+		etudiants |= self.etudiants_concernes([form.instance])
+		Classe.objects.ajuste_compteurs(avant, self.compteurs(etudiants))
+
+	def delete_model(self, request, obj):
+		etudiants = self.etudiants_concernes([obj])
+		avant = self.compteurs(etudiants)
+		super().delete_model(request, obj)
+		Classe.objects.ajuste_compteurs(avant, self.compteurs(etudiants))
+
+	def delete_queryset(self, request, queryset):
+		etudiants = self.etudiants_concernes(list(queryset))
+		avant = self.compteurs(etudiants)
+		super().delete_queryset(request, queryset)
+		Classe.objects.ajuste_compteurs(avant, self.compteurs(etudiants))
+
+class EmpreinteParcoursupMixin:
+	"""
+	Efface l'empreinte Parcoursup des étudiants modifiés depuis
+	l'interface d'administration (voir Etudiant.oublie_empreinte).
+	"""
+	# Attribut des objets administrés qui donne le numéro de dossier de
+	# l'étudiant concerné
+	champ_etudiant = 'pk'
+
+	def oublie_empreintes(self, etudiants):
+		Etudiant.objects.filter(pk__in=etudiants).update(
+				empreinte_parcoursup='')
+
+	def save_related(self, request, form, formsets, change):
+		super().save_related(request, form, formsets, change)
+		self.oublie_empreintes([getattr(form.instance, self.champ_etudiant)])
+
+	def delete_model(self, request, obj):
+		self.oublie_empreintes([getattr(obj, self.champ_etudiant)])
+		super().delete_model(request, obj)
+
+	def delete_queryset(self, request, queryset):
+		self.oublie_empreintes(list(queryset.values_list(
+			self.champ_etudiant, flat=True)))
+		super().delete_queryset(request, queryset)
+
+class ClasseAdmin(admin.ModelAdmin):
+	list_display = ('nom', 'capacite', 'surbooking', 'nb_oui', 'nb_ouimais',
+			'nb_inscrits')
+admin.site.register(Classe, ClasseAdmin)
 
 class CommuneAdmin(admin.ModelAdmin):
 	list_display = ('insee', 'libelle')
 admin.site.register(Commune, CommuneAdmin)
 
-class PropositionAdmin(admin.ModelAdmin):
+class PropositionAdmin(EmpreinteParcoursupMixin, CompteursClassesMixin,
+        admin.ModelAdmin):
+    champ_etudiant = 'etudiant_id'
     list_display = ('date_proposition', 'classe', 'etudiant',
             'internat',)
     list_filter = ['classe',]
@@ -41,7 +125,8 @@ class PropositionInline(admin.TabularInline):
     model = Proposition
     extra = 1
 
-class EtudiantAdmin(admin.ModelAdmin):
+class EtudiantAdmin(EmpreinteParcoursupMixin, CompteursClassesMixin,
+        admin.ModelAdmin):
     inlines = [PropositionInline]
 
 admin.site.register(Etudiant, EtudiantAdmin)
@@ -53,5 +138,34 @@ class ActionAdmin(admin.ModelAdmin):
 admin.site.register(Action, ActionAdmin)
 
 admin.site.register(ParcoursupUser)
-admin.site.register(ParcoursupMessageRecuLog)
+
+class ParcoursupMessageRecuLogAdmin(admin.ModelAdmin):
+    list_display = ('date', 'endpoint', 'code_candidat', 'succes', 'etat',
+            'message', 'ip_source',)
+    list_filter = ['endpoint', 'succes', 'etat',]
+    date_hierarchy = 'date'
+    search_fields = ['=code_candidat',]
+    exclude = ('payload', 'payload_compresse',)
+    readonly_fields = ('contenu_texte',)
+    raw_id_fields = ('doublon_de',)
+
+    def get_queryset(self, request):
+        # Les données reçues ne sont lues que sur la page d'un message,
+        # jamais pour la liste.
+        return super().get_queryset(request).defer('payload')
+
+    def contenu_texte(self, obj):
+        contenu = obj.contenu
+        if contenu is None:
+            return ''
+        return contenu.decode('utf-8', errors='replace')
+    contenu_texte.short_description = "données reçues"
+
+admin.site.register(ParcoursupMessageRecuLog, ParcoursupMessageRecuLogAdmin)
 admin.site.register(ParcoursupMessageEnvoyeLog)
+
+class TacheExportAdmin(admin.ModelAdmin):
+    list_display = ('date_demande', 'nature', 'etat', 'utilisateur',
+            'progression', 'total', 'date_fin')
+    list_filter = ('nature', 'etat')
+admin.site.register(TacheExport, TacheExportAdmin)
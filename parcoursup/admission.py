@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+
+# Inscrisup - Gestion des inscriptions administratives après Parcoursup
+# Copyright (c) 2019 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Traitement des messages admissionCandidat envoyés par Parcoursup
+
+Ces messages sont appliqués soit immédiatement par la vue AdmissionView,
+soit plus tard par la commande traite_admissions lorsque le réglage
+PARCOURSUP_ADMISSION_ASYNCHRONE est activé. Dans ce second cas, la vue
+se contente de valider le message et de l'enregistrer dans le journal
+ParcoursupMessageRecuLog, qui sert de file d'attente.
+"""
+
+import json
+import logging
+
+from django.db import transaction
+from django.utils import timezone
+
+import requests
+
+from parcoursup.models import ParcoursupMessageRecuLog, Etudiant, \
+		Classe, Commune, Proposition
+import parcoursup.utils as utils
+from parcoursup.parcoursup_rest import ParcoursupRest
+
+logger = logging.getLogger(__name__)
+
+class TraitementAdmission:
+	"""
+	Application des messages admissionCandidat à la base de données
+
+	Une même instance peut traiter plusieurs messages à la suite : les
+	classes déjà recherchées sont alors conservées d'un message à
+	l'autre. Pour un lot de messages, la méthode precharge recherche en
+	une seule fois les classes, les communes et les étudiants dont ils
+	auront besoin.
+	"""
+	# Champs sans lesquels un message ne peut pas être traité
+	CHAMPS_OBLIGATOIRES = ('codeCandidat', 'nom', 'prenom', 'sexe',
+			'dateNaissance', 'dateReponse', 'codeSituation',
+			'codeFormationPsup')
+
+	def __init__(self):
+		self._classes = {}
+		self._etudiants = {}
+
+	@staticmethod
+	def valide(donnees):
+		"""
+		Vérifie qu'un message peut être traité plus tard et renvoie le
+		numéro de dossier du candidat.
+
+		Lève l'une des exceptions KeyError, TypeError ou ValueError si
+		un champ obligatoire manque ou n'est pas au bon format.
+		"""
+		for champ in TraitementAdmission.CHAMPS_OBLIGATOIRES:
+			donnees[champ]
+		utils.parse_french_date(donnees['dateNaissance'])
+		utils.parse_datetime(donnees['dateReponse'])
+		return int(donnees['codeCandidat'])
+
+	@staticmethod
+	def empreinte(donnees):
+		"""
+		Empreinte du contenu d'un message, qui permet de reconnaitre un
+		message déjà reçu. Elle porte sur toutes les données du
+		candidat (dont codeCandidat, dateReponse et codeSituation), mais
+		pas sur les données d'identification.
+		"""
+		return utils.empreinte_json({cle: valeur
+			for cle, valeur in donnees.items()
+			if cle.lower() != 'identifiant'})
+
+	def precharge(self, liste_donnees):
+		"""
+		Recherche en une fois les classes, les libellés des communes et
+		les étudiants déjà connus nécessaires au traitement de la liste
+		de messages donnée en paramètre.
+		"""
+		codes_classes = set()
+		codes_candidats = set()
+		for donnees in liste_donnees:
+			try:
+				codes_classes.add(int(donnees['codeFormationPsup']))
+				codes_candidats.add(int(donnees['codeCandidat']))
+			except (KeyError, TypeError, ValueError):
+				pass
+
+		for classe in Classe.objects.filter(
+				code_parcoursup__in=codes_classes):
+			self._classes[str(classe.code_parcoursup)] = classe
+
+		Commune.objects.libelles(donnees.get('codecommune')
+				for donnees in liste_donnees)
+
+		self._etudiants.update(Etudiant.objects.select_related(
+			'proposition_actuelle').in_bulk(codes_candidats))
+
+	def oublie(self, donnees):
+		"""
+		Retire du cache l'étudiant concerné par un message dont le
+		traitement a échoué : l'objet en mémoire peut ne plus
+		correspondre à la base de données après l'annulation de la
+		transaction.
+		"""
+		try:
+			self._etudiants.pop(int(donnees['codeCandidat']), None)
+		except (KeyError, TypeError, ValueError):
+			pass
+
+	def classe(self, code_parcoursup):
+		"""
+		Renvoie la classe dont le code Parcoursup est donné en
+		paramètre.
+		"""
+		code_parcoursup = str(code_parcoursup)
+		try:
+			return self._classes[code_parcoursup]
+		except KeyError:
+			classe = Classe.objects.get(code_parcoursup=code_parcoursup)
+			self._classes[code_parcoursup] = classe
+			return classe
+
+	def etudiant(self, code_candidat, valeurs):
+		"""
+		Met à jour l'étudiant dont le numéro de dossier est donné en
+		paramètre avec les valeurs du dictionnaire valeurs, ou le crée
+		s'il n'existe pas encore.
+		"""
+		code_candidat = int(code_candidat)
+		etudiant = self._etudiants.get(code_candidat)
+		if etudiant is None:
+			etudiant, _ = Etudiant.objects.update_or_create(
+				dossier_parcoursup=code_candidat, defaults=valeurs)
+		else:
+			for champ, valeur in valeurs.items():
+				setattr(etudiant, champ, valeur)
+			etudiant.save(update_fields=list(valeurs))
+		return etudiant
+
+	def traite(self, donnees):
+		"""
+		Applique le message dont les données JSON décodées sont données
+		en paramètre.
+		"""
+		try:
+			adresse = ParcoursupRest.formate_adresse(donnees)
+		except:
+			adresse = '(Inconnue)'
+
+		etudiant = self.etudiant(donnees['codeCandidat'], {
+				'nom': donnees['nom'],
+				'prenom': donnees['prenom'],
+				'date_naissance': utils.parse_french_date(donnees['dateNaissance']),
+				'email': donnees.get('mail'),
+				'telephone': donnees.get('telfixe', ''),
+				'telephone_mobile': donnees.get('telmobile', ''),
+				'adresse': adresse,
+				'sexe': Etudiant.SEXE_HOMME if donnees['sexe'] == 'M' \
+						else Etudiant.SEXE_FEMME,
+				# La situation du candidat change : la prochaine
+				# synchronisation REST devra le traiter même si
+				# getCandidatsAdmis renvoie les mêmes données que la
+				# fois précédente.
+				'empreinte_parcoursup': '',
+			})
+
+		# On détermine la proposition à laquelle fait référence le
+		# message actuel.
+		classe = self.classe(donnees['codeFormationPsup'])
+		date_reponse = utils.parse_datetime(donnees['dateReponse'])
+		proposition = Proposition(
+			etudiant=etudiant,
+			classe=classe,
+			date_proposition=date_reponse,
+			cesure=donnees.get('cesure', '0') == '1',
+			internat=donnees.get('internat', '0') == '1',
+			inscription=donnees.get('etatInscription', '0') == '1',
+		)
+
+		# Le candidat n'a pas encore répondu
+		if donnees['codeSituation'] == '0':
+			# On n'enregistre dans la base de données que les candidats
+			# qui ont accepté la formation. Ce message provenant de
+			# Parcoursup est donc ignoré. La proposition sera
+			# enregistrée lorsque Parcoursup nous enverra la réponse
+			# positive.
+			pass
+
+		# Proposition acceptée définitivement
+		if donnees['codeSituation'] == '1':
+			proposition.etat = Proposition.ETAT_OUI
+			etudiant.nouvelle_proposition(proposition)
+
+		# Proposition acceptée avec autres vœux en attente
+		if donnees['codeSituation'] == '2':
+			proposition.etat = Proposition.ETAT_OUIMAIS
+			etudiant.nouvelle_proposition(proposition)
+
+		# Proposition refusée
+		if donnees['codeSituation'] == '3':
+			try:
+				proposition = Proposition.objects.get(
+					etudiant=etudiant, classe=classe,
+					cesure=proposition.cesure,
+					internat=proposition.internat,
+					date_demission__isnull=True)
+				# La démission modifie l'étudiant : on lui donne l'objet
+				# du cache, qui reste ainsi à jour pour les messages
+				# suivants.
+				proposition.etudiant = etudiant
+				proposition.demission(date_reponse)
+			except Proposition.DoesNotExist:
+				pass
+
+def traite_file_admissions(taille_lot=100):
+	"""
+	Traite au plus taille_lot messages admissionCandidat en attente dans
+	le journal des messages reçus, du plus ancien au plus récent.
+
+	Les messages sont verrouillés avec SELECT ... FOR UPDATE SKIP
+	LOCKED, de sorte que plusieurs processus peuvent vider la file en
+	même temps. Pour que les messages d'un même candidat soient
+	toujours appliqués dans l'ordre de leur réception, les messages
+	d'un candidat qui suivent l'un de ses messages verrouillés par un
+	autre processus sont laissés de côté jusqu'au prochain appel.
+
+	Chaque message est appliqué dans son propre point de sauvegarde :
+	une erreur n'empêche pas le traitement des messages suivants.
+
+	Renvoie le nombre de messages traités.
+	"""
+	en_attente = ParcoursupMessageRecuLog.objects.filter(
+			etat=ParcoursupMessageRecuLog.ETAT_EN_ATTENTE)
+
+	with transaction.atomic():
+		messages = list(en_attente.select_for_update(skip_locked=True)
+				.order_by('pk')[:taille_lot])
+		if not messages:
+			return 0
+
+		# Pour chaque candidat, plus ancien de ses messages en attente
+		# qui n'a pas pu être verrouillé : seuls les messages antérieurs
+		# peuvent être traités.
+		limites = {}
+		for code_candidat, pk in en_attente.filter(
+				code_candidat__in={message.code_candidat
+					for message in messages},
+				pk__lt=messages[-1].pk).exclude(
+				pk__in=[message.pk for message in messages]).values_list(
+				'code_candidat', 'pk'):
+			limites[code_candidat] = min(pk,
+					limites.get(code_candidat, pk))
+
+		traitement = TraitementAdmission()
+		nb_traites = 0
+		for message in messages:
+			if message.pk > limites.get(message.code_candidat,
+					message.pk):
+				continue
+
+			try:
+				donnees = requests.utils.CaseInsensitiveDict(
+						data=json.loads(message.contenu.decode('utf-8')))
+				with transaction.atomic():
+					traitement.traite(donnees)
+				message.succes = True
+				message.message = "Requete correctement traitee"
+			except Exception:
+				logger.exception("Échec du traitement du message %d",
+						message.pk)
+				message.succes = False
+				message.message = "Erreur lors du traitement"
+
+			message.etat = ParcoursupMessageRecuLog.ETAT_TRAITE
+			message.date_traitement = timezone.now()
+			message.save(update_fields=['etat', 'date_traitement',
+				'succes', 'message'])
+			nb_traites += 1
+
+	return nb_traites
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+
+# Inscrisup - Gestion des inscriptions administratives après Parcoursup
+# Copyright (c) 2019 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Cache sur disque des documents exportés
+
+Chaque export est enregistré dans le fichier <dossier>/<nature>/<version>,
+où version est le numéro de VersionDonnees au moment où l'export a été
+produit. Tant que les données ne changent pas, les téléchargements
+suivants sont servis directement depuis ce fichier.
+
+Les versions plus anciennes d'un export sont supprimées dès qu'une
+nouvelle version est enregistrée. Lorsque la taille totale du cache
+dépasse la limite, les fichiers utilisés le moins récemment sont
+supprimés.
+
+Un export est d'abord écrit dans un fichier temporaire (nom commençant
+par un point), renommé une fois l'export terminé. Les fichiers
+temporaires laissés par un processus interrompu en cours d'export sont
+supprimés par la purge suivante.
+"""
+
+import os
+import tempfile
+import time
+
+from django.conf import settings
+
+class CacheExports:
+	# Âge (en secondes) à partir duquel un fichier temporaire qui n'est
+	# plus modifié est considéré comme abandonné
+	DELAI_TEMPORAIRES = 3600
+
+	def __init__(self, dossier=None, taille_max=None):
+		self.dossier = dossier if dossier is not None else \
+				getattr(settings, 'PARCOURSUP_EXPORTS_CACHE', None)
+		self.taille_max = taille_max if taille_max is not None else \
+				getattr(settings, 'PARCOURSUP_EXPORTS_CACHE_TAILLE',
+						200 * 1024 * 1024)
+
+	@property
+	def actif(self):
+		return bool(self.dossier)
+
+	def chemin(self, nature, version):
+		return os.path.join(self.dossier, nature, str(version))
+
+	def ouvre(self, nature, version):
+		"""
+		Ouvre en lecture l'export de la version donnée s'il est dans le
+		cache. Renvoie None sinon.
+		"""
+		chemin = self.chemin(nature, version)
+		try:
+			fichier = open(chemin, 'rb')
+		except FileNotFoundError:
+			return None
+
+		# La date de modification sert de date de dernière utilisation
+		# pour choisir les fichiers à supprimer.
+		try:
+			os.utime(chemin)
+		except OSError:
+			pass
+		return fichier
+
+	def ecrit(self, nature, version, ecrit_export):
+		"""
+		Produit l'export en appelant ecrit_export avec un fichier ouvert
+		en écriture, l'enregistre dans le cache, et renvoie le fichier
+		produit ouvert en lecture.
+		"""
+		fd, temporaire = self._temporaire(nature)
+		try:
+			with os.fdopen(fd, 'wb') as fichier:
+				ecrit_export(fichier)
+			chemin = self._installe(temporaire, nature, version)
+		except BaseException:
+			self._supprime(temporaire)
+			raise
+		return open(chemin, 'rb')
+
+	def ecrit_flux(self, nature, version, morceaux):
+		"""
+		Générateur qui rend les morceaux de l'export produits par
+		l'itérable morceaux, en les enregistrant au passage dans le
+		cache. L'export n'est conservé que si tous les morceaux ont été
+		produits (et pas si le client s'est déconnecté avant la fin).
+		"""
+		fd, temporaire = self._temporaire(nature)
+		try:
+			with os.fdopen(fd, 'wb') as fichier:
+				for morceau in morceaux:
+					fichier.write(morceau)
+					yield morceau
+			self._installe(temporaire, nature, version)
+		except BaseException:
+			self._supprime(temporaire)
+			raise
+
+	def purge(self, garde=None):
+		"""
+		Supprime les fichiers utilisés le moins récemment jusqu'à ce que
+		la taille du cache ne dépasse plus la limite. Le fichier garde
+		n'est jamais supprimé.
+
+		Les fichiers temporaires abandonnés (voir DELAI_TEMPORAIRES) sont
+		aussi supprimés.
+		"""
+		limite_temporaires = time.time() - self.DELAI_TEMPORAIRES
+		fichiers = []
+		for nature in os.listdir(self.dossier):
+			dossier_nature = os.path.join(self.dossier, nature)
+			if nature.startswith('.') or not os.path.isdir(dossier_nature):
+				continue
+			for nom in os.listdir(dossier_nature):
+				chemin = os.path.join(dossier_nature, nom)
+				try:
+					infos = os.stat(chemin)
+				except FileNotFoundError:
+					continue
+				if nom.startswith('.'):
+					if infos.st_mtime < limite_temporaires:
+						self._supprime(chemin)
+					continue
+				fichiers.append((infos.st_mtime, infos.st_size, chemin))
+
+		taille = sum(taille for _, taille, _ in fichiers)
+		for _, taille_fichier, chemin in sorted(fichiers):
+			if taille <= self.taille_max:
+				break
+			if chemin == garde:
+				continue
+			self._supprime(chemin)
+			taille -= taille_fichier
+
+	def _temporaire(self, nature):
+		dossier_nature = os.path.join(self.dossier, nature)
+		os.makedirs(dossier_nature, exist_ok=True)
+		return tempfile.mkstemp(dir=dossier_nature, prefix='.')
+
+	def _installe(self, temporaire, nature, version):
+		"""
+		Place le fichier temporaire dans le cache sous la version donnée,
+		puis supprime les versions précédentes de l'export, qui ne
+		peuvent plus servir. Renvoie le chemin du fichier.
+		"""
+		chemin = self.chemin(nature, version)
+		os.replace(temporaire, chemin)
+
+		dossier_nature = os.path.dirname(chemin)
+		for nom in os.listdir(dossier_nature):
+			try:
+				if int(nom) < version:
+					self._supprime(os.path.join(dossier_nature, nom))
+			except ValueError:
+				pass
+
+		self.purge(garde=chemin)
+		return chemin
+
+	@staticmethod
+	def _supprime(chemin):
+		try:
+			os.remove(chemin)
+		except FileNotFoundError:
+			pass
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+# Inscrisup - Gestion des inscriptions administratives après Parcoursup
+# Copyright (c) 2019 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Client HTTP partagé par tous les appels à l'API REST de Parcoursup
+"""
+
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from django.conf import settings
+
+class SessionParcoursup(requests.Session):
+	"""
+	Session HTTP qui conserve ses connexions ouvertes d'une requête à
+	l'autre (keep-alive), ce qui évite de refaire la poignée de main
+	TCP et TLS à chaque appel de l'API Parcoursup.
+
+	Les requêtes sont retentées automatiquement, avec une attente
+	croissante entre chaque tentative, lorsque la connexion au serveur
+	échoue. Les requêtes GET le sont aussi après une erreur 5xx ou une
+	erreur de lecture de la réponse. Ce n'est pas le cas des requêtes
+	POST, qui ont pu être traitées par le serveur :
+	majInscriptionAdministrative, par exemple, ne doit pas être envoyée
+	deux fois sans que l'on sache ce qu'il est advenu de la première.
+	"""
+	def __init__(self, taille_pool=10, timeout=(5, 120), tentatives=3,
+			backoff=0.5):
+		super().__init__()
+		self.timeout = timeout
+
+		retry = Retry(total=tentatives, backoff_factor=backoff,
+				status_forcelist=(500, 502, 503, 504),
+				allowed_methods=frozenset(('GET',)),
+				raise_on_status=False)
+		self.adaptateur = HTTPAdapter(pool_connections=taille_pool,
+				pool_maxsize=taille_pool, max_retries=retry)
+		self.mount('https://', self.adaptateur)
+		self.mount('http://', self.adaptateur)
+
+		self.headers['Accept-Encoding'] = 'gzip, deflate'
+
+	def request(self, *args, **kwargs):
+		kwargs.setdefault('timeout', self.timeout)
+		return super().request(*args, **kwargs)
+
+	def statistiques(self):
+		"""
+		Renvoie un dictionnaire qui indique le nombre de requêtes
+		envoyées, le nombre de connexions ouvertes pour cela, et donc le
+		nombre de requêtes qui ont pu réutiliser une connexion existante.
+		"""
+		requetes = 0
+		connexions = 0
+		pools = self.adaptateur.poolmanager.pools
+		for cle in list(pools.keys()):
+			pool = pools.get(cle)
+			if pool is not None:
+				requetes += pool.num_requests
+				connexions += pool.num_connections
+
+		return {
+			'requetes': requetes,
+			'connexions': connexions,
+			'reutilisations': requetes - connexions,
+		}
+
+_session = None
+_verrou_session = threading.Lock()
+
+def session_parcoursup():
+	"""
+	Renvoie la session HTTP partagée, créée au premier appel d'après
+	les réglages PARCOURSUP_REST_* du projet.
+	"""
+	global _session
+	with _verrou_session:
+		if _session is None:
+			_session = SessionParcoursup(
+				taille_pool=getattr(settings, 'PARCOURSUP_REST_POOL', 10),
+				timeout=getattr(settings, 'PARCOURSUP_REST_TIMEOUT', (5, 120)),
+				tentatives=getattr(settings, 'PARCOURSUP_REST_TENTATIVES', 3),
+				backoff=getattr(settings, 'PARCOURSUP_REST_BACKOFF', 0.5))
+		return _session
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+
+# Inscrisup - Gestion des inscriptions administratives après Parcoursup
+# Copyright (c) 2019 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Exports des listes de classes et des adresses des étudiants
+
+Chaque export est identifié par sa nature (voir TacheExport). Il est
+produit soit directement par les vues, soit en arrière-plan par la
+commande traite_exports lorsque le réglage PARCOURSUP_EXPORTS_ARRIERE_PLAN
+est activé. Dans ce second cas, les vues se contentent d'enregistrer une
+TacheExport, dont l'avancement est affiché sur la page des exports.
+"""
+
+from collections import namedtuple
+import datetime
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from parcoursup.cache_exports import CacheExports
+from parcoursup.models import Classe, Etudiant, TacheExport, \
+		VersionDonnees
+from parcoursup.odf_liste import MIMETYPE as ODS_MIMETYPE, par_classe, \
+		par_classe_flux
+from parcoursup.pdf_adresses import pdf_adresses, pdf_etiquettes_adresses
+
+logger = logging.getLogger(__name__)
+
+def classes():
+	return Classe.objects.all().order_by('nom')
+
+def processus_pdf():
+	# Rendu des PDF dans un seul processus, sauf réglage explicite (le
+	# rendu en parallèle est expérimental)
+	return getattr(settings, 'PARCOURSUP_PDF_PROCESSUS', 1)
+
+# nom_fichier et content_type décrivent le document produit. ecrit(fichier,
+# progression) l'écrit dans un fichier ; flux(), lorsqu'il est donné,
+# renvoie ses octets morceau par morceau.
+Export = namedtuple('Export', ['nom_fichier', 'content_type', 'ecrit',
+	'flux'])
+
+EXPORTS = {
+	TacheExport.NATURE_CLASSES: Export('liste_classes.ods', ODS_MIMETYPE,
+		lambda fichier, progression=None: par_classe(classes(), fichier,
+			progression),
+		lambda: par_classe_flux(classes())),
+	TacheExport.NATURE_ADRESSES: Export('adresses_parcoursup.pdf',
+		'application/pdf',
+		lambda fichier, progression=None: pdf_adresses(
+			Etudiant.objects.envois_en_attente(), fichier, progression,
+			processus_pdf()),
+		None),
+	TacheExport.NATURE_ADRESSES_DEFINITIF: Export('adresses_parcoursup.pdf',
+		'application/pdf',
+		lambda fichier, progression=None: pdf_adresses(
+			Etudiant.objects.envois_en_attente(definitif=True), fichier,
+			progression, processus_pdf()),
+		None),
+	TacheExport.NATURE_ETIQUETTES: Export(
+		'etiquettes_adresses_parcoursup.pdf', 'application/pdf',
+		lambda fichier, progression=None: pdf_etiquettes_adresses(
+			Etudiant.objects.envois_en_attente(definitif=True), fichier,
+			progression, processus_pdf()),
+		None),
+}
+
+def demande_export(nature, utilisateur=None):
+	"""
+	Enregistre une demande d'export en arrière-plan et la renvoie. Si un
+	export de même nature est déjà en attente ou en cours, c'est lui qui
+	est renvoyé, sauf s'il a été interrompu (voir
+	TacheExport.abandonne_interrompues).
+	"""
+	with transaction.atomic():
+		TacheExport.abandonne_interrompues()
+		tache = TacheExport.objects.select_for_update().filter(
+				nature=nature, etat__in=(TacheExport.ETAT_EN_ATTENTE,
+					TacheExport.ETAT_EN_COURS)).first()
+		if tache is None:
+			tache = TacheExport.objects.create(nature=nature,
+					utilisateur=utilisateur)
+		return tache
+
+class _Progression:
+	"""
+	Enregistre l'avancement d'une tâche dans la base de données, au plus
+	une fois par intervalle (en secondes) pour ne pas ralentir l'export.
+	"""
+	def __init__(self, tache, intervalle=0.5):
+		self.tache = tache
+		self.intervalle = intervalle
+		self.derniere = 0
+
+	def __call__(self, fait, total):
+		maintenant = time.monotonic()
+		if fait < total and maintenant - self.derniere < self.intervalle:
+			return
+		self.derniere = maintenant
+		TacheExport.objects.filter(pk=self.tache.pk).update(
+				progression=fait, total=total)
+
+def execute_tache(tache):
+	"""
+	Produit le document demandé par la tâche dans le fichier
+	tache.chemin(). Si le cache des exports est activé, le document y
+	est cherché, et il y est enregistré s'il n'y était pas encore.
+	"""
+	export = EXPORTS[tache.nature]
+	progression = _Progression(tache)
+	tache.version = VersionDonnees.actuelle()
+
+	dossier = settings.PARCOURSUP_EXPORTS_TACHES
+	os.makedirs(dossier, exist_ok=True)
+	fd, temporaire = tempfile.mkstemp(dir=dossier, prefix='.')
+	try:
+		with os.fdopen(fd, 'wb') as fichier:
+			cache = CacheExports()
+			if cache.actif:
+				source = cache.ouvre(tache.nature, tache.version)
+				if source is None:
+					source = cache.ecrit(tache.nature, tache.version,
+							lambda f: export.ecrit(f, progression))
+				with source:
+					shutil.copyfileobj(source, fichier)
+			else:
+				export.ecrit(fichier, progression)
+		os.replace(temporaire, tache.chemin())
+	except BaseException:
+		os.remove(temporaire)
+		raise
+
+def traite_file_exports():
+	"""
+	Produit le plus ancien export en attente. Plusieurs processus peuvent
+	vider la file en même temps : la tâche choisie est verrouillée avec
+	SELECT ... FOR UPDATE SKIP LOCKED le temps de la marquer en cours.
+
+	Renvoie la tâche traitée, ou None si aucun export n'était en attente.
+	"""
+	TacheExport.abandonne_interrompues()
+	with transaction.atomic():
+		tache = TacheExport.objects.select_for_update(skip_locked=True
+				).filter(etat=TacheExport.ETAT_EN_ATTENTE).order_by('pk').first()
+		if tache is None:
+			return None
+		tache.etat = TacheExport.ETAT_EN_COURS
+		tache.date_debut = timezone.now()
+		tache.save(update_fields=['etat', 'date_debut'])
+
+	try:
+		execute_tache(tache)
+		tache.etat = TacheExport.ETAT_TERMINE
+	except Exception as e:
+		logger.exception("Échec de l'export %d", tache.pk)
+		tache.etat = TacheExport.ETAT_ECHEC
+		tache.message = str(e)
+
+	tache.date_fin = timezone.now()
+	tache.save(update_fields=['etat', 'date_fin', 'version', 'message'])
+	return tache
+
+def purge_exports(heures):
+	"""
+	Supprime les exports terminés (ou en échec) demandés depuis plus du
+	nombre d'heures donné, ainsi que leurs fichiers. Renvoie le nombre
+	d'exports supprimés.
+	"""
+	anciens = list(TacheExport.objects.filter(
+		date_demande__lt=timezone.now() - datetime.timedelta(hours=heures),
+		etat__in=(TacheExport.ETAT_TERMINE, TacheExport.ETAT_ECHEC)))
+	for tache in anciens:
+		try:
+			os.remove(tache.chemin())
+		except FileNotFoundError:
+			pass
+	TacheExport.objects.filter(pk__in=[tache.pk for tache in anciens]).delete()
+	return len(anciens)
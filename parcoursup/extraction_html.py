@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+
+# Inscrisup - Gestion des inscriptions administratives après Parcoursup
+# Copyright (c) 2018 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Extraction du tableau des candidats depuis les pages HTML de Parcoursup
+
+Les pages de listes de candidats de Parcoursup sont volumineuses et
+imbriquent des tableaux dans des tableaux. Seul le tableau d'identifiant
+listeCandidats nous intéresse, et seulement les libellés de son en-tête
+et le premier texte de chacune des cellules de son corps.
+
+Ce module fournit plusieurs extracteurs interchangeables, qui renvoient
+tous le même résultat :
+
+- ExtracteurSoup construit un arbre BeautifulSoup, éventuellement limité
+  au tableau des candidats, avec l'analyseur "html.parser" de Python ou
+  avec lxml s'il est installé ;
+- ExtracteurFlux parcourt la page au fil de l'eau avec
+  html.parser.HTMLParser, sans construire d'arbre, et ne conserve que
+  les lignes du tableau des candidats.
+
+Le choix de l'extracteur se fait avec le paramètre
+PARCOURSUP_ANALYSEUR_HTML (voir la fonction extracteur_html).
+"""
+
+from html.parser import HTMLParser
+
+import bs4
+
+ID_TABLE_CANDIDATS = 'listeCandidats'
+
+class ExtracteurSoup:
+    """
+    Extraction du tableau des candidats avec BeautifulSoup
+
+    Le paramètre analyseur est transmis à BeautifulSoup ("html.parser"
+    ou "lxml"). Lorsque filtre vaut True, BeautifulSoup ne construit
+    l'arbre que pour le tableau des candidats (grâce à un SoupStrainer)
+    au lieu de la page entière.
+    """
+    def __init__(self, analyseur='html.parser', filtre=True):
+        self.analyseur = analyseur
+        self.filtre = filtre
+
+    def extrait(self, html):
+        """
+        Renvoie le couple (libelles, lignes) où libelles est la liste des
+        libellés des colonnes de l'en-tête (None pour les en-têtes sans
+        texte) et lignes est la liste des lignes du corps du tableau,
+        chaque ligne étant la liste des textes de ses cellules.
+
+        Le texte d'une cellule est le texte qui précède la première
+        balise contenue dans cette cellule, sans les espaces au début
+        et à la fin.
+        """
+        if self.filtre:
+            filtre = bs4.SoupStrainer('table', id=ID_TABLE_CANDIDATS)
+            soup = bs4.BeautifulSoup(html, self.analyseur, parse_only=filtre)
+        else:
+            soup = bs4.BeautifulSoup(html, self.analyseur)
+        table = soup.find('table', id=ID_TABLE_CANDIDATS)
+
+        # L'argument "recursive=False" permet de n'attraper que les
+        # lignes et les cellules du tableau des candidats, pas celles
+        # des tableaux imbriqués plus profondément.
+        libelles = []
+        for tr in table.find('thead').find_all('tr', recursive=False):
+            for th in tr.find_all('th', recursive=False):
+                libelles.append(ExtracteurSoup._libelle(th))
+
+        lignes = []
+        for tr in table.find('tbody').find_all('tr', recursive=False):
+            lignes.append([ExtracteurSoup._texte(td)
+                for td in tr.find_all('td', recursive=False)])
+
+        return libelles, lignes
+
+    @staticmethod
+    def _libelle(th):
+        # th.string n'est défini que si l'en-tête ne contient qu'un seul
+        # texte, éventuellement dans une chaîne de balises qui n'ont
+        # chacune qu'un seul enfant (par exemple <th><a>Nom</a></th>).
+        return th.string.strip() if th.string is not None else None
+
+    @staticmethod
+    def _texte(td):
+        if td.contents and isinstance(td.contents[0], bs4.NavigableString):
+            return td.contents[0].strip()
+        return ''
+
+# États de l'analyse du contenu d'un en-tête <th> par _AnalyseurFlux :
+# balises ouvrantes avant le texte, texte, commentaire, balises
+# fermantes après le texte ou contenu qui n'est pas un texte unique.
+_OUVERTURE, _TEXTE, _COMMENTAIRE, _FERMETURE, _MULTIPLE = range(5)
+
+class _AnalyseurFlux(HTMLParser):
+    """
+    Analyseur événementiel utilisé par ExtracteurFlux.
+
+    L'attribut niveau compte les tableaux ouverts depuis le début du
+    tableau des candidats : il vaut 0 en dehors de celui-ci, et 1 pour
+    les balises qui appartiennent directement au tableau des candidats.
+    """
+    def __init__(self, id_table):
+        super().__init__(convert_charrefs=True)
+        self.id_table = id_table
+        self.niveau = 0
+        self.section = None
+        self.libelles = []
+        self.lignes = []
+
+        # Textes de l'en-tête, de la ligne et de la cellule en cours
+        self.entete = None
+        self.entete_etat = None
+        self.entete_profondeur = 0
+        self.ligne = None
+        self.cellule = None
+
+        # Vaut False dès qu'une balise a été ouverte dans la cellule en
+        # cours : le texte qui suit ne fait plus partie de la cellule.
+        self.capture = False
+
+    def _ferme_cellule(self):
+        if self.entete is not None:
+            # Même règle que th.string dans BeautifulSoup : un seul
+            # texte, entouré seulement de balises à enfant unique.
+            if self.entete_etat in (_TEXTE, _COMMENTAIRE, _FERMETURE) \
+                    and self.entete_profondeur == 0:
+                self.libelles.append(''.join(self.entete).strip())
+            else:
+                self.libelles.append(None)
+        self.entete = None
+        if self.cellule is not None and self.ligne is not None:
+            self.ligne.append(''.join(self.cellule).strip())
+        self.cellule = None
+        self.capture = False
+
+    def _ferme_ligne(self):
+        self._ferme_cellule()
+        if self.ligne is not None:
+            self.lignes.append(self.ligne)
+        self.ligne = None
+
+    def handle_starttag(self, tag, attrs):
+        if self.niveau == 0:
+            if tag == 'table' and dict(attrs).get('id') == self.id_table:
+                self.niveau = 1
+            return
+
+        if self.niveau == 1:
+            # Comme le fait le navigateur, une nouvelle cellule (resp.
+            # ligne) ferme la cellule (resp. la ligne) précédente.
+            if tag == 'tr':
+                self._ferme_ligne()
+                if self.section == 'tbody':
+                    self.ligne = []
+                return
+            if tag in ('td', 'th'):
+                self._ferme_cellule()
+                if tag == 'th' and self.section == 'thead':
+                    self.entete = []
+                    self.entete_etat = _OUVERTURE
+                    self.entete_profondeur = 0
+                elif tag == 'td' and self.ligne is not None:
+                    self.cellule = []
+                    self.capture = True
+                return
+            if tag in ('thead', 'tbody'):
+                self._ferme_ligne()
+                self.section = tag
+                return
+
+        self.capture = False
+        if self.entete is not None:
+            if self.entete_etat == _OUVERTURE:
+                self.entete_profondeur += 1
+            else:
+                self.entete_etat = _MULTIPLE
+        if tag == 'table':
+            self.niveau += 1
+
+    def handle_endtag(self, tag):
+        if self.niveau == 0:
+            return
+
+        if self.entete is not None and not (self.niveau == 1
+                and tag in ('td', 'th', 'tr', 'thead', 'tbody', 'table')):
+            if self.entete_etat in (_TEXTE, _COMMENTAIRE, _FERMETURE) \
+                    and self.entete_profondeur > 0:
+                self.entete_etat = _FERMETURE
+                self.entete_profondeur -= 1
+            else:
+                self.entete_etat = _MULTIPLE
+
+        if tag == 'table':
+            self.niveau -= 1
+            if self.niveau == 0:
+                self._ferme_ligne()
+            return
+
+        if self.niveau > 1:
+            return
+
+        if tag in ('td', 'th'):
+            self._ferme_cellule()
+        elif tag in ('tr', 'tbody'):
+            self._ferme_ligne()
+
+    def handle_comment(self, data):
+        # Un commentaire est un nœud à part entière pour BeautifulSoup.
+        if self.niveau > 0 and self.entete is not None:
+            if self.entete_etat == _OUVERTURE:
+                self.entete_etat = _COMMENTAIRE
+                self.entete.append(data)
+            else:
+                self.entete_etat = _MULTIPLE
+
+    def handle_data(self, data):
+        if self.niveau == 0:
+            return
+        if self.entete is not None:
+            if self.entete_etat == _OUVERTURE:
+                self.entete_etat = _TEXTE
+            elif self.entete_etat != _TEXTE:
+                self.entete_etat = _MULTIPLE
+            self.entete.append(data)
+        elif self.cellule is not None and self.capture:
+            self.cellule.append(data)
+
+class ExtracteurFlux:
+    """
+    Extraction du tableau des candidats au fil de l'eau
+
+    La page n'est jamais construite en mémoire sous forme d'arbre :
+    on ne conserve que les libellés de l'en-tête et les textes des
+    cellules du tableau des candidats. Le résultat est le même que celui
+    de ExtracteurSoup.extrait.
+    """
+    def __init__(self, id_table=ID_TABLE_CANDIDATS):
+        self.id_table = id_table
+
+    def extrait(self, html):
+        # Un nouvel analyseur à chaque appel, pour que le même
+        # extracteur puisse servir depuis plusieurs threads.
+        analyseur = _AnalyseurFlux(self.id_table)
+        analyseur.feed(html)
+        analyseur.close()
+        return analyseur.libelles, analyseur.lignes
+
+EXTRACTEURS = {
+    'html.parser': lambda: ExtracteurSoup('html.parser'),
+    'lxml': lambda: ExtracteurSoup('lxml'),
+    'flux': ExtracteurFlux,
+}
+
+def extracteur_html(nom='html.parser'):
+    """
+    Renvoie l'extracteur correspondant au nom donné, qui est l'une des
+    clés du dictionnaire EXTRACTEURS.
+    """
+    try:
+        return EXTRACTEURS[nom]()
+    except KeyError:
+        raise ValueError("Extracteur HTML inconnu : {}".format(nom))
@@ -19,20 +19,27 @@
 from __future__ import unicode_literals
 
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 import datetime
-import locale
-import tempfile
+import io
+import logging
 import re
 import csv
 import os
+import queue
+import threading
+import time
 
 from django.conf import settings
 from django.utils import timezone
-from dateutil.tz import gettz
 import requests
-import bs4
 
-from .models import Etudiant, Proposition, Classe, ParcoursupSynchro
+from .extraction_html import extracteur_html
+from .models import Etudiant, Proposition, Classe, ParcoursupSynchro, \
+        VersionDonnees
+from .utils import par_paquets, parse_date_francaise
+
+logger = logging.getLogger(__name__)
 
 ParcoursupProposition = namedtuple('ParcoursupProposition', ('numero',
     'nom', 'prenom', 'etat', 'message', 'internat', 'date_reponse',
@@ -45,19 +52,49 @@ class Parcoursup:
     """
     Classe qui fournit des méthodes d'extraction des données de Parcoursup.
 
-    Cette classe utilise les modules requests et BeautifulSoup4 pour se
-    connecter au site web de Parcoursup, analyser les pages HTML du
-    site, et extraire les informations qui nous intéressent.
+    Cette classe utilise le module requests pour se connecter au site
+    web de Parcoursup, puis l'un des extracteurs du module
+    extraction_html pour analyser les pages HTML du site et extraire
+    les informations qui nous intéressent.
 
     On utilise un compte dédié créé sur Parcoursup par l'administration
     du lycée.
     """
-    def __init__(self):
+    def __init__(self, parallelisme=1, analyseur_html='html.parser'):
         self.session = requests.Session()
 
+        # Extracteur du tableau des candidats dans les pages HTML (voir
+        # le module extraction_html)
+        self.extracteur = extracteur_html(analyseur_html)
+
+        # Nombre maximal de pages téléchargées simultanément. Le pool de
+        # connexions de la session doit pouvoir toutes les contenir.
+        self.parallelisme = parallelisme
+        adaptateur = requests.adapters.HTTPAdapter(
+                pool_maxsize=max(parallelisme, 1))
+        self.session.mount('https://', adaptateur)
+
+        # Durées de téléchargement des pages, sous forme de triplets
+        # (adresse, durée en secondes, taille en octets)
+        self.chronometrage = []
+
     def purl(self, fin):
         return 'https://gestion.parcoursup.fr/Gestion/%s' % (fin,)
 
+    def telecharge(self, url, **kwargs):
+        """
+        Téléchargement d'une page avec la session ouverte sur
+        Parcoursup, en mesurant la durée du téléchargement.
+        """
+        debut = time.perf_counter()
+        r = self.session.get(url, **kwargs)
+        duree = time.perf_counter() - debut
+
+        taille = len(r.content) if not kwargs.get('stream') else 0
+        self.chronometrage.append((url, duree, taille))
+        logger.info("%s : %.2f s, %d octets", url, duree, taille)
+        return r
+
     def dget(self, url, *args, **kwargs):
         full_url = self.purl(url)
         r = self.session.get(full_url, *args, **kwargs)
@@ -124,7 +161,7 @@ class Parcoursup:
                 code_groupe=classe.groupe_parcoursup,
                 etat=etat_url[etat])
 
-    def _trouve_colonnes(self, table_candidats, colonnes):
+    def _trouve_colonnes(self, libelles, colonnes):
         """
         Détermine, sur une page donnée, les positions des colonnes à
         partir de leurs libellés.
@@ -141,8 +178,8 @@ class Parcoursup:
         déterminer, d'après les libellés, les positions des colonnes qui
         nous intéressent.
 
-        Le paramètre table_candidats doit contenir le tableau des
-        candidats extrait de la page Parcoursup.
+        Le paramètre libelles doit contenir la liste des libellés de
+        l'en-tête du tableau des candidats, dans l'ordre des colonnes.
 
         Le paramètre colonnes est un dictionnaire qui à chaque
         identifiant de colonne associe une ParcoursupColonne. Le champ
@@ -152,14 +189,12 @@ class Parcoursup:
         La méthode renvoie un nouveau dictionnaire suivant le même
         format, mais avec les positions mises à jour.
         """
-        # On commence par extraire la liste de tous les libellés
-        # présents dans le tableau, que l'on stocke dans un dictionnaire
-        # qui à chaque libellé associe sa position.
-        thead = table_candidats.find('thead')
+        # On commence par construire un dictionnaire qui à chaque
+        # libellé présent dans le tableau associe sa position.
         positions = {}
-        for index, th in enumerate(thead.find_all('th')):
-            if th.string:
-                positions[th.string.strip()] = index
+        for index, libelle in enumerate(libelles):
+            if libelle:
+                positions[libelle] = index
 
         # On met ensuite à jour les positions des colonnes données en
         # paramètre lorsque l'on trouve le libellé correspondant.
@@ -172,12 +207,58 @@ class Parcoursup:
 
         return res
 
-    def recupere_par_etat(self, classe, etat, candidats={}):
+    def recupere_par_etat(self, classe, etat, candidats=None):
         """
         Méthode qui récupère la liste des candidatures pour la classe
         et l'état (égal à l'une des constantes ETAT_xxx) donnés en
         paramètres.
 
+        Voir la méthode analyse_par_etat pour la description du
+        résultat.
+        """
+        html = self.telecharge(self._url_classe_etat(classe, etat))
+        return self.analyse_par_etat(html.text, classe, etat, candidats)
+
+    def recupere_tout(self, classes):
+        """
+        Récupère les candidatures de toutes les classes données en
+        paramètre, pour tous les états de ETAT_CHOICES.
+
+        Les pages sont téléchargées et analysées en parallèle (au plus
+        self.parallelisme à la fois), puis les résultats sont fusionnés
+        dans l'ordre des classes et des états, de sorte qu'ils ne
+        dépendent pas de l'ordre d'arrivée des pages.
+        """
+        pages = [(classe, etat) for classe in classes
+                for (etat, _) in Parcoursup.ETAT_CHOICES]
+
+        with ThreadPoolExecutor(max_workers=self.parallelisme) as executor:
+            resultats = executor.map(lambda page:
+                    self.recupere_par_etat(*page), pages)
+
+            candidats = {}
+            for candidats_page in resultats:
+                for candidat in candidats_page.values():
+                    self._ajoute_candidat(candidats, candidat)
+
+        return candidats
+
+    @staticmethod
+    def _ajoute_candidat(candidats, candidat):
+        """
+        Ajoute une proposition au dictionnaire des candidats, en ne
+        conservant que la proposition avec le meilleur état pour chaque
+        candidat.
+        """
+        if candidat.numero not in candidats or \
+                candidats[candidat.numero].etat < candidat.etat:
+            candidats[candidat.numero] = candidat
+
+    def analyse_par_etat(self, html, classe, etat, candidats=None):
+        """
+        Analyse la page Parcoursup qui donne la liste des candidatures
+        pour la classe et l'état donnés en paramètres.
+
         Elle renvoie un dictionnaire qui à chaque numéro de candidat
         associe une ParcoursupProposition construite à parties des
         données Parcoursup.
@@ -190,25 +271,27 @@ class Parcoursup:
         chaque candidat (un oui définitif est meilleur qu'un oui avec
         attente, qui est meilleur qu'une démission).
         """
-        html = self.session.get(self._url_classe_etat(classe, etat))
-        soup = bs4.BeautifulSoup(html.text, 'html.parser')
-        table_candidats = soup.find('table', {'id': 'listeCandidats'})
-        tbody = table_candidats.find('tbody')
+        if candidats is None:
+            candidats = {}
+
+        # L'extracteur renvoie les libellés de l'en-tête du tableau des
+        # candidats et, pour chaque ligne, le texte de ses cellules.
+        libelles, lignes = self.extracteur.extrait(html)
 
         # Chaque entrée du tableau Parcoursup est une balise HTML <td>. On
         # se donne un jeu de parsers qui convertissent, selon le type de
-        # colonne que l'on attend, le contenu de la balise (qui est une
-        # chaine de caractères) en un type Python.
+        # colonne que l'on attend, le texte de la cellule en un type
+        # Python.
 
-        def parser_default(td):
+        def parser_default(texte):
             """
             Parser par défaut qui renvoie simplement le texte de la
             colonne, auquel on retire les caractères d'espacement
             parasites au début et à la fin.
             """
-            return td.contents[0].strip()
+            return texte.strip()
 
-        def parser_nom(td):
+        def parser_nom(texte):
             """
             Parcoursup met dans la même colonne le nom et le prénom de
             chaque candidat. Ce parser extrait le nom de famille en
@@ -216,14 +299,14 @@ class Parcoursup:
             majuscules.
             """
             nom_parts = []
-            for part in parser_default(td).split():
+            for part in parser_default(texte).split():
                 # En fait, on regarde uniquement si la deuxième lettre
                 # du mot est une majuscule.
                 if len(part) > 1 and part[1].isupper():
                     nom_parts.append(part)
             return ' '.join(nom_parts)
 
-        def parser_prenom(td):
+        def parser_prenom(texte):
             """
             Parcoursup met dans la même colonne le nom et le prénom de
             chaque candidat. Ce parser extrait le prénom utilisant le
@@ -231,48 +314,29 @@ class Parcoursup:
             prénom en majuscule.
             """
             prenom_parts = []
-            for part in parser_default(td).split():
+            for part in parser_default(texte).split():
                 # On teste en fait uniquement si la deuxième lettre est
                 # une minuscule.
                 if len(part) > 1 and part[1].islower():
                     prenom_parts.append(part)
             return ' '.join(prenom_parts)
 
-        # Une date et heure est ambigüe si elle n'est pas stockée avec
-        # l'indication du fuseau horaire correspondant. Les heures de
-        # Parcoursup sont à l'heure légale française. On prépare le
-        # fuseau horaire pour l'attacher ensuite aux heures que l'on
-        # récupèrera sur le site web.
-        paris_tz = gettz('Europe/Paris')
+        # Les dates sont écrites en français, avec le nom du mois en
+        # toutes lettres ou abrégé. La fonction parse_date_francaise les
+        # analyse sans changer la locale du processus, et y attache le
+        # fuseau horaire de Paris (les heures de Parcoursup sont à
+        # l'heure légale française).
 
-        def parser_date_reponse(td):
+        def parser_date_reponse(texte):
             """
             Transformation du texte donnant la date de réponse en un
             objet datetime.datetime Python.
             """
-            # La fonction strptime() interprète le motif "%B" comme
-            # étant le nom du mois en toutes lettres. Elle doit pour
-            # cela savoir dans quelle langue on travaille. On force
-            # temporairement le changement de locale pour travailler en
-            # français.
-            old_loc = locale.getlocale(locale.LC_TIME)
-            locale.setlocale(locale.LC_TIME, 'fr_FR.UTF-8')
-            try:
-                date = datetime.datetime.strptime(parser_default(td),
-                        "%d %B %Y %H:%M").replace(tzinfo=paris_tz)
-            except ValueError:
-                # On tente aussi avec le mois abrégé, si jamais ça passe
-                try:
-                    date = datetime.datetime.strptime(parser_default(td),
-                            "%d %b %Y %H:%M").replace(tzinfo=paris_tz)
-                except ValueError:
-                    date = None
-            # On remet la locale à son ancienne valeur pour ne pas
-            # risquer de perturber le reste du monde.
-            locale.setlocale(locale.LC_TIME, old_loc)
-            return date
-
-        def parser_date_proposition(td):
+            return parse_date_francaise(texte)
+
+        annee_courante = datetime.date.today().year
+
+        def parser_date_proposition(texte):
             """
             Transformation du texte donnant la date de proposition en un
             objet datetime.datetime Python.
@@ -281,28 +345,12 @@ class Parcoursup:
             pour cette colonne, soit en indiquant uniquement le jour et
             le mois, soit en indiquant la date complète avec l'heure.
 
-            On tente les deux formats. Quand il s'agit du premier,
+            On accepte les deux formats. Quand il s'agit du premier,
             Parcoursup ne précise ni l'heure de proposition, ni l'année.
             On choisit minuit pour l'heure, et l'année en cours au
             moment de l'exécution de la méthode.
             """
-            # La fonction strptime() interprète le motif "%b" comme
-            # étant le nom du mois en toutes lettres. Elle doit pour
-            # cela savoir dans quelle langue on travaille. On force
-            # temporairement le changement de locale pour travailler en
-            # français.
-            old_loc = locale.getlocale(locale.LC_TIME)
-            locale.setlocale(locale.LC_TIME, 'fr_FR.UTF-8')
-            try:
-                date = datetime.datetime.strptime(parser_default(td),
-                        "%d %b").replace(year=datetime.date.today().year,
-                                tzinfo=paris_tz)
-            except ValueError:
-                date = parser_date_reponse(td)
-            # On remet la locale à son ancienne valeur pour ne pas
-            # risquer de perturber le reste du monde.
-            locale.setlocale(locale.LC_TIME, old_loc)
-            return date
+            return parse_date_francaise(texte, annee=annee_courante)
 
         # Liste des colonnes que l'on va rechercher pour chaque
         # candidat. Les positions indiquées en dur correspondent à ce
@@ -310,7 +358,7 @@ class Parcoursup:
         # pas toujours à ce que Parcoursup renvoie lorsque l'on ouvre la
         # page avec cette classe. La méthode _trouve_colonnes se charge
         # donc de mettre à jour les positions en fonction des libellés.
-        colonnes_psup = self._trouve_colonnes(table_candidats, {
+        colonnes_psup = self._trouve_colonnes(libelles, {
                 'numero': ParcoursupColonne('numero', 'N° dossier', 3,
                     lambda c: int(parser_default(c))),
 
@@ -323,7 +371,7 @@ class Parcoursup:
                 'etat': ParcoursupColonne('etat', 'Etat', 7, lambda _: etat),
 
                 'internat': ParcoursupColonne('internat', 'Internat', 9,
-                    lambda td: parser_default(td) == "Avec internat"),
+                    lambda texte: parser_default(texte) == "Avec internat"),
 
                 'date_reponse': ParcoursupColonne('date_reponse',
                     'Date de la réponse', 2, parser_date_reponse),
@@ -335,53 +383,112 @@ class Parcoursup:
             })
 
         # Mise à jour du dictionnaire des candidats avec toutes les
-        # propositions trouvées sur la page. Chaque proposition est dans
-        # une balise <tr>. Cependant, Parcoursup produit du code HTML
-        # comme il y a plus de 20 ans, et imbrique des tableaux dans des
-        # tableaux. L'argument "recursive=False" permet de n'attraper
-        # que les lignes du tableau actuel, pas les lignes des tableaux
-        # imbriqués plus profondément...
-        for tr in tbody.find_all('tr', recursive=False):
-            tds = tr.find_all('td', recursive=False)
-
+        # propositions trouvées sur la page. Chaque proposition est une
+        # ligne du tableau des candidats.
+        for cellules in lignes:
             candidat_props = []
             for field_name in ParcoursupProposition._fields:
                 field = colonnes_psup[field_name]
-                candidat_props.append(field.parser(tds[field.position]))
-
-            candidat = ParcoursupProposition(*candidat_props)
+                candidat_props.append(field.parser(cellules[field.position]))
 
-            if candidat.numero not in candidats or \
-                    candidats[candidat.numero].etat < candidat.etat:
-                candidats[candidat.numero] = candidat
+            self._ajoute_candidat(candidats,
+                    ParcoursupProposition(*candidat_props))
 
         return candidats
 
+    # Taille des blocs lus sur la réponse HTTP lors de la lecture des
+    # fichiers d'admissions
+    TAILLE_MORCEAU = 64 * 1024
+
     def fichier_admissions(self, classe):
         """
         Téléchargement du fichier d'admissions pour extraire les
         adresses e-mail et postale.
+
+        Le fichier CSV est analysé au fur et à mesure de son
+        téléchargement, sans être enregistré au préalable. La méthode
+        renvoie un générateur de couples (numéro de dossier,
+        dictionnaire des coordonnées du candidat).
         """
         base_url = 'https://gestion.parcoursup.fr/Gestion/admissions.fichiers?ACTION=19&cf_g_ta_cod={code_classe}&cf_g_ti_cod={code_classe}&cf_g_ti_flg_int=0&cf_g_ea_cod_aff={code_etablissement}&cf_g_ea_cod_ins={code_etablissement}'
         url = base_url.format(code_classe=classe.code_parcoursup,
                 code_etablissement='0740003B')
-        csv_resp = self.session.get(url, stream=True)
-
-        csv_temp = tempfile.TemporaryFile(mode='r+b')
-        for chunk in csv_resp.iter_content(chunk_size=128):
-            csv_temp.write(chunk)
-
-        # Après l'écriture, csv_temp est placé à la fin du fichier. On
-        # se remet au début pour lire.
-        csv_temp.seek(0)
-        csv_temp_text = open(csv_temp.fileno(), 'rt', encoding='utf-8')
-        csv_file = csv.reader(csv_temp_text, delimiter=';')
-
-        adresses = {}
+        with self.telecharge(url, stream=True) as csv_resp:
+            # On lit directement le flux de la réponse (décompressé si
+            # besoin), par blocs de TAILLE_MORCEAU octets. Le flux ne
+            # doit pas se fermer tout seul à la fin des données, sinon
+            # io.BufferedReader refuse de lire le dernier bloc.
+            csv_resp.raw.decode_content = True
+            csv_resp.raw.auto_close = False
+            csv_flux = io.TextIOWrapper(io.BufferedReader(csv_resp.raw,
+                buffer_size=self.TAILLE_MORCEAU), encoding='utf-8',
+                newline='')
+            yield from self._analyse_admissions(csv.reader(csv_flux,
+                delimiter=';'))
+
+    def coordonnees_classes(self, classes, taille_lot=500):
+        """
+        Générateur des coordonnées des candidats de toutes les classes
+        données, sous la forme renvoyée par fichier_admissions.
+
+        Les fichiers d'admissions sont téléchargés et analysés en
+        parallèle. Chaque téléchargement transmet ses coordonnées par
+        paquets de taille_lot candidats, au travers d'une file qui ne
+        contient jamais plus de parallelisme paquets : la mémoire
+        utilisée ne dépend pas de la taille des fichiers. Les paquets
+        de classes différentes peuvent s'entremêler.
+
+        Une erreur lors d'un téléchargement est levée à nouveau une fois
+        que toutes les classes ont été traitées.
+        """
+        file_paquets = queue.Queue(maxsize=self.parallelisme)
+        abandon = threading.Event()
+        fin = object()
 
+        def telecharge(classe):
+            try:
+                if abandon.is_set():
+                    return
+                for paquet in par_paquets(self.fichier_admissions(classe),
+                        taille_lot):
+                    if abandon.is_set():
+                        return
+                    file_paquets.put(paquet)
+            finally:
+                file_paquets.put(fin)
+
+        with ThreadPoolExecutor(max_workers=self.parallelisme) as executor:
+            futures = [executor.submit(telecharge, classe)
+                    for classe in classes]
+            restants = len(futures)
+            try:
+                while restants:
+                    paquet = file_paquets.get()
+                    if paquet is fin:
+                        restants -= 1
+                    else:
+                        yield from paquet
+            finally:
+                # Si le générateur est abandonné avant la fin, on vide la
+                # file pour que les téléchargements en cours ne restent
+                # pas bloqués.
+                abandon.set()
+                while restants:
+                    if file_paquets.get() is fin:
+                        restants -= 1
+
+        for future in futures:
+            future.result()
+
+    def _analyse_admissions(self, csv_file):
+        """
+        Extraction des coordonnées de chaque candidat depuis les lignes
+        du fichier d'admissions.
+        """
         # On ignore la première ligne qui contient uniquement les
         # en-têtes
-        next(csv_file)
+        if next(csv_file, None) is None:
+            return
 
         # On traite les adresses de chaque étudiant
         date_re = re.compile(r'(?P<day>\d{1,2})/(?P<month>\d{1,2})/(?P<year>\d{4})$')
@@ -425,31 +532,70 @@ class Parcoursup:
 
             date_naissance = parse_date(ligne[6])
 
-            adresses[numero] = {'adresse': adresse, 'email': email,
+            yield numero, {'adresse': adresse, 'email': email,
                     'sexe': sexe, 'date_naissance': date_naissance,
                     'telephone': telephone,
                     'telephone_mobile': telephone_mobile}
 
-        return adresses
+def enregistre_coordonnees(coordonnees, taille_lot=500):
+    """
+    Enregistre en base de données les coordonnées des candidats données
+    par l'itérable de couples (numéro de dossier, dictionnaire des
+    coordonnées) renvoyé par Parcoursup.fichier_admissions.
+
+    L'itérable est consommé au fur et à mesure, par paquets de
+    taille_lot candidats : pour chaque paquet, les candidats déjà
+    présents dans la base de données sont lus en une seule requête, et
+    seuls ceux dont les coordonnées ont changé sont mis à jour. Les
+    candidats absents de la base de données sont ignorés. Lorsqu'un
+    candidat apparait plusieurs fois, ce sont ses dernières coordonnées
+    qui sont conservées.
+
+    Renvoie le nombre de mises à jour effectuées.
+    """
+    nombre = 0
+    for paquet in par_paquets(coordonnees, taille_lot):
+        nombre += _enregistre_paquet_coordonnees(dict(paquet))
+
+    if nombre:
+        VersionDonnees.incremente()
+    return nombre
+
+def _enregistre_paquet_coordonnees(coordonnees):
+    champs = sorted({champ for valeurs in coordonnees.values()
+        for champ in valeurs})
+    if not champs:
+        return 0
+
+    modifies = []
+    for etudiant in Etudiant.objects.filter(
+            pk__in=coordonnees.keys()).only(*champs):
+        valeurs = coordonnees[etudiant.pk]
+        if all(getattr(etudiant, champ) == valeur
+                for champ, valeur in valeurs.items()):
+            continue
+
+        for champ, valeur in valeurs.items():
+            setattr(etudiant, champ, valeur)
+        # La synchronisation REST doit de nouveau traiter l'étudiant
+        etudiant.empreinte_parcoursup = ''
+        modifies.append(etudiant)
+
+    Etudiant.objects.bulk_update(modifies, champs + ['empreinte_parcoursup'])
+    return len(modifies)
 
 def unsafe_auto_import():
-    psup = Parcoursup()
+    psup = Parcoursup(parallelisme=getattr(settings,
+            'PARCOURSUP_WEB_PARALLELISME', 4),
+        analyseur_html=getattr(settings,
+            'PARCOURSUP_ANALYSEUR_HTML', 'html.parser'))
     psup.connect(settings.PARCOURSUP_USER, settings.PARCOURSUP_PASS)
 
-    # Import des propositions d'admission depuis Parcoursup
-    candidats = {}
-    for classe in Classe.objects.all():
-        if classe.code_parcoursup > 0 and classe.groupe_parcoursup > 0:
-            for (etat, _) in Parcoursup.ETAT_CHOICES:
-                psup.recupere_par_etat(classe, etat, candidats)
-
-    # Import des adresses des candidats depuis les fichiers d'admission
-    adresses = {}
-    for classe in Classe.objects.all():
-        if classe.code_parcoursup > 0:
-            adresses.update(psup.fichier_admissions(classe))
+    classes = Classe.objects.filter(code_parcoursup__gt=0).order_by('pk')
 
-    psup.disconnect()
+    # Import des propositions d'admission depuis Parcoursup
+    candidats = psup.recupere_tout([classe for classe in classes
+        if classe.groupe_parcoursup > 0])
 
     # Enregistrer les propositions en base de données
     for numero in candidats:
@@ -477,15 +623,24 @@ def unsafe_auto_import():
                     etudiant=etudiant,
                     date_proposition=psup_prop.date_proposition,
                     internat=psup_prop.internat,
-                    statut=psup_prop.etat,
+                    cesure=False,
+                    etat=psup_prop.etat,
                     )
             etudiant.nouvelle_proposition(proposition)
         else:
             etudiant.demission(psup_prop.date_reponse)
 
-    # Enregistrer les adresses des candidats
-    for numero in adresses:
-        Etudiant.objects.filter(pk=numero).update(**adresses[numero])
+    # Import des adresses des candidats depuis les fichiers d'admission,
+    # une fois les nouveaux étudiants créés. Les fichiers sont
+    # téléchargés et analysés en parallèle, et les coordonnées
+    # enregistrées au fur et à mesure.
+    enregistre_coordonnees(psup.coordonnees_classes(classes))
+
+    psup.disconnect()
+
+    duree_totale = sum(duree for _, duree, _ in psup.chronometrage)
+    logger.info("%d pages téléchargées en %.2f s cumulées",
+        len(psup.chronometrage), duree_totale)
 
 def auto_import(mode=ParcoursupSynchro.MODE_MANUEL):
     # Sauvegarde de l'heure de début, pour l'historique
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+
+# Inscrisup - Gestion des inscriptions administratives après Parcoursup
+# Copyright (c) 2019 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import base64
+import datetime
+import gzip
+import json
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from parcoursup.models import ParcoursupMessageRecuLog
+
+class Command(BaseCommand):
+    help = """Archiver dans un fichier JSONL compressé les messages reçus
+    de Parcoursup plus anciens que la durée de conservation, puis les
+    supprimer de la base de données"""
+
+    # Nombre de messages lus et supprimés à la fois
+    TAILLE_LOT = 1000
+
+    def add_arguments(self, parser):
+        parser.add_argument('--jours', type=int,
+                default=getattr(settings, 'PARCOURSUP_JOURNAL_CONSERVATION', 90),
+                help="Durée de conservation des messages (en jours)")
+        parser.add_argument('--dossier',
+                default=getattr(settings, 'PARCOURSUP_JOURNAL_ARCHIVES', None),
+                help="Dossier où écrire le fichier d'archive")
+        parser.add_argument('--sans-archive', action='store_true',
+                help="Supprimer les messages sans les archiver")
+
+    def handle(self, *args, **options):
+        if not options['sans_archive'] and not options['dossier']:
+            raise CommandError("Aucun dossier d'archives n'est indiqué")
+
+        limite = timezone.now() - datetime.timedelta(days=options['jours'])
+
+        # Les messages encore en attente de traitement ne sont jamais
+        # archivés, ni ceux dont un doublon est encore conservé : il
+        # deviendrait un original (voir lot).
+        anciens = ParcoursupMessageRecuLog.objects.filter(date__lt=limite,
+                etat=ParcoursupMessageRecuLog.ETAT_TRAITE
+            ).exclude(doublons__date__gte=limite).order_by('pk')
+
+        if options['sans_archive']:
+            nb_messages = self.supprime(anciens)
+        else:
+            os.makedirs(options['dossier'], exist_ok=True)
+            chemin = os.path.join(options['dossier'],
+                    'messages-recus-{}.jsonl.gz'.format(
+                        timezone.now().strftime('%Y%m%d-%H%M%S')))
+            nb_messages = self.archive(anciens, chemin)
+            self.stdout.write("Archive : {}".format(chemin))
+
+        self.stdout.write("{} message(s) supprimé(s)".format(nb_messages))
+
+    def lot(self, messages):
+        """
+        Prochain lot de messages à supprimer : les TAILLE_LOT premiers
+        messages du queryset, suivis des doublons de ces messages.
+
+        Un message ne doit pas être supprimé sans ses doublons : leur
+        champ doublon_de serait mis à NULL, et ils deviendraient des
+        originaux sans données, ou plusieurs originaux de même
+        empreinte, ce que la contrainte psup_msgrecu_empreinte_uniq
+        interdit.
+        """
+        lot = list(messages[:self.TAILLE_LOT])
+        pks = {message.pk for message in lot}
+        lot.extend(doublon for doublon in messages.model.objects.filter(
+                doublon_de__in=pks).order_by('pk')
+            if doublon.pk not in pks)
+        return lot
+
+    @staticmethod
+    def supprime_lot(lot):
+        """
+        Supprime les messages du lot, les doublons avant leurs originaux :
+        Django met à NULL le champ doublon_de des doublons d'un original
+        supprimé avant de supprimer les messages, même lorsque ces
+        doublons font partie des messages à supprimer.
+        """
+        with transaction.atomic():
+            for doublons in (True, False):
+                ParcoursupMessageRecuLog.objects.filter(pk__in=[
+                    message.pk for message in lot
+                    if (message.doublon_de_id is not None) == doublons]
+                    ).delete()
+
+    def supprime(self, messages):
+        nb_messages = 0
+        while True:
+            lot = self.lot(messages.only('pk', 'doublon_de'))
+            if not lot:
+                return nb_messages
+            self.supprime_lot(lot)
+            nb_messages += len(lot)
+
+    def archive(self, messages, chemin):
+        """
+        Écrit les messages dans le fichier d'archive, lot par lot, et
+        supprime chaque lot de la base de données une fois qu'il a été
+        écrit sur le disque.
+        """
+        nb_messages = 0
+        with gzip.open(chemin, 'wt', encoding='utf-8') as archive:
+            while True:
+                lot = self.lot(messages)
+                if not lot:
+                    return nb_messages
+
+                for message in lot:
+                    archive.write(json.dumps(self.enregistrement(message),
+                        ensure_ascii=False))
+                    archive.write('\n')
+                archive.flush()
+                os.fsync(archive.fileno())
+
+                self.supprime_lot(lot)
+                nb_messages += len(lot)
+
+    @staticmethod
+    def enregistrement(message):
+        """
+        Transcription d'un message en dictionnaire sérialisable en JSON.
+        Les données reçues sont conservées en texte si elles sont en
+        UTF-8 (c'est normalement le cas), et en base64 sinon.
+        """
+        enregistrement = {
+            'id': message.pk,
+            'date': message.date.isoformat(),
+            'ip_source': message.ip_source,
+            'user': message.user_id,
+            'endpoint': message.endpoint,
+            'message': message.message,
+            'succes': message.succes,
+            'date_traitement': message.date_traitement.isoformat()
+                if message.date_traitement else None,
+            'code_candidat': message.code_candidat,
+            'empreinte': message.empreinte,
+            'doublon_de': message.doublon_de_id,
+        }
+
+        contenu = message.contenu
+        try:
+            enregistrement['payload'] = contenu.decode('utf-8') \
+                    if contenu is not None else None
+        except UnicodeDecodeError:
+            enregistrement['payload_base64'] = \
+                    base64.b64encode(contenu).decode('ascii')
+
+        return enregistrement
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+# Inscrisup - Gestion des inscriptions administratives après Parcoursup
+# Copyright (c) 2018 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import time
+import tracemalloc
+
+import bs4
+from django.core.management.base import BaseCommand, CommandError
+
+from parcoursup.extraction_html import EXTRACTEURS, ExtracteurSoup
+
+class Command(BaseCommand):
+    help = """Comparer les durées et la mémoire utilisée par les
+    extracteurs HTML sur des pages Parcoursup enregistrées"""
+
+    def add_arguments(self, parser):
+        parser.add_argument('pages', nargs='+',
+                help="Pages HTML de listes de candidats enregistrées "
+                "(par exemple parcoursup/fixtures/pages/*.html)")
+        parser.add_argument('--repetitions', type=int, default=5,
+                help="Nombre d'analyses de chaque page par extracteur")
+
+    def handle(self, *args, **options):
+        pages = []
+        for nom_fichier in options['pages']:
+            try:
+                with open(nom_fichier, encoding='utf-8') as fichier:
+                    pages.append(fichier.read())
+            except OSError as e:
+                raise CommandError(str(e))
+
+        # La référence est l'analyse de la page entière avec
+        # BeautifulSoup, telle qu'elle était faite avant l'introduction
+        # des extracteurs.
+        extracteurs = [('arbre complet',
+            ExtracteurSoup('html.parser', filtre=False))]
+        extracteurs.extend((nom, creation())
+                for nom, creation in EXTRACTEURS.items())
+
+        self.stdout.write("{:<15} {:>10} {:>12} {:>8}  {}".format(
+            "Extracteur", "Durée (ms)", "Mémoire (ko)", "Lignes",
+            "Identique"))
+
+        reference = None
+        for nom, extracteur in extracteurs:
+            try:
+                resultats = [extracteur.extrait(page) for page in pages]
+            except bs4.FeatureNotFound:
+                self.stdout.write("{:<15} non disponible".format(nom))
+                continue
+
+            if reference is None:
+                reference = resultats
+
+            duree = min(self.chronometre(extracteur, pages)
+                    for _ in range(options['repetitions']))
+
+            tracemalloc.start()
+            for page in pages:
+                extracteur.extrait(page)
+            _, pic = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            self.stdout.write("{:<15} {:>10.1f} {:>12.0f} {:>8}  {}".format(
+                nom, duree * 1000, pic / 1024,
+                sum(len(lignes) for _, lignes in resultats),
+                "oui" if resultats == reference else "NON"))
+
+    @staticmethod
+    def chronometre(extracteur, pages):
+        debut = time.perf_counter()
+        for page in pages:
+            extracteur.extrait(page)
+        return time.perf_counter() - debut
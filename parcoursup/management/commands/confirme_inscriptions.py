@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+# Inscrisup - Gestion des inscriptions administratives après Parcoursup
+# Copyright (c) 2019 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from django.core.management.base import BaseCommand, CommandError
+from parcoursup.models import Etudiant
+
+class Command(BaseCommand):
+    help = "Confirmer auprès de Parcoursup les inscriptions administratives"
+
+    def add_arguments(self, parser):
+        parser.add_argument('dossiers', nargs='*', type=int,
+                help="Numéros de dossier Parcoursup des étudiants inscrits")
+        parser.add_argument('--classe', action='append', default=[],
+                help="Confirmer tous les étudiants de la classe "
+                "(identifiée par son slug) dont l'inscription n'a pas "
+                "encore été transmise")
+        parser.add_argument('--parallelisme', type=int, default=None,
+                help="Nombre maximal de requêtes simultanées vers Parcoursup")
+
+    def handle(self, *args, **options):
+        from parcoursup.parcoursup_rest import confirme_inscriptions
+
+        if not options['dossiers'] and not options['classe']:
+            raise CommandError("Indiquez des numéros de dossier ou une classe")
+
+        etudiants = Etudiant.objects.filter(
+                proposition_actuelle__inscription=False)
+        if options['dossiers']:
+            etudiants = etudiants.filter(pk__in=options['dossiers'])
+        if options['classe']:
+            etudiants = etudiants.filter(
+                    proposition_actuelle__classe__slug__in=options['classe'])
+
+        resultats = confirme_inscriptions(etudiants,
+                parallelisme=options['parallelisme'])
+
+        nb_succes = 0
+        for resultat in resultats:
+            if resultat.succes:
+                nb_succes += 1
+            else:
+                self.stderr.write("Dossier {} : {}".format(
+                    resultat.candidat.code, resultat.message))
+
+        self.stdout.write("{} inscription(s) confirmée(s), {} échec(s)".format(
+            nb_succes, len(resultats) - nb_succes))
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+
+# Inscrisup - Gestion des inscriptions administratives après Parcoursup
+# Copyright (c) 2019 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from django.core.management.base import BaseCommand
+from parcoursup.models import Classe
+
+class Command(BaseCommand):
+    help = """Recalculer les compteurs d'admissions de toutes les classes
+    à partir des propositions en cours"""
+
+    def handle(self, *args, **options):
+        nb_modifiees = Classe.objects.maj_compteurs()
+        self.stdout.write("{} classe(s) corrigée(s) sur {}".format(
+            nb_modifiees, Classe.objects.count()))
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+
+# Inscrisup - Gestion des inscriptions administratives après Parcoursup
+# Copyright (c) 2019 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import datetime
+import json
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, router, transaction
+from django.db.models import Count
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+import requests
+
+from parcoursup.models import ParcoursupMessageRecuLog, ParcoursupUser, \
+        Etudiant, Proposition, Action
+
+class RouteurDestination:
+    """
+    Routeur de bases de données qui envoie toutes les lectures et
+    écritures vers la base de destination des messages rejoués.
+    """
+    def __init__(self, alias):
+        self.alias = alias
+
+    def db_for_read(self, model, **hints):
+        return self.alias
+
+    def db_for_write(self, model, **hints):
+        return self.alias
+
+@contextmanager
+def routage(alias):
+    """
+    Gestionnaire de contexte pendant lequel toutes les requêtes qui ne
+    précisent pas leur base de données sont envoyées vers la base
+    alias.
+    """
+    routeur = RouteurDestination(alias)
+    router.routers.insert(0, routeur)
+    try:
+        yield
+    finally:
+        router.routers.remove(routeur)
+
+class Command(BaseCommand):
+    help = """Rejouer, dans l'ordre de leur réception, les messages
+    d'admission reçus de Parcoursup pendant une période donnée, et
+    mesurer la durée de leur traitement. Les messages sont appliqués à
+    la base de destination, qui ne peut pas être la base de production,
+    et les modifications sont annulées à la fin sauf avec --commit."""
+
+    def add_arguments(self, parser):
+        parser.add_argument('--debut', type=self.date,
+                help="Date (AAAA-MM-JJ) ou date et heure du premier message")
+        parser.add_argument('--fin', type=self.date,
+                help="Date (AAAA-MM-JJ) ou date et heure après le dernier message")
+        parser.add_argument('--source', default='default',
+                help="Base de données où lire le journal des messages")
+        parser.add_argument('--destination', required=True,
+                help="Base de données où appliquer les messages (jamais "
+                "la base de production)")
+        parser.add_argument('--commit', action='store_true',
+                help="Conserver les modifications dans la base de "
+                "destination (par défaut, elles sont annulées à la fin)")
+        parser.add_argument('--identification', action='store_true',
+                help="Vérifier aussi les données d'identification de "
+                "chaque message")
+
+    @staticmethod
+    def date(texte):
+        date = parse_datetime(texte)
+        if date is None:
+            jour = parse_date(texte)
+            if jour is None:
+                raise ValueError(texte)
+            date = datetime.datetime.combine(jour, datetime.time())
+        if timezone.is_naive(date):
+            date = timezone.make_aware(date)
+        return date
+
+    def handle(self, *args, **options):
+        destination = options['destination']
+        if destination not in connections.databases:
+            raise CommandError("Base de données inconnue : {}".format(
+                destination))
+        if destination == getattr(settings, 'PARCOURSUP_BASE_PRODUCTION',
+                'default'):
+            raise CommandError("La base de destination {} est la base de "
+                    "production".format(destination))
+
+        with routage(destination):
+            self.rejoue_messages(options)
+
+    def rejoue_messages(self, options):
+        from parcoursup.admission import TraitementAdmission
+
+        destination = options['destination']
+
+        # Seuls les premiers exemplaires des messages d'admission
+        # acceptés sont rejoués : les doublons et les messages refusés
+        # n'ont jamais été traités, et les entrées des appels groupés
+        # n'ont pas de données (chaque message du tableau a sa propre
+        # entrée).
+        messages = ParcoursupMessageRecuLog.objects.using(
+                options['source']).filter(endpoint='admissionCandidat',
+                succes=True, doublon_de__isnull=True, payload__isnull=False)
+        if options['debut']:
+            messages = messages.filter(date__gte=options['debut'])
+        if options['fin']:
+            messages = messages.filter(date__lt=options['fin'])
+        messages = messages.order_by('pk')
+
+        etapes = OrderedDict((etape, 0.0) for etape in ('lecture',
+            'decodage', 'identification', 'validation', 'traitement'))
+        nb_messages = 0
+        nb_erreurs = 0
+
+        avant = self.etat_base()
+        debut = time.perf_counter()
+
+        with transaction.atomic(using=destination):
+            traitement = TraitementAdmission()
+            iterateur = messages.iterator()
+            while True:
+                t0 = time.perf_counter()
+                message = next(iterateur, None)
+                t1 = time.perf_counter()
+                etapes['lecture'] += t1 - t0
+                if message is None:
+                    break
+
+                nb_messages += 1
+                try:
+                    with transaction.atomic(using=destination):
+                        self.rejoue(message, traitement, etapes,
+                                options['identification'])
+                except Exception as e:
+                    nb_erreurs += 1
+                    traitement.oublie({'codeCandidat': message.code_candidat})
+                    self.stderr.write("Message {} : {}".format(message.pk,
+                        repr(e)))
+
+            duree = time.perf_counter() - debut
+            apres = self.etat_base()
+
+            if not options['commit']:
+                transaction.set_rollback(True, using=destination)
+
+        self.rapport(nb_messages, nb_erreurs, duree, etapes, avant, apres,
+                not options['commit'])
+
+    def rejoue(self, message, traitement, etapes, identification):
+        """
+        Traitement d'un message du journal, comme le ferait AdmissionView
+        en mode synchrone (sans la détection des doublons, puisque le
+        journal de la base de destination peut déjà contenir ces mêmes
+        messages). La durée de chaque étape est ajoutée au dictionnaire
+        etapes.
+        """
+        from parcoursup.admission import TraitementAdmission
+
+        t0 = time.perf_counter()
+        donnees = requests.utils.CaseInsensitiveDict(
+                data=json.loads(message.contenu.decode('utf-8')))
+        t1 = time.perf_counter()
+        etapes['decodage'] += t1 - t0
+
+        if identification:
+            ParcoursupUser.objects.authenticate(
+                    username=donnees['identifiant']['login'],
+                    password=donnees['identifiant']['pwd'])
+        t2 = time.perf_counter()
+        etapes['identification'] += t2 - t1
+
+        TraitementAdmission.valide(donnees)
+        t3 = time.perf_counter()
+        etapes['validation'] += t3 - t2
+
+        traitement.traite(donnees)
+        etapes['traitement'] += time.perf_counter() - t3
+
+    @staticmethod
+    def etat_base():
+        """
+        Résumé de l'état de la base de données, qui sert à comparer
+        l'état avant et après les messages rejoués.
+        """
+        etat = OrderedDict()
+        etat['étudiants'] = Etudiant.objects.count()
+        etat['étudiants avec une proposition en cours'] = \
+                Etudiant.objects.filter(
+                        proposition_actuelle__isnull=False).count()
+
+        for ligne in Proposition.objects.values('classe__nom', 'etat') \
+                .annotate(nb=Count('pk')).order_by('classe__nom', 'etat'):
+            etat['propositions {} (état {})'.format(ligne['classe__nom'],
+                ligne['etat'])] = ligne['nb']
+        etat['propositions démissionnées'] = Proposition.objects.filter(
+                date_demission__isnull=False).count()
+
+        for ligne in Action.objects.values('categorie', 'etat') \
+                .annotate(nb=Count('pk')).order_by('categorie', 'etat'):
+            etat['actions {} (état {})'.format(ligne['categorie'],
+                ligne['etat'])] = ligne['nb']
+
+        return etat
+
+    def rapport(self, nb_messages, nb_erreurs, duree, etapes, avant, apres,
+            rollback):
+        self.stdout.write("{} message(s) rejoué(s), {} en erreur, "
+                "en {:.2f} s".format(nb_messages, nb_erreurs, duree))
+        if duree > 0:
+            self.stdout.write("Débit : {:.1f} messages/s".format(
+                nb_messages / duree))
+
+        self.stdout.write("\nDurée par étape :")
+        for etape, duree_etape in etapes.items():
+            moyenne = duree_etape / nb_messages * 1000 if nb_messages else 0
+            self.stdout.write("  {:<15} {:>8.2f} s  {:>8.2f} ms/message".format(
+                etape, duree_etape, moyenne))
+
+        self.stdout.write("\nModifications de la base de données{} :".format(
+            " (annulées)" if rollback else ""))
+        differences = False
+        for cle in OrderedDict.fromkeys(list(avant) + list(apres)):
+            if avant.get(cle, 0) != apres.get(cle, 0):
+                differences = True
+                self.stdout.write("  {} : {} -> {}".format(cle,
+                    avant.get(cle, 0), apres.get(cle, 0)))
+        if not differences:
+            self.stdout.write("  aucune")
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+
+# Inscrisup - Gestion des inscriptions administratives après Parcoursup
+# Copyright (c) 2019 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import time
+
+from django.core.management.base import BaseCommand
+
+class Command(BaseCommand):
+    help = """Appliquer les messages d'admission reçus de Parcoursup qui
+    sont en attente de traitement"""
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lot', type=int, default=100,
+                help="Nombre maximal de messages traités par transaction")
+        parser.add_argument('--continu', action='store_true',
+                help="Attendre les nouveaux messages au lieu de s'arrêter "
+                "quand la file est vide")
+        parser.add_argument('--pause', type=float, default=2,
+                help="Durée d'attente (en secondes) quand la file est vide")
+
+    def handle(self, *args, **options):
+        from parcoursup.admission import traite_file_admissions
+
+        total = 0
+        while True:
+            nb_traites = traite_file_admissions(taille_lot=options['lot'])
+            total += nb_traites
+            if nb_traites and options['continu']:
+                self.stdout.write("{} message(s) traité(s)".format(nb_traites))
+
+            if nb_traites == 0:
+                if not options['continu']:
+                    break
+                time.sleep(options['pause'])
+
+        self.stdout.write("{} message(s) traité(s) au total".format(total))
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+
+# Inscrisup - Gestion des inscriptions administratives après Parcoursup
+# Copyright (c) 2019 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+class Command(BaseCommand):
+    help = """Produire les exports (adresses, listes de classes) demandés
+    depuis l'interface web"""
+
+    def add_arguments(self, parser):
+        parser.add_argument('--continu', action='store_true',
+                help="Attendre les nouvelles demandes au lieu de s'arrêter "
+                "quand la file est vide")
+        parser.add_argument('--pause', type=float, default=2,
+                help="Durée d'attente (en secondes) quand la file est vide")
+        parser.add_argument('--conservation', type=float,
+                default=getattr(settings,
+                    'PARCOURSUP_EXPORTS_TACHES_CONSERVATION', 24),
+                help="Durée (en heures) de conservation des exports produits")
+
+    def handle(self, *args, **options):
+        from parcoursup.exports import traite_file_exports, purge_exports
+
+        total = 0
+        while True:
+            tache = traite_file_exports()
+            if tache is not None:
+                total += 1
+                self.stdout.write("{} : {}".format(tache,
+                    tache.get_etat_display()))
+                continue
+
+            purge_exports(options['conservation'])
+            if not options['continu']:
+                break
+            time.sleep(options['pause'])
+
+        self.stdout.write("{} export(s) produit(s) au total".format(total))
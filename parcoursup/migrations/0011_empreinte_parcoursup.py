@@ -0,0 +1,33 @@
+# Generated by Django 2.2.1 on 2019-09-02 10:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('parcoursup', '0010_etudiant_ine'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='etudiant',
+            name='empreinte_parcoursup',
+            field=models.CharField(blank=True, default='', editable=False, max_length=64, verbose_name='empreinte des dernières données Parcoursup'),
+        ),
+        migrations.AddField(
+            model_name='parcoursupsynchro',
+            name='nb_inchanges',
+            field=models.PositiveIntegerField(blank=True, null=True, verbose_name='candidats inchangés'),
+        ),
+        migrations.AddField(
+            model_name='parcoursupsynchro',
+            name='nb_modifies',
+            field=models.PositiveIntegerField(blank=True, null=True, verbose_name='candidats modifiés'),
+        ),
+        migrations.AddField(
+            model_name='parcoursupsynchro',
+            name='nb_nouveaux',
+            field=models.PositiveIntegerField(blank=True, null=True, verbose_name='nouveaux candidats'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 2.2.1 on 2019-09-09 09:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('parcoursup', '0011_empreinte_parcoursup'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='parcoursupmessagereculog',
+            name='code_candidat',
+            field=models.IntegerField(blank=True, db_index=True, null=True, verbose_name='numéro de dossier du candidat'),
+        ),
+        migrations.AddField(
+            model_name='parcoursupmessagereculog',
+            name='date_traitement',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='date de traitement'),
+        ),
+        migrations.AddField(
+            model_name='parcoursupmessagereculog',
+            name='etat',
+            field=models.SmallIntegerField(choices=[(0, 'traité'), (1, 'en attente de traitement')], db_index=True, default=0),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 2.2.1 on 2019-09-10 14:05
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('parcoursup', '0012_message_recu_file_attente'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='parcoursupmessagereculog',
+            name='doublon_de',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='doublons', to='parcoursup.ParcoursupMessageRecuLog', verbose_name='doublon du message'),
+        ),
+        migrations.AddField(
+            model_name='parcoursupmessagereculog',
+            name='empreinte',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=64, verbose_name='empreinte du contenu'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 2.2.1 on 2019-09-12 16:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('parcoursup', '0013_message_recu_doublon'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='parcoursupmessagereculog',
+            name='payload_compresse',
+            field=models.BooleanField(default=False, verbose_name='données compressées'),
+        ),
+        migrations.AddIndex(
+            model_name='parcoursupmessagereculog',
+            index=models.Index(fields=['date'], name='psup_msgrecu_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='parcoursupmessagereculog',
+            index=models.Index(fields=['endpoint'], name='psup_msgrecu_endpoint_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='parcoursupmessagereculog',
+            index=models.Index(fields=['succes'], name='psup_msgrecu_succes_idx'),
+        ),
+    ]
@@ -0,0 +1,60 @@
+# Generated by Django 2.2.1 on 2019-09-16 10:05
+
+from django.db import migrations, models
+from django.db.models import Count, Q
+
+
+def calcule_compteurs(apps, schema_editor):
+    Classe = apps.get_model('parcoursup', 'Classe')
+    Proposition = apps.get_model('parcoursup', 'Proposition')
+
+    # Mêmes valeurs que Proposition.ETAT_OUI et Proposition.ETAT_OUIMAIS
+    oui = Q(etat=0)
+    ouimais = Q(etat=1)
+    compteurs = Proposition.objects.filter(date_demission__isnull=True,
+            remplacee_par__isnull=True).values('classe').annotate(
+                nb_oui=Count('pk', filter=oui),
+                nb_ouimais=Count('pk', filter=ouimais),
+                nb_internat_oui=Count('pk', filter=oui & Q(internat=True)),
+                nb_internat_ouimais=Count('pk',
+                    filter=ouimais & Q(internat=True)),
+                nb_inscrits=Count('pk', filter=Q(inscription=True)),
+            ).order_by()
+    for ligne in compteurs:
+        Classe.objects.filter(pk=ligne.pop('classe')).update(**ligne)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('parcoursup', '0014_message_recu_compression'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='classe',
+            name='nb_inscrits',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='inscrits'),
+        ),
+        migrations.AddField(
+            model_name='classe',
+            name='nb_internat_oui',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name="oui définitifs à l'internat"),
+        ),
+        migrations.AddField(
+            model_name='classe',
+            name='nb_internat_ouimais',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name="oui avec vœux en attente à l'internat"),
+        ),
+        migrations.AddField(
+            model_name='classe',
+            name='nb_oui',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='oui définitifs'),
+        ),
+        migrations.AddField(
+            model_name='classe',
+            name='nb_ouimais',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='oui avec vœux en attente'),
+        ),
+        migrations.RunPython(calcule_compteurs, migrations.RunPython.noop),
+    ]
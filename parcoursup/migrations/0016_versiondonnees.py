@@ -0,0 +1,30 @@
+# Generated by Django 2.2.1 on 2019-09-18 14:40
+
+from django.db import migrations, models
+
+
+def cree_version(apps, schema_editor):
+    VersionDonnees = apps.get_model('parcoursup', 'VersionDonnees')
+    VersionDonnees.objects.get_or_create(pk=1)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('parcoursup', '0015_classe_compteurs'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VersionDonnees',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('numero', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'verbose_name': 'version des données',
+                'verbose_name_plural': 'versions des données',
+            },
+        ),
+        migrations.RunPython(cree_version, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 2.2.1 on 2019-09-20 09:15
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('parcoursup', '0016_versiondonnees'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TacheExport',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('nature', models.CharField(choices=[('classes', 'Listes des classes'), ('adresses', 'Adresses de tous les envois'), ('adresses_definitif', 'Adresses des oui définitifs'), ('etiquettes', "Étiquettes d'adresses")], max_length=30)),
+                ('etat', models.SmallIntegerField(choices=[(0, 'En attente'), (1, 'En cours'), (2, 'Terminé'), (3, 'Échec')], db_index=True, default=0, verbose_name='état')),
+                ('date_demande', models.DateTimeField(auto_now_add=True, verbose_name='date de la demande')),
+                ('date_debut', models.DateTimeField(blank=True, null=True, verbose_name='début')),
+                ('date_fin', models.DateTimeField(blank=True, null=True, verbose_name='fin')),
+                ('progression', models.PositiveIntegerField(default=0)),
+                ('total', models.PositiveIntegerField(blank=True, null=True)),
+                ('version', models.PositiveIntegerField(blank=True, null=True)),
+                ('message', models.TextField(blank=True)),
+                ('utilisateur', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'export en arrière-plan',
+                'verbose_name_plural': 'exports en arrière-plan',
+            },
+        ),
+    ]
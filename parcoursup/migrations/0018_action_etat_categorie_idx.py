@@ -0,0 +1,17 @@
+# Generated by Django 2.2.1 on 2019-09-20 10:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('parcoursup', '0017_tacheexport'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='action',
+            index=models.Index(fields=['etat', 'categorie'], name='psup_action_etat_categorie_idx'),
+        ),
+    ]
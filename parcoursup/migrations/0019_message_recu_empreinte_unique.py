@@ -0,0 +1,37 @@
+# Generated by Django 2.2.1 on 2019-09-20 10:31
+
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+def marque_doublons(apps, schema_editor):
+    """
+    Les messages identiques reçus en même temps avant l'ajout de la
+    contrainte sont rattachés au plus ancien d'entre eux.
+    """
+    ParcoursupMessageRecuLog = apps.get_model('parcoursup',
+            'ParcoursupMessageRecuLog')
+    originaux = ParcoursupMessageRecuLog.objects.filter(
+            doublon_de__isnull=True, succes=True).exclude(empreinte='')
+    groupes = originaux.values('endpoint', 'empreinte').annotate(
+            nombre=Count('pk'), premier=Min('pk')).filter(nombre__gt=1)
+    for groupe in groupes:
+        originaux.filter(endpoint=groupe['endpoint'],
+                empreinte=groupe['empreinte']).exclude(
+                pk=groupe['premier']).update(doublon_de=groupe['premier'],
+                payload=None, payload_compresse=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('parcoursup', '0018_action_etat_categorie_idx'),
+    ]
+
+    operations = [
+        migrations.RunPython(marque_doublons, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='parcoursupmessagereculog',
+            constraint=models.UniqueConstraint(condition=models.Q(('doublon_de__isnull', True), ('succes', True), models.Q(_negated=True, empreinte='')), fields=('endpoint', 'empreinte'), name='psup_msgrecu_empreinte_uniq'),
+        ),
+    ]
@@ -18,16 +18,116 @@
 
 from __future__ import unicode_literals
 
+import datetime
+import hashlib
+import hmac
+import json
+import os
+import zlib
+
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import cache
 from django.db import models
 from django.db import transaction
+from django.db.models import Count, Exists, F, OuterRef, Q
+from django.db.models.functions import Greatest
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 from django.urls import reverse
-from django.contrib.auth.hashers import check_password
+from django.utils import timezone
+from django.contrib.auth.hashers import check_password, make_password
+from django.utils.crypto import constant_time_compare
+from django.utils.encoding import force_bytes
 
 class EtudiantManager(models.Manager):
 	def par_classe(self, classe):
+		"""
+		Étudiants dont la proposition actuelle concerne la classe donnée
+		en paramètre. La proposition actuelle est lue dans la même
+		requête que les étudiants.
+		"""
 		return self.get_queryset().filter(proposition_actuelle__classe=classe,
-			proposition__date_demission__isnull=True,
-			proposition__remplacee_par__isnull=True)
+			proposition_actuelle__date_demission__isnull=True,
+			proposition_actuelle__remplacee_par__isnull=True
+			).select_related('proposition_actuelle')
+
+	def envois_en_attente(self, definitif=False):
+		"""
+		Étudiants à qui un dossier d'inscription (ou d'internat) doit
+		être envoyé, triés par nom. Si definitif vaut True, seuls ceux
+		qui ont dit oui définitivement sont retenus.
+
+		Chaque étudiant n'apparaît qu'une fois, même s'il a plusieurs
+		envois en attente, et seuls les champs nécessaires à
+		l'impression des adresses sont lus.
+		"""
+		envois = Action.objects.filter(proposition__etudiant=OuterRef('pk'),
+				etat=Action.ETAT_TODO,
+				categorie__in=(Action.ENVOI_DOSSIER,
+					Action.ENVOI_DOSSIER_INTERNAT))
+		if definitif:
+			envois = envois.filter(proposition__etat=Proposition.ETAT_OUI)
+		return self.get_queryset().annotate(envoi_en_attente=Exists(envois)
+			).filter(envoi_en_attente=True
+			).only('sexe', 'nom', 'prenom', 'adresse'
+			).order_by('nom', 'prenom')
+
+	@transaction.atomic
+	def demission_lot(self, etudiants, date):
+		"""
+		Enregistre à la date donnée la démission de tous les étudiants
+		du queryset etudiants qui ont encore une proposition actuelle.
+
+		Le résultat est le même que celui de Etudiant.demission()
+		appelée pour chacun de ces étudiants, mais le nombre de requêtes
+		ne dépend pas du nombre d'étudiants concernés. Les étudiants qui
+		ont déjà démissionné ne sont pas traités de nouveau.
+
+		Renvoie le nombre de démissions enregistrées.
+		"""
+		demissions = list(etudiants.filter(
+			proposition_actuelle__isnull=False).values_list('pk',
+				'proposition_actuelle', 'proposition_actuelle__date_demission',
+				'proposition_actuelle__classe', 'proposition_actuelle__etat',
+				'proposition_actuelle__internat',
+				'proposition_actuelle__inscription'))
+		if not demissions:
+			return 0
+
+		propositions = [demission[1] for demission in demissions]
+
+		# Propositions qui étaient encore comptées dans les compteurs de
+		# leur classe
+		compteurs_avant = Classe.objects.compteurs(
+			Proposition(classe_id=classe, etat=etat, internat=internat,
+				inscription=inscription)
+			for _, _, date_demission, classe, etat, internat, inscription
+			in demissions if date_demission is None)
+
+		# On annule toutes les actions qui n'avaient pas encore été
+		# accomplies.
+		Action.objects.filter(proposition__in=propositions,
+				etat=Action.ETAT_TODO
+			).exclude(categorie=Action.DEMISSION
+			).update(etat=Action.ETAT_ANNULEE, date_fait=date)
+
+		Action.objects.bulk_create([
+			Action(proposition_id=proposition, etudiant_id=etudiant,
+				categorie=Action.DEMISSION, date=date)
+			for etudiant, proposition, date_demission, *_ in demissions
+			if date_demission is None])
+
+		Proposition.objects.filter(pk__in=propositions
+				).update(date_demission=date)
+		self.get_queryset().filter(proposition_actuelle__in=propositions
+				).update(proposition_actuelle=None, empreinte_parcoursup='')
+		VersionDonnees.incremente()
+
+		Classe.objects.ajuste_compteurs(compteurs_avant, Counter())
+
+		return len(demissions)
 
 class Etudiant(models.Model):
 	nom = models.CharField(max_length=100)
@@ -47,6 +147,9 @@ class Etudiant(models.Model):
 	ine = models.CharField(blank=True, null=True,
 			max_length=11, verbose_name="INE (numéro d'étudiant)",
 			unique=True)
+	empreinte_parcoursup = models.CharField(max_length=64, blank=True,
+			default='', editable=False,
+			verbose_name="empreinte des dernières données Parcoursup")
 
 	SEXE_HOMME=1
 	SEXE_FEMME=2
@@ -75,6 +178,19 @@ class Etudiant(models.Model):
 	class Meta:
 		verbose_name = "étudiant"
 
+	def oublie_empreinte(self):
+		"""
+		Efface l'empreinte des dernières données Parcoursup de
+		l'étudiant. La prochaine synchronisation REST le traitera alors
+		même si getCandidatsAdmis renvoie les mêmes données (voir
+		SynchroLot._inchange). Elle doit être effacée dès que l'étudiant
+		ou ses propositions sont modifiés par un autre moyen.
+		"""
+		if self.empreinte_parcoursup:
+			self.empreinte_parcoursup = ''
+			Etudiant.objects.filter(pk=self.pk).update(
+					empreinte_parcoursup='')
+
 	@transaction.atomic
 	def nouvelle_proposition(self, nouv_prop):
 		"""
@@ -91,6 +207,11 @@ class Etudiant(models.Model):
 		réaliser suite à cette proposition.
 		"""
 		old_prop = self.proposition_actuelle
+		compteurs_avant = Classe.objects.compteurs([old_prop])
+
+		# La proposition peut venir d'ailleurs que de la synchronisation
+		# REST : celle-ci devra traiter de nouveau l'étudiant.
+		self.oublie_empreinte()
 
 		actions_demission = Action.objects.filter(
 			etudiant=self,
@@ -109,6 +230,8 @@ class Etudiant(models.Model):
 			if old_prop.etat != nouv_prop.etat:
 				old_prop.etat = nouv_prop.etat
 				old_prop.save()
+				Classe.objects.ajuste_compteurs(compteurs_avant,
+					Classe.objects.compteurs([old_prop]))
 			return
 
 		nouv_prop.remplace = old_prop
@@ -161,7 +284,7 @@ class Etudiant(models.Model):
 				for action_envoi in Action.objects.filter(etat=Action.ETAT_TODO,
 						categorie=Action.ENVOI_DOSSIER_INTERNAT,
 						proposition__etudiant=self):
-					action_envoi.annuler(nouv_prop_date.date_proposition)
+					action_envoi.annuler(nouv_prop.date_proposition)
 
 				Action(proposition=nouv_prop,
 						etudiant=self,
@@ -183,6 +306,9 @@ class Etudiant(models.Model):
 						date=nouv_prop.date_proposition,
 						message="L'étudiant a changé de classe").save()
 
+		Classe.objects.ajuste_compteurs(compteurs_avant,
+			Classe.objects.compteurs([old_prop, nouv_prop]))
+
 	@transaction.atomic
 	def demission(self, date):
 		"""
@@ -196,6 +322,150 @@ class Etudiant(models.Model):
 		if self.proposition_actuelle is not None:
 			proposition.demission(date)
 
+class ClasseManager(models.Manager):
+	# Compteurs d'admissions des classes (voir Classe)
+	CHAMPS_COMPTEURS = ('nb_oui', 'nb_ouimais', 'nb_internat_oui',
+			'nb_internat_ouimais', 'nb_inscrits')
+
+	@staticmethod
+	def compteurs(propositions):
+		"""
+		Contribution aux compteurs d'admissions des classes des
+		propositions données, telles qu'elles sont en mémoire : Counter
+		qui associe à chaque couple (classe, compteur) le nombre de
+		propositions comptées. Les propositions démissionnées, ou
+		remplacées (ce qui leur donne aussi une date de démission), ne
+		sont comptées nulle part.
+
+		Les méthodes qui modifient des propositions calculent cette
+		contribution avant et après la modification et passent les deux
+		à ajuste_compteurs.
+		"""
+		compteurs = Counter()
+		for proposition in propositions:
+			if proposition is None or proposition.date_demission is not None:
+				continue
+			classe = proposition.classe_id
+			if proposition.etat == Proposition.ETAT_OUI:
+				compteurs[classe, 'nb_oui'] += 1
+				if proposition.internat:
+					compteurs[classe, 'nb_internat_oui'] += 1
+			elif proposition.etat == Proposition.ETAT_OUIMAIS:
+				compteurs[classe, 'nb_ouimais'] += 1
+				if proposition.internat:
+					compteurs[classe, 'nb_internat_ouimais'] += 1
+			if proposition.inscription:
+				compteurs[classe, 'nb_inscrits'] += 1
+		return compteurs
+
+	@staticmethod
+	def _agrege(propositions):
+		"""
+		Compteurs d'admissions des propositions en cours du queryset
+		donné, calculés par la base de données et groupés par classe.
+		"""
+		oui = Q(etat=Proposition.ETAT_OUI)
+		ouimais = Q(etat=Proposition.ETAT_OUIMAIS)
+		return propositions.filter(
+				date_demission__isnull=True,
+				remplacee_par__isnull=True).values('classe').annotate(
+					nb_oui=Count('pk', filter=oui),
+					nb_ouimais=Count('pk', filter=ouimais),
+					nb_internat_oui=Count('pk', filter=oui & Q(internat=True)),
+					nb_internat_ouimais=Count('pk',
+						filter=ouimais & Q(internat=True)),
+					nb_inscrits=Count('pk', filter=Q(inscription=True)),
+				).order_by()
+
+	def compteurs_base(self, propositions):
+		"""
+		Contribution aux compteurs d'admissions des propositions du
+		queryset donné, lue dans la base de données, sous la même forme
+		que compteurs().
+
+		Cette méthode sert quand les propositions sont modifiées sans
+		passer par les méthodes des modèles (interface
+		d'administration).
+		"""
+		compteurs = Counter()
+		for ligne in self._agrege(propositions):
+			classe = ligne.pop('classe')
+			for champ, valeur in ligne.items():
+				if valeur:
+					compteurs[classe, champ] = valeur
+		return compteurs
+
+	def ajuste_compteurs(self, avant, apres):
+		"""
+		Reporte sur les compteurs d'admissions des classes la
+		différence entre les contributions avant et apres d'un ensemble
+		de propositions (voir compteurs), avec une requête
+		UPDATE ... SET nb_oui = nb_oui + n par classe concernée.
+
+		L'incrément est calculé par la base de données au moment de
+		l'écriture : deux transactions qui modifient en même temps les
+		propositions d'une même classe n'ont pas besoin de verrouiller la
+		classe ni de relire ses propositions.
+
+		Renvoie le nombre de classes modifiées.
+		"""
+		differences = {}
+		for classe, champ in set(avant) | set(apres):
+			n = apres[classe, champ] - avant[classe, champ]
+			if n > 0:
+				differences.setdefault(classe, {})[champ] = F(champ) + n
+			elif n < 0:
+				# Les compteurs ne deviennent jamais négatifs, même si
+				# leur valeur précédente était fausse : il suffit alors
+				# de lancer recalcule_compteurs_classes.
+				differences.setdefault(classe, {})[champ] = Greatest(
+						F(champ) + n, 0)
+
+		for classe, valeurs in differences.items():
+			self.get_queryset().filter(pk=classe).update(**valeurs)
+		return len(differences)
+
+	@transaction.atomic
+	def maj_compteurs(self, classes=None):
+		"""
+		Recalcule entièrement les compteurs d'admissions des classes
+		données en paramètre (objets Classe ou clés primaires), ou de
+		toutes les classes si classes vaut None, à partir des
+		propositions en cours.
+
+		Les modifications des propositions ne font qu'ajuster les
+		compteurs (voir ajuste_compteurs) ; ce recalcul complet n'est
+		utilisé que par la commande recalcule_compteurs_classes, pour
+		corriger des compteurs faussés. Les classes sont verrouillées
+		(SELECT ... FOR UPDATE) pendant le calcul.
+
+		Renvoie le nombre de classes dont les compteurs ont changé.
+		"""
+		queryset = self.get_queryset()
+		if classes is not None:
+			pks = {getattr(classe, 'pk', classe) for classe in classes}
+			pks.discard(None)
+			if not pks:
+				return 0
+			queryset = queryset.filter(pk__in=pks)
+		classes = list(queryset.select_for_update().order_by('pk'))
+
+		compteurs = {ligne.pop('classe'): ligne
+			for ligne in self._agrege(
+				Proposition.objects.filter(classe__in=classes))}
+
+		modifiees = []
+		for classe in classes:
+			valeurs = compteurs.get(classe.pk, {})
+			if any(getattr(classe, champ) != valeurs.get(champ, 0)
+					for champ in self.CHAMPS_COMPTEURS):
+				for champ in self.CHAMPS_COMPTEURS:
+					setattr(classe, champ, valeurs.get(champ, 0))
+				modifiees.append(classe)
+
+		self.bulk_update(modifiees, self.CHAMPS_COMPTEURS)
+		return len(modifiees)
+
 class Classe(models.Model):
 	nom = models.CharField(max_length=20)
 	slug = models.SlugField(unique=True)
@@ -204,9 +474,55 @@ class Classe(models.Model):
 	capacite = models.SmallIntegerField(verbose_name="capacité")
 	surbooking = models.SmallIntegerField(default=0)
 
+	# Compteurs des propositions en cours, ajustés par
+	# Classe.objects.ajuste_compteurs à chaque modification des
+	# propositions (et recalculés entièrement par la commande
+	# recalcule_compteurs_classes).
+	nb_oui = models.PositiveIntegerField("oui définitifs", default=0,
+			editable=False)
+	nb_ouimais = models.PositiveIntegerField("oui avec vœux en attente",
+			default=0, editable=False)
+	nb_internat_oui = models.PositiveIntegerField(
+			"oui définitifs à l'internat", default=0, editable=False)
+	nb_internat_ouimais = models.PositiveIntegerField(
+			"oui avec vœux en attente à l'internat", default=0,
+			editable=False)
+	nb_inscrits = models.PositiveIntegerField("inscrits", default=0,
+			editable=False)
+
+	objects = ClasseManager()
+
 	def __str__(self):
 		return self.nom
 
+	@property
+	def nb_admis(self):
+		return self.nb_oui + self.nb_ouimais
+
+	@property
+	def nb_internat(self):
+		return self.nb_internat_oui + self.nb_internat_ouimais
+
+	@property
+	def marge(self):
+		"""
+		Nombre de places restantes avant d'atteindre la capacité de la
+		classe (négatif si la capacité est dépassée).
+		"""
+		return self.capacite - self.nb_admis
+
+	@property
+	def etat_capacite(self):
+		"""
+		Classe CSS qui indique si le nombre d'admis reste dans la
+		capacité de la classe, dans la limite du surbooking, ou au-delà.
+		"""
+		if self.nb_admis <= self.capacite:
+			return 'capacite_ok'
+		if self.nb_admis <= self.surbooking:
+			return 'capacite_surbooking'
+		return 'capacite_trop'
+
 	def get_absolute_url(self):
 		return reverse('classe.details', args=[self.slug,])
 
@@ -249,13 +565,16 @@ class Proposition(models.Model):
 	def __str__(self):
 		return str(self.date_proposition)
 
+	@transaction.atomic
 	def demission(self, date):
 		"""
 		Enregistre la démission d'un candidat sur cette proposition.
 		"""
 		deja_demission = self.date_demission is not None
+		compteurs_avant = Classe.objects.compteurs([self])
 		self.date_demission = date
 		self.save()
+		self.etudiant.oublie_empreinte()
 
 		actions = self.action_set.filter(etat=Action.ETAT_TODO
 			).exclude(categorie=Action.DEMISSION)
@@ -272,6 +591,8 @@ class Proposition(models.Model):
 			self.etudiant.proposition_actuelle = None
 			self.etudiant.save()
 
+		Classe.objects.ajuste_compteurs(compteurs_avant, Counter())
+
 	class Meta:
 		get_latest_by = 'date_proposition'
 
@@ -324,6 +645,12 @@ class Action(models.Model):
 
 	message = models.TextField(blank=True, null=False)
 
+	class Meta:
+		indexes = [
+			models.Index(fields=['etat', 'categorie'],
+				name='psup_action_etat_categorie_idx'),
+		]
+
 	def traiter(self, date):
 		"""Marque une action comme traitée à la date donnée"""
 		if self.etat == Action.ETAT_TODO:
@@ -372,7 +699,163 @@ class ParcoursupSynchro(models.Model):
 	source = models.SmallIntegerField(verbose_name="source des données",
 			choices=SOURCE_CHOICES)
 
+	# Bilan des candidats reçus lors de la synchronisation
+	nb_nouveaux = models.PositiveIntegerField(verbose_name="nouveaux candidats",
+			blank=True, null=True)
+	nb_modifies = models.PositiveIntegerField(verbose_name="candidats modifiés",
+			blank=True, null=True)
+	nb_inchanges = models.PositiveIntegerField(verbose_name="candidats inchangés",
+			blank=True, null=True)
+
+class VersionDonnees(models.Model):
+	"""
+	Numéro de version des données des étudiants, augmenté après chaque
+	modification des étudiants, des propositions ou des actions. Les
+	exports (listes de classes, adresses) sont conservés dans un cache
+	tant que ce numéro ne change pas.
+
+	La table ne contient qu'une seule ligne.
+	"""
+	numero = models.PositiveIntegerField(default=0)
+
+	@classmethod
+	def actuelle(cls):
+		return cls.objects.filter(pk=1).values_list('numero',
+				flat=True).first() or 0
+
+	@classmethod
+	def incremente(cls):
+		"""
+		Augmente le numéro de version une fois la transaction en cours
+		validée (ou immédiatement en dehors de toute transaction). La
+		ligne n'est ainsi pas verrouillée pendant toute la durée des
+		transactions qui modifient les données, et un export qui lit le
+		nouveau numéro voit forcément les modifications.
+		"""
+		transaction.on_commit(cls._incremente)
+
+	@classmethod
+	def _incremente(cls):
+		if not cls.objects.filter(pk=1).update(numero=F('numero') + 1):
+			# Première modification : la version passe de 0 (table
+			# vide, voir actuelle) à 1, sauf si la ligne vient d'être
+			# créée par un autre processus.
+			_, creee = cls.objects.get_or_create(pk=1,
+					defaults={'numero': 1})
+			if not creee:
+				cls.objects.filter(pk=1).update(numero=F('numero') + 1)
+
+	class Meta:
+		verbose_name = "version des données"
+		verbose_name_plural = "versions des données"
+
+class TacheExport(models.Model):
+	"""
+	Demande d'export (listes de classes, adresses) produite en
+	arrière-plan par la commande traite_exports, lorsque le réglage
+	PARCOURSUP_EXPORTS_ARRIERE_PLAN est activé.
+	"""
+	NATURE_CLASSES = 'classes'
+	NATURE_ADRESSES = 'adresses'
+	NATURE_ADRESSES_DEFINITIF = 'adresses_definitif'
+	NATURE_ETIQUETTES = 'etiquettes'
+	NATURE_CHOICES = (
+		(NATURE_CLASSES, "Listes des classes"),
+		(NATURE_ADRESSES, "Adresses de tous les envois"),
+		(NATURE_ADRESSES_DEFINITIF, "Adresses des oui définitifs"),
+		(NATURE_ETIQUETTES, "Étiquettes d'adresses"),
+	)
+	nature = models.CharField(max_length=30, choices=NATURE_CHOICES)
+
+	ETAT_EN_ATTENTE = 0
+	ETAT_EN_COURS = 1
+	ETAT_TERMINE = 2
+	ETAT_ECHEC = 3
+	ETAT_CHOICES = (
+		(ETAT_EN_ATTENTE, "En attente"),
+		(ETAT_EN_COURS, "En cours"),
+		(ETAT_TERMINE, "Terminé"),
+		(ETAT_ECHEC, "Échec"),
+	)
+	etat = models.SmallIntegerField(verbose_name="état",
+			choices=ETAT_CHOICES, default=ETAT_EN_ATTENTE, db_index=True)
+
+	utilisateur = models.ForeignKey(settings.AUTH_USER_MODEL,
+			blank=True, null=True, on_delete=models.SET_NULL)
+	date_demande = models.DateTimeField(auto_now_add=True,
+			verbose_name="date de la demande")
+	date_debut = models.DateTimeField(blank=True, null=True,
+			verbose_name="début")
+	date_fin = models.DateTimeField(blank=True, null=True,
+			verbose_name="fin")
+
+	# Avancement : nombre d'éléments (étudiants ou lignes) déjà traités
+	# sur le nombre total
+	progression = models.PositiveIntegerField(default=0)
+	total = models.PositiveIntegerField(blank=True, null=True)
+
+	# Version des données (VersionDonnees) exportées
+	version = models.PositiveIntegerField(blank=True, null=True)
+	message = models.TextField(blank=True)
+
+	class Meta:
+		verbose_name = "export en arrière-plan"
+		verbose_name_plural = "exports en arrière-plan"
+
+	def __str__(self):
+		return "{} ({})".format(self.get_nature_display(),
+				self.date_demande)
+
+	def en_cours(self):
+		return self.etat in (self.ETAT_EN_ATTENTE, self.ETAT_EN_COURS)
+
+	@classmethod
+	def abandonne_interrompues(cls):
+		"""
+		Marque en échec les exports commencés depuis plus de
+		PARCOURSUP_EXPORTS_TACHES_DUREE_MAX minutes et toujours en
+		cours : le processus qui les produisait a été arrêté avant la
+		fin. Sans cela, ils bloqueraient indéfiniment les nouvelles
+		demandes de même nature (voir exports.demande_export).
+
+		Renvoie le nombre d'exports marqués en échec.
+		"""
+		duree_max = getattr(settings, 'PARCOURSUP_EXPORTS_TACHES_DUREE_MAX',
+				30)
+		maintenant = timezone.now()
+		return cls.objects.filter(etat=cls.ETAT_EN_COURS,
+				date_debut__lt=maintenant - datetime.timedelta(
+					minutes=duree_max)
+			).update(etat=cls.ETAT_ECHEC, date_fin=maintenant,
+				message="Export interrompu avant la fin")
+
+	def pourcentage(self):
+		if self.etat == self.ETAT_TERMINE:
+			return 100
+		if not self.total:
+			return 0
+		return 100 * self.progression // self.total
+
+	def chemin(self):
+		"""
+		Fichier où est enregistré le document produit.
+		"""
+		return os.path.join(settings.PARCOURSUP_EXPORTS_TACHES, str(self.pk))
+
 class ParcoursupUserManager(models.Manager):
+	@staticmethod
+	def _cle_cache(username, password):
+		"""
+		Clé sous laquelle est conservée dans le cache une identification
+		réussie. Le mot de passe n'y apparait pas en clair : la clé est
+		un HMAC du couple (identifiant, mot de passe) calculé avec la
+		clé secrète du projet.
+		"""
+		mac = hmac.new(force_bytes(settings.SECRET_KEY),
+				json.dumps([username, password]).encode('utf-8'),
+				hashlib.sha256)
+		return 'parcoursup.identification.' + mac.hexdigest()
+
 	def authenticate(self, username, password):
 		"""
 		Renvoie l'utilisateur désigné par le nom d'utilisateur et le mot
@@ -380,11 +863,31 @@ class ParcoursupUserManager(models.Manager):
 
 		Lève l'exception ParcoursupUser.DoesNotExist si l'utilisateur
 		n'existe pas ou si le mot de passe n'est pas correct.
+
+		Parcoursup s'identifie à chaque appel avec le même compte. Pour
+		ne pas recalculer à chaque fois la dérivation coûteuse du mot de
+		passe, une identification réussie est conservée dans le cache
+		de Django pendant PARCOURSUP_IDENTIFICATION_CACHE secondes, avec
+		l'empreinte du mot de passe de l'utilisateur à ce moment-là :
+		l'entrée ne sert donc plus dès que le mot de passe est modifié.
+		Les échecs ne sont jamais conservés, et suivent toujours le
+		chemin complet de check_password.
 		"""
 		user = self.get(username=username)
+
+		cle = self._cle_cache(username, password)
+		empreinte = cache.get(cle)
+		if empreinte is not None and \
+				constant_time_compare(empreinte, user.password):
+			return user
+
 		if not user.check_password(password):
 			raise user.DoesNotExist
 
+		duree = getattr(settings, 'PARCOURSUP_IDENTIFICATION_CACHE', 300)
+		if duree:
+			cache.set(cle, user.password, duree)
+
 		return user
 
 class ParcoursupUser(models.Model):
@@ -413,7 +916,19 @@ class ParcoursupUser(models.Model):
 class ParcoursupMessageRecuLog(models.Model):
 	"""
 	Journal des messages reçus depuis Parcoursup
+
+	Lorsque les messages d'admission sont traités de façon asynchrone
+	(réglage PARCOURSUP_ADMISSION_ASYNCHRONE), ce journal sert aussi de
+	file d'attente : les messages acceptés sont enregistrés dans l'état
+	ETAT_EN_ATTENTE, puis appliqués par la commande traite_admissions.
 	"""
+	ETAT_TRAITE = 0
+	ETAT_EN_ATTENTE = 1
+	ETAT_CHOICES = (
+		(ETAT_TRAITE, "traité"),
+		(ETAT_EN_ATTENTE, "en attente de traitement"),
+	)
+
 	date = models.DateTimeField()
 	ip_source = models.GenericIPAddressField()
 	user = models.ForeignKey(ParcoursupUser, on_delete=models.SET_NULL,
@@ -423,6 +938,64 @@ class ParcoursupMessageRecuLog(models.Model):
 	succes = models.BooleanField()
 	payload = models.BinaryField(verbose_name="données reçues",
 			blank=True, default=b'', null=True)
+	payload_compresse = models.BooleanField("données compressées",
+			default=False)
+	etat = models.SmallIntegerField(choices=ETAT_CHOICES,
+			default=ETAT_TRAITE, db_index=True)
+	date_traitement = models.DateTimeField("date de traitement",
+			blank=True, null=True)
+	code_candidat = models.IntegerField("numéro de dossier du candidat",
+			blank=True, null=True, db_index=True)
+
+	# Parcoursup renvoie parfois plusieurs fois le même message. Chaque
+	# message est identifié par l'empreinte de son contenu (sans les
+	# données d'identification) ; un message déjà reçu n'est pas traité
+	# une seconde fois, et le journal fait alors seulement référence au
+	# premier exemplaire, sans en conserver une nouvelle copie. La
+	# contrainte psup_msgrecu_empreinte_uniq garantit qu'un seul
+	# exemplaire accepté est traité, même lorsque deux requêtes
+	# identiques arrivent en même temps.
+	empreinte = models.CharField("empreinte du contenu", max_length=64,
+			blank=True, default='', db_index=True)
+	doublon_de = models.ForeignKey('self', on_delete=models.SET_NULL,
+			blank=True, null=True, related_name='doublons',
+			verbose_name="doublon du message")
+
+	class Meta:
+		indexes = [
+			models.Index(fields=['date'], name='psup_msgrecu_date_idx'),
+			models.Index(fields=['endpoint'], name='psup_msgrecu_endpoint_idx'),
+			models.Index(fields=['succes'], name='psup_msgrecu_succes_idx'),
+		]
+		constraints = [
+			models.UniqueConstraint(fields=['endpoint', 'empreinte'],
+				condition=models.Q(doublon_de__isnull=True, succes=True) \
+						& ~models.Q(empreinte=''),
+				name='psup_msgrecu_empreinte_uniq'),
+		]
+
+	@property
+	def contenu(self):
+		"""
+		Données reçues, décompressées si besoin. Le champ payload
+		contient ces données compressées avec zlib lorsque
+		payload_compresse vaut True (c'est le cas de tous les messages
+		enregistrés en passant par cette propriété).
+		"""
+		if self.payload is None:
+			return None
+		if self.payload_compresse:
+			return zlib.decompress(self.payload)
+		return bytes(self.payload)
+
+	@contenu.setter
+	def contenu(self, donnees):
+		if donnees is None:
+			self.payload = None
+			self.payload_compresse = False
+		else:
+			self.payload = zlib.compress(donnees)
+			self.payload_compresse = True
 
 class ParcoursupMessageEnvoyeLog(models.Model):
 	"""
@@ -430,9 +1003,93 @@ class ParcoursupMessageEnvoyeLog(models.Model):
 	"""
 	date = models.DateTimeField()
 
+class CommuneManager(models.Manager):
+	# Cache des libellés des communes, partagé par tout le processus,
+	# qui à chaque code INSEE déjà trouvé associe le libellé de la
+	# commune. Les codes inconnus n'y sont pas conservés : une commune
+	# ajoutée par un autre processus est trouvée dès la recherche
+	# suivante.
+	_libelles = {}
+
+	# Nombre maximal de libellés conservés (la France compte environ
+	# 35 000 communes) : au-delà, le cache est vidé.
+	TAILLE_CACHE = 50000
+
+	def libelles(self, codes):
+		"""
+		Renvoie un dictionnaire qui à chaque code INSEE donné en
+		paramètre associe le libellé de la commune correspondante, ou
+		None si la commune n'existe pas.
+
+		Les codes qui ne sont pas dans le cache sont recherchés dans la
+		base de données en une seule requête.
+		"""
+		libelles = {}
+		manquants = []
+		for code in set(codes):
+			try:
+				libelles[code] = self._libelles[code]
+			except KeyError:
+				manquants.append(code)
+
+		if manquants:
+			trouves = dict(self.get_queryset().filter(
+				pk__in=manquants).values_list('insee', 'libelle'))
+			if len(self._libelles) + len(trouves) > self.TAILLE_CACHE:
+				self._libelles.clear()
+			self._libelles.update(trouves)
+			for code in manquants:
+				libelles[code] = trouves.get(code)
+
+		return libelles
+
+	def libelle(self, code):
+		"""
+		Renvoie le libellé de la commune dont le code INSEE est donné en
+		paramètre, ou None si elle n'existe pas.
+		"""
+		return self.libelles([code])[code]
+
+	def vide_cache(self):
+		self._libelles.clear()
+
 class Commune(models.Model):
 	"""
 	Commune française, identifiée par son code INSEE.
 	"""
 	insee = models.CharField(max_length=5, primary_key=True)
 	libelle = models.CharField(max_length=200)
+
+	objects = CommuneManager()
+
+@receiver(post_save, sender=Commune)
+@receiver(post_delete, sender=Commune)
+def vide_cache_communes(sender, **kwargs):
+	"""
+	Vide le cache des libellés lorsque la table des communes est
+	modifiée, notamment lors du chargement du fichier de l'INSEE avec
+	loaddata.
+
+	Seul le cache du processus qui a modifié la table est vidé. Les
+	autres processus (serveur web) trouvent immédiatement les nouvelles
+	communes, qui ne sont pas dans leur cache, mais doivent être
+	redémarrés pour voir les libellés modifiés.
+	"""
+	Commune.objects.vide_cache()
+
+@receiver(post_save, sender=Etudiant)
+@receiver(post_save, sender=Proposition)
+@receiver(post_save, sender=Action)
+@receiver(post_save, sender=Classe)
+@receiver(post_delete, sender=Etudiant)
+@receiver(post_delete, sender=Proposition)
+@receiver(post_delete, sender=Action)
+@receiver(post_delete, sender=Classe)
+def donnees_modifiees(sender, **kwargs):
+	"""
+	Change la version des données à chaque enregistrement d'un objet.
+	Les modifications faites en masse (update, bulk_create, bulk_update)
+	n'envoient pas ces signaux : le code qui les fait appelle lui-même
+	VersionDonnees.incremente.
+	"""
+	VersionDonnees.incremente()
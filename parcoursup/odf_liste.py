@@ -16,180 +16,293 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+"""
+Export des listes de classes au format OpenDocument (tableur)
+
+Le fichier est produit au fil de l'eau : content.xml est écrit ligne
+par ligne dans l'archive ZIP pendant le parcours des étudiants, et les
+octets de l'archive sont rendus dès qu'ils sont prêts. Ni le document
+ni l'archive ne sont donc construits entièrement en mémoire.
+"""
+
 from __future__ import unicode_literals
 
-from odf.opendocument import OpenDocumentSpreadsheet
-from odf.table import Table, TableColumn, TableRow, TableCell, \
-		CoveredTableCell
-from odf.style import Style, TableColumnProperties, TableRowProperties, \
-		TextProperties, ParagraphProperties
-import odf.number
-from odf.text import P
+from xml.sax.saxutils import escape, quoteattr
+import zipfile
+import zlib
+
+from django.db.models import Case, When, Value, IntegerField
 
 from parcoursup.models import Etudiant
 
-def par_classe(classes, fileout):
-	ods = OpenDocumentSpreadsheet()
-
-	style_civilite = Style(parent=ods.automaticstyles,
-			name='col_civilite', family='table-column')
-	TableColumnProperties(parent=style_civilite, columnwidth='1cm')
-
-	style_nom = Style(parent=ods.automaticstyles,
-			name='col_nom', family='table-column')
-	TableColumnProperties(parent=style_nom, columnwidth='4.5cm')
-
-	style_date = Style(parent=ods.automaticstyles,
-			name='col_date', family='table-column')
-	TableColumnProperties(parent=style_date, columnwidth='3.2cm')
-
-	style_internat = Style(parent=ods.automaticstyles,
-			name='col_internat', family='table-column')
-	TableColumnProperties(parent=style_internat, columnwidth='3.2cm')
-
-	style_classe = Style(parent=ods.automaticstyles,
-			name='col_classe', family='table-column')
-	TableColumnProperties(parent=style_classe, columnwidth='3.2cm')
-
-	style_etat_voeu = Style(parent=ods.automaticstyles,
-			name='col_etat_voeu', family='table-column')
-	TableColumnProperties(parent=style_etat_voeu, columnwidth='4cm')
-
-	style_titre = Style(parent=ods.automaticstyles,
-			name='cell_titre', family='table-cell')
-	TextProperties(parent=style_titre, fontweight='bold',
-			fontsize='14pt')
-	ParagraphProperties(parent=style_titre, textalign='center')
-
-	style_ligne_titre = Style(parent=ods.automaticstyles,
-			name='ligne_titre', family='table-row')
-	TableRowProperties(parent=style_ligne_titre, rowheight='8mm')
-
-	style_entete = Style(parent=ods.automaticstyles,
-			name='cell_entete', family='table-cell')
-	TextProperties(parent=style_entete, fontweight='bold')
-
-	number_style_date_format = odf.number.DateStyle(parent=ods.automaticstyles,
-			name='date_number')
-	odf.number.Day(parent=number_style_date_format, style='long')
-	odf.number.Text(parent=number_style_date_format, text="/")
-	odf.number.Month(parent=number_style_date_format, style='long')
-	odf.number.Text(parent=number_style_date_format, text="/")
-	odf.number.Year(parent=number_style_date_format, style='long')
-	style_date_format = Style(parent=ods.automaticstyles,
-			name='cell_date', family='table-cell',
-			datastylename=number_style_date_format)
-
-	for classe in classes:
-		table = Table(name=str(classe))
-		table.addElement(TableColumn(stylename=style_civilite)) # Sexe
-		table.addElement(TableColumn(stylename=style_nom)) # Nom
-		table.addElement(TableColumn(stylename=style_nom)) # Prénom
-		table.addElement(TableColumn(stylename=style_date)) # Date de naissance
-		table.addElement(TableColumn(stylename=style_internat)) # Internat
-		table.addElement(TableColumn(stylename=style_etat_voeu)) # État vœu
-		table.addElement(TableColumn(stylename=style_nom)) # E-mail
-		table.addElement(TableColumn(stylename=style_nom)) # Téléphone
-		table.addElement(TableColumn(stylename=style_nom)) # Mobile
-
-		# En-tête de la feuille
-		tr = TableRow(parent=table, stylename=style_ligne_titre)
-		cell = TableCell(parent=tr,
-				numbercolumnsspanned=9, numberrowsspanned=1,
-				valuetype='string', stylename=style_titre)
-		cell.addElement(P(text=str(classe)))
-		CoveredTableCell(parent=tr, numbercolumnsrepeated=8)
-
-		tr = TableRow(parent=table)
-		TableCell(parent=tr) # Sexe
-		P(parent=TableCell(parent=tr, valuetype='string', stylename=style_entete), text="Nom")
-		P(parent=TableCell(parent=tr, valuetype='string', stylename=style_entete), text="Prénom")
-		P(parent=TableCell(parent=tr, valuetype='string', stylename=style_entete), text="Date de naissance")
-		P(parent=TableCell(parent=tr, valuetype='string', stylename=style_entete), text="Internat")
-		P(parent=TableCell(parent=tr, valuetype='string', stylename=style_entete), text="État Parcoursup")
-		P(parent=TableCell(parent=tr, valuetype='string', stylename=style_entete), text="E-mail")
-		P(parent=TableCell(parent=tr, valuetype='string', stylename=style_entete), text="Téléphone")
-		P(parent=TableCell(parent=tr, valuetype='string', stylename=style_entete), text="Mobile")
-
-		for etudiant in classe.admissions().order_by('nom'):
-			tr = TableRow()
-			table.addElement(tr)
-
-			TableCell(parent=tr, valuetype='string').addElement(P(text=etudiant.get_sexe_display()))
-
-			TableCell(parent=tr, valuetype='string').addElement(P(text=etudiant.nom))
-
-			TableCell(parent=tr, valuetype='string').addElement(P(text=etudiant.prenom))
-
-			cell = TableCell(valuetype='date',
-					datevalue=str(etudiant.date_naissance),
-					stylename=style_date_format)
-			cell.addElement(P(text=etudiant.date_naissance))
-			tr.addElement(cell)
-
-			cell = TableCell(valuetype='string')
-			if etudiant.proposition_actuelle.internat:
-				cell.addElement(P(text="Interne"))
-			tr.addElement(cell)
-
-			TableCell(parent=tr, valuetype='string').addElement(P(text=etudiant.proposition_actuelle.get_etat_display()))
-
-			TableCell(parent=tr, valuetype='string').addElement(P(text=etudiant.email))
-			TableCell(parent=tr, valuetype='string').addElement(P(text=etudiant.telephone))
-			TableCell(parent=tr, valuetype='string').addElement(P(text=etudiant.telephone_mobile))
-
-		ods.spreadsheet.addElement(table)
-
-	# Liste générale pour l'infirmerie
-	table = Table(name="Infirmerie")
-	ods.spreadsheet.addElement(table)
-	table.addElement(TableColumn(stylename=style_civilite)) # Sexe
-	table.addElement(TableColumn(stylename=style_nom)) # Nom
-	table.addElement(TableColumn(stylename=style_nom)) # Prénom
-	table.addElement(TableColumn(stylename=style_classe)) # Classe
-	table.addElement(TableColumn(stylename=style_date)) # Date de naissance
-	table.addElement(TableColumn(stylename=style_internat)) # Internat
-
-	# En-tête de la feuille
-	tr = TableRow(parent=table, stylename=style_ligne_titre)
-	cell = TableCell(parent=tr,
-			numbercolumnsspanned=9, numberrowsspanned=1,
-			valuetype='string', stylename=style_titre)
-	cell.addElement(P(text="Liste de tous les étudiants admis"))
-	tr = TableRow(parent=table)
-	TableCell(parent=tr) # Sexe
-	P(parent=TableCell(parent=tr, valuetype='string', stylename=style_entete), text="Nom")
-	P(parent=TableCell(parent=tr, valuetype='string', stylename=style_entete), text="Prénom")
-	P(parent=TableCell(parent=tr, valuetype='string', stylename=style_entete), text="Classe")
-	P(parent=TableCell(parent=tr, valuetype='string', stylename=style_entete), text="Date de naissance")
-	P(parent=TableCell(parent=tr, valuetype='string', stylename=style_entete), text="Internat")
-
-	for etudiant in Etudiant.objects.filter(
-		proposition_actuelle__isnull=False,
-		proposition_actuelle__date_demission__isnull=True
-		).order_by('nom', 'prenom'):
-
-		tr = TableRow(parent=table)
-
-		TableCell(parent=tr, valuetype='string').addElement(P(text=etudiant.get_sexe_display()))
-
-		TableCell(parent=tr, valuetype='string').addElement(P(text=etudiant.nom))
-
-		TableCell(parent=tr, valuetype='string').addElement(P(text=etudiant.prenom))
-
-		TableCell(parent=tr,
-			valuetype='string').addElement(P(text=str(etudiant.proposition_actuelle.classe)))
-
-		cell = TableCell(valuetype='date',
-				datevalue=str(etudiant.date_naissance),
-				stylename=style_date_format)
-		cell.addElement(P(text=etudiant.date_naissance))
-		tr.addElement(cell)
-
-		cell = TableCell(valuetype='string')
-		if etudiant.proposition_actuelle.internat:
-			cell.addElement(P(text="Interne"))
-		tr.addElement(cell)
-
-
-	ods.write(fileout)
+MIMETYPE = 'application/vnd.oasis.opendocument.spreadsheet'
+
+# Taille à partir de laquelle les octets déjà produits sont rendus
+TAILLE_MORCEAU = 64 * 1024
+
+MANIFEST = """<?xml version="1.0" encoding="UTF-8"?>
+<manifest:manifest xmlns:manifest="urn:oasis:names:tc:opendocument:xmlns:manifest:1.0" manifest:version="1.2">
+ <manifest:file-entry manifest:full-path="/" manifest:version="1.2" manifest:media-type="{}"/>
+ <manifest:file-entry manifest:full-path="content.xml" manifest:media-type="text/xml"/>
+</manifest:manifest>
+""".format(MIMETYPE)
+
+DEBUT_CONTENU = """<?xml version="1.0" encoding="UTF-8"?>
+<office:document-content xmlns:office="urn:oasis:names:tc:opendocument:xmlns:office:1.0" xmlns:style="urn:oasis:names:tc:opendocument:xmlns:style:1.0" xmlns:text="urn:oasis:names:tc:opendocument:xmlns:text:1.0" xmlns:table="urn:oasis:names:tc:opendocument:xmlns:table:1.0" xmlns:fo="urn:oasis:names:tc:opendocument:xmlns:xsl-fo-compatible:1.0" xmlns:number="urn:oasis:names:tc:opendocument:xmlns:datastyle:1.0" office:version="1.2">
+<office:automatic-styles>
+<style:style style:name="col_civilite" style:family="table-column"><style:table-column-properties style:column-width="1cm"/></style:style>
+<style:style style:name="col_nom" style:family="table-column"><style:table-column-properties style:column-width="4.5cm"/></style:style>
+<style:style style:name="col_date" style:family="table-column"><style:table-column-properties style:column-width="3.2cm"/></style:style>
+<style:style style:name="col_internat" style:family="table-column"><style:table-column-properties style:column-width="3.2cm"/></style:style>
+<style:style style:name="col_classe" style:family="table-column"><style:table-column-properties style:column-width="3.2cm"/></style:style>
+<style:style style:name="col_etat_voeu" style:family="table-column"><style:table-column-properties style:column-width="4cm"/></style:style>
+<style:style style:name="cell_titre" style:family="table-cell"><style:paragraph-properties fo:text-align="center"/><style:text-properties fo:font-weight="bold" fo:font-size="14pt"/></style:style>
+<style:style style:name="ligne_titre" style:family="table-row"><style:table-row-properties style:row-height="8mm"/></style:style>
+<style:style style:name="cell_entete" style:family="table-cell"><style:text-properties fo:font-weight="bold"/></style:style>
+<number:date-style style:name="date_number"><number:day number:style="long"/><number:text>/</number:text><number:month number:style="long"/><number:text>/</number:text><number:year number:style="long"/></number:date-style>
+<style:style style:name="cell_date" style:family="table-cell" style:data-style-name="date_number"/>
+</office:automatic-styles>
+<office:body>
+<office:spreadsheet>
+"""
+
+FIN_CONTENU = """</office:spreadsheet>
+</office:body>
+</office:document-content>
+"""
+
+# Aucun texte ne doit apparaître entre les éléments du document : on
+# retire les retours à la ligne, qui ne servent qu'à la lisibilité.
+DEBUT_CONTENU = DEBUT_CONTENU.replace('\n', '')
+FIN_CONTENU = FIN_CONTENU.replace('\n', '')
+
+# Colonnes des feuilles (style de la colonne, titre de la colonne)
+COLONNES_CLASSE = (
+	('col_civilite', None),
+	('col_nom', "Nom"),
+	('col_nom', "Prénom"),
+	('col_date', "Date de naissance"),
+	('col_internat', "Internat"),
+	('col_etat_voeu', "État Parcoursup"),
+	('col_nom', "E-mail"),
+	('col_nom', "Téléphone"),
+	('col_nom', "Mobile"),
+)
+
+COLONNES_INFIRMERIE = (
+	('col_civilite', None),
+	('col_nom', "Nom"),
+	('col_nom', "Prénom"),
+	('col_classe', "Classe"),
+	('col_date', "Date de naissance"),
+	('col_internat', "Internat"),
+)
+
+class _Tampon:
+	"""
+	Destination de l'archive ZIP. Elle n'est pas positionnable (pas de
+	méthode seek) : zipfile écrit alors la taille et la somme de
+	contrôle de chaque fichier après ses données, sans revenir en
+	arrière, et les octets écrits peuvent être rendus aussitôt. La
+	méthode tell donne le nombre total d'octets écrits.
+	"""
+	def __init__(self):
+		self.morceaux = []
+		self.taille = 0
+		self.position = 0
+
+	def write(self, donnees):
+		self.morceaux.append(bytes(donnees))
+		self.taille += len(donnees)
+		self.position += len(donnees)
+		return len(donnees)
+
+	def tell(self):
+		return self.position
+
+	def flush(self):
+		pass
+
+	def vide(self):
+		donnees = b''.join(self.morceaux)
+		self.morceaux = []
+		self.taille = 0
+		return donnees
+
+def _mimetype():
+	"""
+	Entrée mimetype de l'archive : ZipInfo et octets à écrire au début
+	de l'archive (en-tête local puis type MIME).
+
+	La spécification OpenDocument demande que cette entrée soit la
+	première, non compressée, sans champ supplémentaire, et que le type
+	MIME se trouve à l'octet 38 de l'archive. Sur une destination non
+	positionnable, zipfile ajouterait un descripteur de données après
+	le contenu : on écrit donc l'en-tête nous-mêmes, avec la taille et
+	la somme de contrôle déjà connues.
+	"""
+	donnees = MIMETYPE.encode('ascii')
+	info = zipfile.ZipInfo('mimetype')
+	info.compress_type = zipfile.ZIP_STORED
+	info.file_size = info.compress_size = len(donnees)
+	info.CRC = zlib.crc32(donnees)
+	info.header_offset = 0
+	return info, info.FileHeader(zip64=False) + donnees
+
+def _cellule(texte, style=None):
+	if texte is None or texte == '':
+		return '<table:table-cell/>'
+	return '<table:table-cell office:value-type="string"{}><text:p>{}</text:p></table:table-cell>'.format(
+			' table:style-name="{}"'.format(style) if style else '',
+			escape(str(texte)))
+
+def _cellule_date(date):
+	if date is None:
+		return '<table:table-cell/>'
+	return '<table:table-cell office:value-type="date" office:date-value="{0}" table:style-name="cell_date"><text:p>{0}</text:p></table:table-cell>'.format(
+			date.isoformat())
+
+def _debut_feuille(nom, titre, colonnes):
+	return ''.join([
+		'<table:table table:name={}>'.format(quoteattr(nom)),
+		''.join('<table:table-column table:style-name="{}"/>'.format(style)
+			for style, _ in colonnes),
+		'<table:table-row table:style-name="ligne_titre">',
+		'<table:table-cell office:value-type="string" table:style-name="cell_titre" table:number-columns-spanned="{}" table:number-rows-spanned="1"><text:p>{}</text:p></table:table-cell>'.format(
+			len(colonnes), escape(titre)),
+		'<table:covered-table-cell table:number-columns-repeated="{}"/>'.format(
+			len(colonnes) - 1),
+		'</table:table-row>',
+		'<table:table-row>',
+		''.join(_cellule(entete, 'cell_entete') for _, entete in colonnes),
+		'</table:table-row>',
+	])
+
+def _ligne(cellules):
+	return '<table:table-row>{}</table:table-row>'.format(''.join(cellules))
+
+def _ligne_classe(etudiant):
+	proposition = etudiant.proposition_actuelle
+	return _ligne([
+		_cellule(etudiant.get_sexe_display()),
+		_cellule(etudiant.nom),
+		_cellule(etudiant.prenom),
+		_cellule_date(etudiant.date_naissance),
+		_cellule("Interne" if proposition.internat else None),
+		_cellule(proposition.get_etat_display()),
+		_cellule(etudiant.email),
+		_cellule(etudiant.telephone),
+		_cellule(etudiant.telephone_mobile),
+	])
+
+def _ligne_infirmerie(etudiant):
+	proposition = etudiant.proposition_actuelle
+	return _ligne([
+		_cellule(etudiant.get_sexe_display()),
+		_cellule(etudiant.nom),
+		_cellule(etudiant.prenom),
+		_cellule(proposition.classe),
+		_cellule_date(etudiant.date_naissance),
+		_cellule("Interne" if proposition.internat else None),
+	])
+
+def _admissions(classes):
+	"""
+	Étudiants admis dans les classes données en paramètre, triés dans
+	l'ordre de la liste des classes, puis par nom, en une seule requête.
+	"""
+	if not classes:
+		return []
+	rang = Case(*[When(proposition_actuelle__classe=classe.pk,
+		then=Value(i)) for i, classe in enumerate(classes)],
+		output_field=IntegerField())
+	return Etudiant.objects.filter(proposition_actuelle__classe__in=classes,
+			proposition_actuelle__date_demission__isnull=True,
+			proposition_actuelle__remplacee_par__isnull=True
+		).select_related('proposition_actuelle'
+		).annotate(rang_classe=rang).order_by('rang_classe', 'nom').iterator()
+
+def _infirmerie():
+	return Etudiant.objects.filter(proposition_actuelle__isnull=False,
+			proposition_actuelle__date_demission__isnull=True)
+
+def par_classe_flux(classes, progression=None):
+	"""
+	Générateur qui produit, morceau par morceau, le fichier ODS des
+	listes d'étudiants : une feuille par classe (dans l'ordre de
+	classes), puis une feuille pour l'infirmerie avec tous les
+	étudiants admis.
+
+	Si progression est donnée, elle est appelée après chaque ligne
+	avec le nombre de lignes déjà écrites et le nombre total.
+	"""
+	classes = list(classes)
+	tampon = _Tampon()
+
+	fait = 0
+	if progression:
+		total = _infirmerie().count()
+		if classes:
+			total += Etudiant.objects.filter(
+					proposition_actuelle__classe__in=classes,
+					proposition_actuelle__date_demission__isnull=True,
+					proposition_actuelle__remplacee_par__isnull=True).count()
+
+	info_mimetype, entete = _mimetype()
+	tampon.write(entete)
+
+	with zipfile.ZipFile(tampon, 'w', zipfile.ZIP_DEFLATED) as archive:
+		# L'entrée mimetype est déjà écrite : il reste à l'inscrire dans
+		# le répertoire central de l'archive.
+		archive.filelist.append(info_mimetype)
+		archive.NameToInfo[info_mimetype.filename] = info_mimetype
+		archive.writestr('META-INF/manifest.xml', MANIFEST)
+		yield tampon.vide()
+
+		with archive.open('content.xml', 'w') as contenu:
+			def ecrit(texte):
+				contenu.write(texte.encode('utf-8'))
+
+			ecrit(DEBUT_CONTENU)
+
+			etudiants = iter(_admissions(classes))
+			etudiant = next(etudiants, None)
+			for classe in classes:
+				ecrit(_debut_feuille(str(classe), str(classe),
+					COLONNES_CLASSE))
+				while etudiant is not None and \
+						etudiant.proposition_actuelle.classe_id == classe.pk:
+					ecrit(_ligne_classe(etudiant))
+					fait += 1
+					if progression:
+						progression(fait, total)
+					if tampon.taille >= TAILLE_MORCEAU:
+						yield tampon.vide()
+					etudiant = next(etudiants, None)
+				ecrit('</table:table>')
+
+			# Liste générale pour l'infirmerie
+			ecrit(_debut_feuille("Infirmerie",
+				"Liste de tous les étudiants admis", COLONNES_INFIRMERIE))
+			for etudiant in _infirmerie().select_related(
+					'proposition_actuelle__classe'
+					).order_by('nom', 'prenom').iterator():
+				ecrit(_ligne_infirmerie(etudiant))
+				fait += 1
+				if progression:
+					progression(fait, total)
+				if tampon.taille >= TAILLE_MORCEAU:
+					yield tampon.vide()
+			ecrit('</table:table>')
+
+			ecrit(FIN_CONTENU)
+
+	yield tampon.vide()
+
+def par_classe(classes, fileout, progression=None):
+	"""
+	Écrit dans le fichier fileout le fichier ODS des listes d'étudiants
+	(voir par_classe_flux).
+	"""
+	for morceau in par_classe_flux(classes, progression):
+		fileout.write(morceau)
@@ -20,31 +20,27 @@
 Utilitaires pour communiquer avec l'API REST de Parcoursup
 """
 
-from datetime import date, datetime
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+from datetime import date
 import re
 import requests
-from dateutil.tz import gettz
 
+from django.db import transaction
 from django.utils import timezone
 from django.conf import settings
 
+from parcoursup.client_http import session_parcoursup
 from parcoursup.models import Commune, Classe, Etudiant, \
-		Proposition, ParcoursupSynchro
-from parcoursup.utils import parse_french_date
+		Proposition, ParcoursupSynchro, VersionDonnees
+from parcoursup.utils import parse_french_date, parse_datetime, \
+		par_paquets, empreinte_json, iter_tableau_json
 
 PARCOURSUP_ENDPOINT = "https://ws.parcoursup.fr/ApiRest/"
 
 def parse_date_reponse(date_str):
-	paris_tz = gettz('Europe/Paris')
-	date_match = re.match('^(?P<jour>\d{1,2})/(?P<mois>\d{1,2})/(?P<annee>\d{4}) (?P<heure>\d{1,2}):(?P<minute>\d{1,2})$', date_str)
-	return datetime(
-		year=int(date_match.group('annee')),
-		month=int(date_match.group('mois')),
-		day=int(date_match.group('jour')),
-		hour=int(date_match.group('heure')),
-		minute=int(date_match.group('minute')),
-		tzinfo=paris_tz,
-	)
+	return parse_datetime(date_str)
 
 class ParcoursupRequest:
 	"""
@@ -53,12 +49,20 @@ class ParcoursupRequest:
 	d'identification.
 	"""
 	def __init__(self, login, password, method_name=None,
-			http_method='POST', data={}):
+			http_method='POST', data={}, stream=False, session=None,
+			endpoint=PARCOURSUP_ENDPOINT):
 		self.login = login
 		self.password = password
 		self.response = None
 		self.method_name = method_name
 		self.http_method = http_method
+		# Lorsque stream vaut True, le corps de la réponse n'est pas
+		# téléchargé par send(), mais au fur et à mesure de sa lecture.
+		self.stream = stream
+		# Session HTTP utilisée pour envoyer la requête. Par défaut, on
+		# utilise la session partagée de client_http.
+		self.session = session
+		self.endpoint = endpoint
 
 		self.data = data
 		self.data.update({
@@ -73,7 +77,7 @@ class ParcoursupRequest:
 		Construction de l'URL à laquelle il faut poster la requête.
 		"""
 		return '{base}{method}'.format(
-			base=PARCOURSUP_ENDPOINT, method=self.method_name)
+			base=self.endpoint, method=self.method_name)
 
 	def send(self):
 		"""
@@ -86,7 +90,9 @@ class ParcoursupRequest:
 			raise ValueError("Cette API ne gère pas d'autres méthodes "
 					"HTTP que POST")
 
-		self.request = requests.post(self.get_url(), json=self.data)
+		session = self.session or session_parcoursup()
+		self.request = session.post(self.get_url(), json=self.data,
+				stream=self.stream)
 
 class ParcoursupPersonne:
 	SEXE_HOMME = Etudiant.SEXE_HOMME
@@ -108,6 +114,18 @@ class ParcoursupCandidat(ParcoursupPersonne):
 		self.date_naissance = kwargs.get('date_naissance')
 		self.ine = kwargs.get('ine')
 
+	@classmethod
+	def depuis_etudiant(cls, etudiant):
+		"""
+		Construit un candidat Parcoursup d'après un étudiant enregistré
+		dans la base de données.
+		"""
+		return cls(code=etudiant.dossier_parcoursup,
+				nom=etudiant.nom,
+				prenom=etudiant.prenom,
+				date_naissance=etudiant.date_naissance,
+				ine=etudiant.ine)
+
 	def to_json(self):
 		return {
 			'codeCandidat': int(self.code),
@@ -125,7 +143,7 @@ class ParcoursupResponsableLegal(ParcoursupPersonne):
 class ParcoursupProposition:
 	ETAT_ATTENTE = 0
 	ETAT_ACCEPTEE = 1
-	ETAT_ACEPTEE_AUTRES_VOEUX = 2
+	ETAT_ACCEPTEE_AUTRES_VOEUX = 2
 	ETAT_REFUSEE = 3
 
 	def __init__(self, **kwargs):
@@ -137,21 +155,41 @@ class ParcoursupProposition:
 		self.etat = kwargs.get('etat')
 		self.date = kwargs.get('date')
 
+# Résultat de la mise à jour de l'inscription d'un candidat
+ResultatInscription = namedtuple('ResultatInscription', ('candidat',
+	'succes', 'message'))
+
 class ParcoursupRest:
 	def __init__(self, login=settings.PARCOURSUP_REST_LOGIN,
 			password=settings.PARCOURSUP_REST_PASSWORD,
-			code_etablissement=settings.PARCOURSUP_UAI_ETABLISSEMENT):
+			code_etablissement=settings.PARCOURSUP_UAI_ETABLISSEMENT,
+			session=None, endpoint=PARCOURSUP_ENDPOINT):
 		self.login = login
 		self.password = password
 		self.code_etablissement = code_etablissement
+		self.session = session
+		self.endpoint = endpoint
 
-	def get_candidats_admis(self, **kwargs):
+	def requete(self, method_name, data, **kwargs):
+		"""
+		Construit une requête vers la méthode donnée de l'API
+		Parcoursup, avec les identifiants, la session HTTP et l'adresse
+		de l'API de cet objet.
+		"""
+		return ParcoursupRequest(self.login, self.password,
+				method_name=method_name, data=data,
+				session=self.session, endpoint=self.endpoint, **kwargs)
+
+	def get_candidats_admis(self, stream=False, **kwargs):
 		"""
 		Accès générique à la méthode getCandidatsAdmis de l'API
 		Parcoursup.
 
 		Cette méthode est déclinée en autres méthodes plus simples à
 		utiliser, en fonction des paramètres que l'on veut renseigner.
+
+		Si stream vaut True, la réponse de Parcoursup n'est téléchargée
+		qu'au moment de sa lecture.
 		"""
 		parcoursup_args = {
 			'code_candidat': ('codeCandidat', int),
@@ -171,27 +209,55 @@ class ParcoursupRest:
 			raise TypeError("Unexpected named parameters {}".format(
 				', '.join(args_inconnus)))
 
-		request = ParcoursupRequest(self.login, self.password,
-				method_name='getCandidatsAdmis',
-				data=request_data)
+		request = self.requete('getCandidatsAdmis', request_data,
+				stream=stream)
 		request.send()
 		return request
 
+	# Taille des morceaux lus dans la réponse de getCandidatsAdmis
+	TAILLE_MORCEAU = 64 * 1024
+	# Nombre de candidats dont on formate les adresses en même temps
+	TAILLE_PAQUET = 500
+
+	def iter_candidats_admis(self, **kwargs):
+		"""
+		Lecture au fil de l'eau de la réponse de la méthode
+		getCandidatsAdmis de l'API Parcoursup.
+
+		Renvoie un itérateur sur les admissions, analysées une à une
+		par parse_parcoursup_admission() au fur et à mesure de leur
+		téléchargement : la liste complète des candidats n'est jamais
+		chargée en mémoire.
+
+		Les paramètres nommés sont ceux de get_candidats_admis().
+		"""
+		request = self.get_candidats_admis(stream=True, **kwargs)
+		with contextlib.closing(request.request) as response:
+			psup_jsons = iter_tableau_json(response.iter_content(
+					chunk_size=self.TAILLE_MORCEAU))
+
+			# On traite les candidats par paquets pour formater leurs
+			# adresses en une seule fois.
+			for paquet in par_paquets(psup_jsons, self.TAILLE_PAQUET):
+				adresses = self.formate_adresses(paquet)
+				for psup_json, adresse in zip(paquet, adresses):
+					yield self.parse_parcoursup_admission(psup_json,
+							adresse=adresse)
+
 	def get_candidat(self, code_candidat):
 		"""
 		Recherche des informations sur un candidat admis d'après son
 		numéro de dossier.
 		"""
-		return self.get_candidats_admis(self, code_candidat=code_candidat)
+		return self.get_candidats_admis(code_candidat=code_candidat)
 
 	@staticmethod
 	def formate_adresse(donnees):
 		CODE_PAYS_FRANCE = '99100'
 		code_pays = donnees.get('codepaysadresse', CODE_PAYS_FRANCE)
 		if code_pays == CODE_PAYS_FRANCE:
-			try:
-				libelle_ville = Commune.objects.get(pk=donnees.get('codecommune')).libelle
-			except Commune.DoesNotExist:
+			libelle_ville = Commune.objects.libelle(donnees.get('codecommune'))
+			if libelle_ville is None:
 				libelle_ville = '**** COMMUNE INCONNUE ****'
 				print("Commune {} inconnue".format(donnees.get('codecommune')))
 			libelle_pays = ''
@@ -211,12 +277,33 @@ class ParcoursupRest:
 			pays=libelle_pays)
 		return re.sub(r'\n+', '\n', raw_adresse).strip()
 
-	def parse_parcoursup_admission(self, psup_json):
+	@staticmethod
+	def formate_adresses(liste_donnees):
+		"""
+		Formate les adresses d'une liste de candidats, comme
+		formate_adresse(). Les libellés de toutes les communes
+		nécessaires sont recherchés en une seule fois.
+		"""
+		liste_donnees = [requests.utils.CaseInsensitiveDict(data=donnees)
+				for donnees in liste_donnees]
+		Commune.objects.libelles(donnees.get('codecommune')
+				for donnees in liste_donnees)
+		return [ParcoursupRest.formate_adresse(donnees)
+				for donnees in liste_donnees]
+
+	def parse_parcoursup_admission(self, psup_json, adresse=None):
 		"""
 		Prend en paramètre le JSON envoyé par l'interface synchrone de
 		Parcoursup et renvoie les informations structurées avec les
 		classes ParcoursupCandidat, ParcoursupResponsableLegal et
 		ParcoursupProposition.
+
+		L'adresse du candidat peut être donnée si elle a déjà été
+		formatée, par exemple par formate_adresses().
+
+		Le résultat contient également une empreinte des données JSON,
+		qui permet de savoir si elles ont changé depuis la précédente
+		synchronisation.
 		"""
 		donnees = requests.utils.CaseInsensitiveDict(data=psup_json)
 		candidat = ParcoursupCandidat(
@@ -226,7 +313,8 @@ class ParcoursupRest:
 			date_naissance=parse_french_date(donnees['dateNaissance']),
 			code=donnees['codeCandidat'],
 			ine=donnees['ine'],
-			adresse=self.formate_adresse(donnees),
+			adresse=adresse if adresse is not None
+				else self.formate_adresse(donnees),
 			telephone_fixe = donnees['telfixe'],
 			telephone_mobile = donnees['telmobile'],
 			sexe=ParcoursupCandidat.SEXE_HOMME if donnees['sexe'] == 'M'
@@ -257,6 +345,7 @@ class ParcoursupRest:
 			'candidat': candidat,
 			'proposition': proposition,
 			'responsables': responsables,
+			'empreinte': empreinte_json(psup_json),
 		}
 
 
@@ -280,12 +369,46 @@ class ParcoursupRest:
 			'etatInscription': int(etat_inscription),
 			'codeEtablissementAffectation': str(self.code_etablissement),
 		})
-		request = ParcoursupRequest(self.login, self.password,
-				method_name='majInscriptionAdministrative',
-				data=request_data)
+		request = self.requete('majInscriptionAdministrative',
+				request_data)
 		request.send()
 		return request
 
+	def maj_inscriptions(self, inscriptions, parallelisme=None):
+		"""
+		Mise à jour de l'état d'inscription de plusieurs candidats.
+
+		Le paramètre inscriptions est une liste de triplets (candidat,
+		formation, etat_inscription), qui correspondent aux paramètres
+		de maj_inscription(). Les requêtes sont envoyées en parallèle,
+		avec au plus parallelisme requêtes simultanées (par défaut, la
+		taille du pool de connexions de la session HTTP).
+
+		Renvoie, dans l'ordre des inscriptions, la liste des
+		ResultatInscription obtenus. Une erreur sur l'un des candidats
+		n'empêche pas le traitement des autres.
+		"""
+		if parallelisme is None:
+			parallelisme = getattr(settings, 'PARCOURSUP_REST_POOL', 10)
+
+		def envoi(inscription):
+			candidat, formation, etat_inscription = inscription
+			try:
+				request = self.maj_inscription(candidat, formation,
+						etat_inscription)
+				reponse = request.request.json()
+				if not isinstance(reponse, dict):
+					raise ValueError("Réponse inattendue de Parcoursup : "
+							"{!r}".format(reponse))
+				return ResultatInscription(candidat,
+						reponse.get('retour') == 'OK',
+						reponse.get('message', ''))
+			except (requests.RequestException, ValueError) as e:
+				return ResultatInscription(candidat, False, str(e))
+
+		with ThreadPoolExecutor(max_workers=parallelisme) as executor:
+			return list(executor.map(envoi, inscriptions))
+
 	def requete_test(self):
 		"""
 		Envoie la requête test prévue par Parcoursup. Cette requête doit
@@ -301,87 +424,77 @@ class ParcoursupRest:
 			statut_inscription=INSCRIPTION_PRINCIPALE)
 
 
+def confirme_inscriptions(etudiants, parallelisme=None):
+	"""
+	Confirme auprès de Parcoursup l'inscription principale des étudiants
+	du queryset donné en paramètre, puis marque comme réalisées, en une
+	seule requête, les inscriptions acceptées par Parcoursup.
+
+	Les étudiants sans proposition actuelle sont ignorés. Renvoie la
+	liste des ResultatInscription.
+	"""
+	etudiants = list(etudiants.filter(proposition_actuelle__isnull=False
+		).select_related('proposition_actuelle__classe'))
+
+	psup = ParcoursupRest()
+	resultats = psup.maj_inscriptions([
+		(ParcoursupCandidat.depuis_etudiant(etudiant),
+			etudiant.proposition_actuelle.classe.code_parcoursup,
+			ParcoursupRest.INSCRIPTION_PRINCIPALE)
+		for etudiant in etudiants], parallelisme=parallelisme)
+
+	inscrits = [etudiant.proposition_actuelle
+		for etudiant, resultat in zip(etudiants, resultats)
+		if resultat.succes]
+	compteurs_avant = Classe.objects.compteurs(inscrits)
+	for proposition in inscrits:
+		proposition.inscription = True
+	Proposition.objects.filter(pk__in=[proposition.pk
+		for proposition in inscrits]).update(inscription=True)
+	Classe.objects.ajuste_compteurs(compteurs_avant,
+		Classe.objects.compteurs(inscrits))
+	VersionDonnees.incremente()
+
+	return resultats
+
 def unsafe_auto_import_rest():
+	# Import local, car le module synchro dépend lui-même de celui-ci.
+	from parcoursup.synchro import SynchroLot
+
 	psup = ParcoursupRest(
 		login=settings.PARCOURSUP_REST_LOGIN,
 		password=settings.PARCOURSUP_REST_PASSWORD,
 		code_etablissement=settings.PARCOURSUP_UAI_ETABLISSEMENT,
 	)
-	req = psup.get_candidats_admis()
-	candidats = []
-	for psup_json in req.request.json():
-		candidats.append(psup.parse_parcoursup_admission(psup_json))
-
-	# Liste des codes Parcoursup des candidats admis
-	codes_admis = []
-
-	# Enregistrement des propositions en base de données
-	for candidat in candidats:
-		psup_etudiant = candidat['candidat']
-		psup_prop = candidat['proposition']
-
-		try:
-			etudiant = Etudiant.objects.get(pk=psup_etudiant.code)
-		except Etudiant.DoesNotExist:
-			# On ignore les démissions
-			if psup_prop.etat == ParcoursupProposition.ETAT_REFUSEE:
-				continue
-
-			# On importe l'étudiant qui n'existait pas encore
-			etudiant = Etudiant(dossier_parcoursup=psup_etudiant.code)
-
-		# On enregistre les coordonnées de l'étudiant, elles peuvent
-		# avoir été mises à jour par rapport à ce qui était dans la base
-		# de données.
-		etudiant.nom = psup_etudiant.nom
-		etudiant.prenom = psup_etudiant.prenom
-		etudiant.email = psup_etudiant.email
-		etudiant.adresse = psup_etudiant.adresse
-		etudiant.telephone = psup_etudiant.telephone_fixe or ''
-		etudiant.telephone_mobile = psup_etudiant.telephone_mobile or ''
-		etudiant.sexe = psup_etudiant.sexe
-		etudiant.date_naissance = psup_etudiant.date_naissance
-		etudiant.ine = psup_etudiant.ine
-		etudiant.save()
-
-		# On enregistre la proposition faite à cet étudiant
-		if psup_prop.etat != ParcoursupProposition.ETAT_REFUSEE:
-			try:
-				if psup_prop.etat == ParcoursupProposition.ETAT_ACCEPTEE:
-					etat_prop = Proposition.ETAT_OUI
-				elif psup_prop.etat == ParcoursupProposition.ETAT_ACCEPTEE_AUTRES_VOEUX:
-					etat_prop = Proposition.ETAT_OUIMAIS
-				else:
-					continue
-
-				proposition = Proposition(
-					classe=Classe.objects.get(
-						code_parcoursup=psup_prop.code_formation),
-					etudiant=etudiant,
-					date_proposition=psup_prop.date,
-					internat=psup_prop.internat,
-					cesure=psup_prop.cesure,
-					etat=etat_prop)
-				etudiant.nouvelle_proposition(proposition)
-				codes_admis.append(etudiant.dossier_parcoursup)
-			except Classe.DoesNotExist:
-				pass
-		else:
-			etudiant.demission(psup_prop.date)
-
-	# Les étudiants qui ne sont plus présents dans la liste des
-	# candidats admis sont considérés comme démissionnaires.
-	for etudiant in Etudiant.objects.exclude(
-		dossier_parcoursup__in=codes_admis):
-		etudiant.demission(timezone.now())
+	with transaction.atomic():
+		# Enregistrement des propositions en base de données, par lots,
+		# au fur et à mesure de leur lecture dans la réponse de
+		# Parcoursup.
+		synchro = SynchroLot()
+		for lot in par_paquets(psup.iter_candidats_admis(),
+				SynchroLot.TAILLE_LOT):
+			synchro.enregistre(lot)
+
+		# Les étudiants qui ne sont plus présents dans la liste des
+		# candidats admis sont considérés comme démissionnaires.
+		Etudiant.objects.demission_lot(Etudiant.objects.exclude(
+			dossier_parcoursup__in=synchro.codes_admis), timezone.now())
+
+	return synchro
 
 def auto_import_rest(mode=ParcoursupSynchro.MODE_MANUEL):
 	# Sauvegarde de l'heure de début, pour l'historique
 	date_debut = timezone.now()
+	bilan = {}
 
 	try:
-	    unsafe_auto_import_rest()
+	    synchro = unsafe_auto_import_rest()
 	    resultat = ParcoursupSynchro.RESULTAT_OK
+	    bilan = {
+	        'nb_nouveaux': synchro.nb_nouveaux,
+	        'nb_modifies': synchro.nb_modifies,
+	        'nb_inchanges': synchro.nb_inchanges,
+	    }
 	except:
 	    resultat = ParcoursupSynchro.RESULTAT_ERREUR
 
@@ -389,4 +502,4 @@ def auto_import_rest(mode=ParcoursupSynchro.MODE_MANUEL):
 
 	ParcoursupSynchro(date_debut=date_debut, date_fin=date_fin,
 	        mode=mode, resultat=resultat,
-			source=ParcoursupSynchro.SOURCE_REST).save()
+			source=ParcoursupSynchro.SOURCE_REST, **bilan).save()
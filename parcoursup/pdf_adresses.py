@@ -18,30 +18,71 @@
 
 from __future__ import unicode_literals
 
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import io
+import logging
+import re
+
 from reportlab.lib.pagesizes import A4
 from reportlab.lib.units import cm
 from reportlab.pdfgen import canvas
 
-def pdf_adresses(etudiants, fileout):
-	c = canvas.Canvas(fileout)
+logger = logging.getLogger(__name__)
+
+# Disposition des planches d'étiquettes
+NB_LIGNES = 7
+NB_COLONNES = 2
+
+def pdf_adresses(etudiants, fileout, progression=None, processus=1):
+	"""
+	Écrit dans fileout une page par étudiant, avec son adresse placée à
+	l'emplacement de la fenêtre des enveloppes.
+
+	Si progression est donnée, elle est appelée au fur et à mesure avec
+	le nombre d'étudiants déjà traités et le nombre total.
+
+	Si processus est supérieur à 1 (expérimental), les pages sont
+	produites par autant de processus en parallèle, puis assemblées en
+	un seul document (voir _concatene). Si le document assemblé n'a pas
+	la structure attendue, il est abandonné et les pages sont de nouveau
+	produites dans un seul processus.
+	"""
+	_pdf(_lettres, 1, etudiants, fileout, progression, processus)
+
+def pdf_etiquettes_adresses(etudiants, fileout, progression=None,
+		processus=1):
+	"""
+	Écrit dans fileout les adresses des étudiants sur des planches
+	d'étiquettes. Les paramètres progression et processus ont le même
+	rôle que pour pdf_adresses. En parallèle, chaque processus reçoit
+	un nombre entier de planches.
+	"""
+	_pdf(_etiquettes, NB_LIGNES * NB_COLONNES, etudiants, fileout,
+			progression, processus)
+
+def _destinataire(etudiant):
+	"""
+	Texte à imprimer pour un étudiant : son nom précédé de sa civilité,
+	et son adresse. Les processus de rendu ne reçoivent que ces textes.
+	"""
+	return (etudiant.civilite() + " " + str(etudiant), str(etudiant.adresse))
+
+def _lettres(c, destinataires, progression=None):
 	pos_left = 11.5 * cm
 	pos_bottom = 25.3 * cm
 	interligne = 0.6 * cm
-	for etudiant in etudiants:
-		c.drawString(pos_left, pos_bottom, etudiant.civilite() + " " + str(etudiant))
+	for fait, (nom, adresse) in enumerate(destinataires, 1):
+		c.drawString(pos_left, pos_bottom, nom)
 		bot_actuel = pos_bottom - interligne
-		lignes_adresse = str(etudiant.adresse).split("\n")
+		lignes_adresse = adresse.split("\n")
 		for ligne in lignes_adresse:
 			c.drawString(pos_left, bot_actuel, ligne.strip())
 			bot_actuel -= interligne
 		c.showPage()
-	c.save()
-
-def pdf_etiquettes_adresses(etudiants, fileout):
-	NB_LIGNES = 7
-	NB_COLONNES = 2
+		if progression:
+			progression(fait, len(destinataires))
 
-	c = canvas.Canvas(fileout)
+def _etiquettes(c, destinataires, progression=None):
 	# Marge du bas diminuée pour décaler un peu les étiquettes vers
 	# le bas.
 	margin_bottom = 1.61 * cm - 0.4 * cm
@@ -53,7 +94,7 @@ def pdf_etiquettes_adresses(etudiants, fileout):
 	etiq_height = 3.81 * cm
 	interligne = 0.6 * cm
 
-	for pos_etudiant, etudiant in enumerate(etudiants):
+	for pos_etudiant, (nom, adresse) in enumerate(destinataires):
 		pos_page = pos_etudiant % (NB_LIGNES * NB_COLONNES)
 
 		if pos_etudiant > 0 and pos_page == 0:
@@ -65,10 +106,183 @@ def pdf_etiquettes_adresses(etudiants, fileout):
 		pos_bottom = margin_bottom + (NB_LIGNES - pos_page //
 				NB_COLONNES) * etiq_height - interligne
 
-		c.drawString(pos_left, pos_bottom, etudiant.civilite() + " " + str(etudiant))
+		c.drawString(pos_left, pos_bottom, nom)
 		bot_actuel = pos_bottom - interligne
-		lignes_adresse = str(etudiant.adresse).split("\n")
+		lignes_adresse = adresse.split("\n")
 		for ligne in lignes_adresse:
 			c.drawString(pos_left, bot_actuel, ligne.strip())
 			bot_actuel -= interligne
+
+		if progression:
+			progression(pos_etudiant + 1, len(destinataires))
+
+def _rend(dessine, destinataires):
+	"""
+	Rendu d'une partie des pages dans un processus séparé. Renvoie le
+	contenu du fichier PDF produit.
+	"""
+	tampon = io.BytesIO()
+	c = canvas.Canvas(tampon)
+	dessine(c, destinataires)
 	c.save()
+	return tampon.getvalue()
+
+def _pdf(dessine, alignement, etudiants, fileout, progression, processus):
+	destinataires = [_destinataire(etudiant) for etudiant in etudiants]
+
+	# Chaque processus reçoit plusieurs morceaux successifs, pour que
+	# l'avancement puisse être suivi. La taille des morceaux est un
+	# multiple du nombre d'étudiants par page.
+	nb_morceaux = 4 * processus
+	taille = -(-len(destinataires) // nb_morceaux)
+	taille = max(alignement, -(-taille // alignement) * alignement)
+
+	if processus <= 1 or len(destinataires) <= taille:
+		c = canvas.Canvas(fileout)
+		dessine(c, destinataires, progression)
+		c.save()
+		return
+
+	morceaux = [destinataires[debut:debut + taille]
+			for debut in range(0, len(destinataires), taille)]
+	with ProcessPoolExecutor(max_workers=processus) as executeur:
+		rendus = [executeur.submit(_rend, dessine, morceau)
+				for morceau in morceaux]
+		tailles = {rendu: len(morceau)
+				for rendu, morceau in zip(rendus, morceaux)}
+		fait = 0
+		for rendu in as_completed(rendus):
+			rendu.result()
+			fait += tailles[rendu]
+			if progression:
+				progression(fait, len(destinataires))
+
+	documents = [rendu.result() for rendu in rendus]
+	tampon = io.BytesIO()
+	try:
+		_concatene(documents, tampon)
+		nb_pages = _verifie(tampon.getvalue())
+		attendu = sum(_verifie(document) for document in documents)
+		if nb_pages != attendu:
+			raise ValueError("{} pages au lieu de {}".format(nb_pages,
+				attendu))
+	except (AttributeError, IndexError, KeyError, TypeError,
+			ValueError) as e:
+		# _concatene suppose la structure des documents de reportlab.
+		logger.warning("Assemblage du PDF impossible (%s) : rendu dans "
+				"un seul processus", e)
+		c = canvas.Canvas(fileout)
+		dessine(c, destinataires)
+		c.save()
+	else:
+		fileout.write(tampon.getvalue())
+
+_REFERENCE = re.compile(rb'(\d+) 0 (obj|R)\b')
+
+def _concatene(documents, fileout):
+	"""
+	Écrit dans fileout un PDF formé des pages des documents donnés, tels
+	que reportlab les produit (avec une table xref classique).
+
+	Les documents ne sont pas analysés en entier : chaque objet est
+	recopié tel quel, seuls les numéros d'objets de son dictionnaire
+	sont décalés. L'arbre des pages de chaque document devient un nœud
+	de l'arbre des pages du document final. Les catalogues des
+	documents sont recopiés eux aussi, mais ne servent plus.
+	"""
+	objets = []
+	noeuds = []
+	for document in documents:
+		debut_xref = int(document[document.rindex(b'startxref'):].split()[1])
+		xref = document[debut_xref:].split(b'\n')
+		nb_objets = int(xref[1].split()[1])
+		# L'entrée 0 de la table est toujours libre
+		positions = [int(entree[:10]) for entree in xref[3:2 + nb_objets]]
+		if not objets:
+			entete = document[:min(positions)]
+			info = int(re.search(rb'/Info (\d+) 0 R',
+				document[debut_xref:]).group(1))
+
+		# Chaque objet s'étend jusqu'au début du suivant, ou de la table
+		bornes = sorted(positions) + [debut_xref]
+		fins = dict(zip(bornes, bornes[1:]))
+
+		decalage = len(objets)
+		def renumerote(m):
+			return b'%d 0 %s' % (int(m.group(1)) + decalage, m.group(2))
+		for position in positions:
+			objet = document[position:fins[position]]
+			dictionnaire, debut_flux, flux = objet.partition(b'stream\n')
+			objets.append(_REFERENCE.sub(renumerote, dictionnaire) +
+					debut_flux + flux)
+
+		racine = int(re.search(rb'/Root (\d+) 0 R',
+			document[debut_xref:]).group(1))
+		catalogue = objets[decalage + racine - 1]
+		noeuds.append(int(re.search(rb'/Pages (\d+) 0 R',
+			catalogue).group(1)))
+
+	pages = len(objets) + 1
+	nb_pages = 0
+	for noeud in noeuds:
+		objet = objets[noeud - 1]
+		nb_pages += int(re.search(rb'/Count (\d+)', objet).group(1))
+		objets[noeud - 1] = objet.replace(b'<<',
+				b'<<\n/Parent %d 0 R' % pages, 1)
+	objets.append(b'%d 0 obj\n<<\n/Count %d /Kids [ %s ] /Type /Pages\n>>\n'
+			b'endobj\n' % (pages, nb_pages,
+				b' '.join(b'%d 0 R' % noeud for noeud in noeuds)))
+	objets.append(b'%d 0 obj\n<<\n/PageMode /UseNone /Pages %d 0 R '
+			b'/Type /Catalog\n>>\nendobj\n' % (pages + 1, pages))
+
+	positions = []
+	position = len(entete)
+	for objet in objets:
+		positions.append(position)
+		position += len(objet)
+
+	fileout.write(entete)
+	for objet in objets:
+		fileout.write(objet)
+	fileout.write(b'xref\n0 %d\n0000000000 65535 f \n' % (len(objets) + 1))
+	fileout.write(b''.join(b'%010d 00000 n \n' % position
+		for position in positions))
+	fileout.write(b'trailer\n<<\n/Info %d 0 R\n/Root %d 0 R\n/Size %d\n>>\n'
+			b'startxref\n%d\n%%%%EOF\n' % (info, pages + 1,
+				len(objets) + 1, position))
+
+def _verifie(document):
+	"""
+	Vérifie la structure d'un PDF produit par reportlab ou par
+	_concatene : la table xref doit se trouver à la position donnée par
+	startxref, et chacune de ses entrées désigner le début de l'objet
+	correspondant. Renvoie le nombre de pages indiqué par l'arbre des
+	pages. Lève ValueError si le document n'a pas la structure attendue.
+	"""
+	try:
+		debut_xref = int(document[document.rindex(b'startxref'):].split()[1])
+		xref = document[debut_xref:].split(b'\n')
+		if xref[0] != b'xref':
+			raise ValueError("table xref introuvable")
+		nb_objets = int(xref[1].split()[1])
+		positions = [int(entree[:10]) for entree in xref[3:2 + nb_objets]]
+		if len(positions) != nb_objets - 1:
+			raise ValueError("table xref incomplète")
+		for numero, position in enumerate(positions, 1):
+			if not document.startswith(b'%d 0 obj' % numero, position):
+				raise ValueError("position de l'objet {} incorrecte".format(
+					numero))
+
+		def objet(numero):
+			position = positions[numero - 1]
+			return document[position:document.index(b'endobj', position)]
+
+		racine = int(re.search(rb'/Root (\d+) 0 R',
+			document[debut_xref:]).group(1))
+		pages = int(re.search(rb'/Pages (\d+) 0 R',
+			objet(racine)).group(1))
+		return int(re.search(rb'/Count (\d+)', objet(pages)).group(1))
+	except (AttributeError, IndexError) as e:
+		# Expression introuvable (re.search renvoie None) ou numéro
+		# d'objet hors de la table
+		raise ValueError("structure inattendue") from e
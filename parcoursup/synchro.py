@@ -0,0 +1,393 @@
+# -*- coding: utf-8 -*-
+
+# Inscrisup - Gestion des inscriptions administratives après Parcoursup
+# Copyright (c) 2019 Florian Hatat
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Enregistrement par lots des admissions transmises par Parcoursup
+"""
+
+import itertools
+
+from django.db import connection, transaction
+
+from parcoursup.models import Action, Classe, Etudiant, Proposition, \
+		VersionDonnees
+from parcoursup.parcoursup_rest import ParcoursupProposition
+
+class SynchroLot:
+	"""
+	Enregistre en base de données, par lots, les admissions renvoyées
+	par la méthode getCandidatsAdmis de l'API REST de Parcoursup.
+
+	Au lieu de traiter chaque candidat avec ses propres requêtes, on
+	précharge en quelques requêtes les étudiants, propositions et
+	actions concernés par un lot de candidats, on calcule en mémoire
+	les modifications à apporter, puis on les écrit avec bulk_create
+	et bulk_update.
+
+	Les candidats dont les données JSON n'ont pas changé depuis la
+	synchronisation précédente (même empreinte) ne sont pas traités.
+
+	Le résultat doit rester identique à celui qu'on obtiendrait en
+	appelant Etudiant.nouvelle_proposition et Etudiant.demission pour
+	chaque candidat : toute évolution de ces méthodes doit être
+	reportée ici.
+	"""
+	# Nombre de candidats traités à chaque appel de la méthode
+	# enregistre().
+	TAILLE_LOT = 500
+
+	# Champs des étudiants mis à jour par la synchronisation
+	CHAMPS_ETUDIANT = ['nom', 'prenom', 'email', 'adresse', 'telephone',
+			'telephone_mobile', 'sexe', 'date_naissance', 'ine',
+			'empreinte_parcoursup', 'proposition_actuelle']
+
+	# Correspondance entre les états Parcoursup et ceux des propositions
+	# enregistrées dans la base de données.
+	ETATS = {
+		ParcoursupProposition.ETAT_ACCEPTEE: Proposition.ETAT_OUI,
+		ParcoursupProposition.ETAT_ACCEPTEE_AUTRES_VOEUX: Proposition.ETAT_OUIMAIS,
+	}
+
+	def __init__(self):
+		self.classes = {classe.code_parcoursup: classe
+				for classe in Classe.objects.all()}
+
+		# Numéros de dossier des candidats qui ont accepté une
+		# proposition, tous lots confondus.
+		self.codes_admis = set()
+
+		# Bilan de la synchronisation
+		self.nb_nouveaux = 0
+		self.nb_modifies = 0
+		self.nb_inchanges = 0
+
+	def _reinitialise(self):
+		"""
+		Vide la liste des modifications à écrire pour le lot en cours.
+		"""
+		self.etudiants_crees = []
+		self.propositions_creees = []
+		self.propositions_prechargees = []
+		self.actions_creees = []
+		self.rattachements = []
+		self.modifies = {
+			Etudiant: {},
+			Proposition: {},
+			Action: {},
+		}
+
+	def _modifie(self, objet):
+		"""
+		Note qu'un objet déjà présent dans la base de données doit être
+		mis à jour. Les objets créés pendant le lot seront de toute
+		façon écrits en entier.
+		"""
+		if not objet._state.adding:
+			self.modifies[type(objet)][objet.pk] = objet
+
+	def _rattache(self, objet, champ, proposition):
+		"""
+		Rattache un objet à une proposition. Si cette proposition n'est
+		pas encore enregistrée, la clé étrangère reste vide jusqu'à sa
+		création : bulk_create refuse (depuis Django 3.2) les objets
+		liés à un objet qui n'a pas encore de clé primaire.
+		"""
+		if proposition is not None and proposition.pk is None:
+			setattr(objet, champ, None)
+			self.rattachements.append((objet, champ, proposition))
+		else:
+			setattr(objet, champ, proposition)
+
+	def _cree_action(self, actions, proposition, **kwargs):
+		action = Action(**kwargs)
+		self._rattache(action, 'proposition', proposition)
+		self.actions_creees.append(action)
+		actions.append(action)
+
+	def _annule(self, action, date):
+		"""Équivalent de Action.annuler()"""
+		if action.etat == Action.ETAT_TODO:
+			action.date_fait = date
+			action.etat = Action.ETAT_ANNULEE
+			self._modifie(action)
+
+	def _inchange(self, etudiant, admission):
+		"""
+		Indique si l'on peut se dispenser de traiter un candidat déjà
+		connu : ses données Parcoursup n'ont pas changé depuis la
+		dernière synchronisation et, s'il avait accepté une
+		proposition, elle est toujours enregistrée comme actuelle (elle
+		a pu être retirée entre-temps, par exemple par une démission
+		saisie à la main).
+		"""
+		if etudiant.empreinte_parcoursup != admission['empreinte']:
+			return False
+		return admission['proposition'].etat not in self.ETATS or \
+				etudiant.proposition_actuelle is not None
+
+	def _maj_coordonnees(self, etudiant, psup_etudiant):
+		"""
+		Recopie les coordonnées transmises par Parcoursup dans l'objet
+		Etudiant, en ne notant comme modifiés que les étudiants dont
+		les coordonnées ont effectivement changé.
+		"""
+		coordonnees = {
+			'nom': psup_etudiant.nom,
+			'prenom': psup_etudiant.prenom,
+			'email': psup_etudiant.email,
+			'adresse': psup_etudiant.adresse,
+			'telephone': psup_etudiant.telephone_fixe or '',
+			'telephone_mobile': psup_etudiant.telephone_mobile or '',
+			'sexe': psup_etudiant.sexe,
+			'date_naissance': psup_etudiant.date_naissance,
+			'ine': psup_etudiant.ine,
+		}
+		for champ, valeur in coordonnees.items():
+			if getattr(etudiant, champ) != valeur:
+				setattr(etudiant, champ, valeur)
+				self._modifie(etudiant)
+
+	def _nouvelle_proposition(self, etudiant, nouv_prop, actions):
+		"""
+		Équivalent en mémoire de Etudiant.nouvelle_proposition().
+
+		Le paramètre actions contient les actions à traiter ou déjà
+		faites de l'étudiant. Les actions créées y sont ajoutées.
+		"""
+		old_prop = etudiant.proposition_actuelle
+		date = nouv_prop.date_proposition
+
+		# On annule les démissions précédentes.
+		for action in actions:
+			if action.categorie == Action.DEMISSION:
+				self._annule(action, date)
+
+		# Seul l'état de la proposition a changé
+		if old_prop and old_prop.classe_id == nouv_prop.classe.pk and \
+				old_prop.internat == nouv_prop.internat:
+			if old_prop.etat != nouv_prop.etat:
+				old_prop.etat = nouv_prop.etat
+				self._modifie(old_prop)
+			return
+
+		nouv_prop.remplace = old_prop
+		self.propositions_creees.append(nouv_prop)
+
+		self._rattache(etudiant, 'proposition_actuelle', nouv_prop)
+		self._modifie(etudiant)
+
+		# On envoie le dossier d'inscription s'il n'a pas encore été
+		# envoyé.
+		if not any(action.categorie == Action.ENVOI_DOSSIER and
+				action.etat in (Action.ETAT_TODO, Action.ETAT_FAIT)
+				for action in actions):
+			self._cree_action(actions, categorie=Action.ENVOI_DOSSIER,
+					etudiant=etudiant, date=date, proposition=nouv_prop)
+
+		if not old_prop:
+			return
+
+		old_prop.date_demission = date
+		self._modifie(old_prop)
+
+		# On rattache toutes les actions d'envoi pas encore traitées à
+		# la proposition actuelle.
+		for action in actions:
+			if action.etat == Action.ETAT_TODO and action.est_envoi() \
+					and not action._state.adding:
+				self._rattache(action, 'proposition', nouv_prop)
+				self._modifie(action)
+
+		# Envoi du dossier complémentaire d'internat
+		if not old_prop.internat and nouv_prop.internat and \
+				not any(action.categorie == Action.ENVOI_DOSSIER and
+					action.etat == Action.ETAT_TODO for action in actions):
+			self._cree_action(actions, proposition=nouv_prop,
+					etudiant=etudiant,
+					categorie=Action.ENVOI_DOSSIER_INTERNAT,
+					date=date)
+
+		# Renoncement à l'internat
+		if old_prop.internat and not nouv_prop.internat:
+			for action in actions:
+				if action.categorie == Action.ENVOI_DOSSIER_INTERNAT:
+					self._annule(action, date)
+
+			self._cree_action(actions, proposition=nouv_prop,
+					etudiant=etudiant,
+					categorie=Action.INSCRIPTION,
+					date=date,
+					message="L'étudiant a renoncé à l'internat")
+
+		# Changement de classe
+		if old_prop.classe_id != nouv_prop.classe.pk:
+			self._cree_action(actions, proposition=nouv_prop,
+					etudiant=etudiant,
+					categorie=Action.INSCRIPTION,
+					date=date,
+					message="L'étudiant a changé de classe")
+
+	def _demission(self, etudiant, date, actions):
+		"""
+		Équivalent en mémoire de Etudiant.demission().
+		"""
+		proposition = etudiant.proposition_actuelle
+		if proposition is None:
+			return
+
+		deja_demission = proposition.date_demission is not None
+		proposition.date_demission = date
+		self._modifie(proposition)
+
+		for action in actions:
+			if action.proposition_id == proposition.pk and \
+					action.categorie != Action.DEMISSION:
+				self._annule(action, date)
+
+		if not deja_demission:
+			self._cree_action(actions, proposition=proposition,
+					categorie=Action.DEMISSION,
+					etudiant=etudiant,
+					date=date)
+
+		etudiant.proposition_actuelle = None
+		self._modifie(etudiant)
+
+	def enregistre(self, admissions):
+		"""
+		Enregistre un lot d'admissions, telles que renvoyées par la
+		méthode ParcoursupRest.parse_parcoursup_admission().
+		"""
+		self._reinitialise()
+
+		par_code = {}
+		for admission in admissions:
+			par_code[int(admission['candidat'].code)] = admission
+
+		# Préchargement des données existantes
+		etudiants = Etudiant.objects.select_related(
+				'proposition_actuelle').in_bulk(list(par_code))
+		actions_etudiants = {}
+		for action in Action.objects.filter(etudiant__in=list(par_code),
+				etat__in=(Action.ETAT_TODO, Action.ETAT_FAIT)):
+			actions_etudiants.setdefault(action.etudiant_id, []).append(action)
+
+		# Seules les propositions actuelles des étudiants du lot peuvent
+		# être modifiées : on note leur contribution aux compteurs des
+		# classes avant toute modification.
+		self.propositions_prechargees = [etudiant.proposition_actuelle
+			for etudiant in etudiants.values()
+			if etudiant.proposition_actuelle is not None]
+		self.compteurs_avant = Classe.objects.compteurs(
+				self.propositions_prechargees)
+
+		for code, admission in par_code.items():
+			psup_etudiant = admission['candidat']
+			psup_prop = admission['proposition']
+			actions = actions_etudiants.setdefault(code, [])
+
+			try:
+				etudiant = etudiants[code]
+			except KeyError:
+				# On ignore les démissions
+				if psup_prop.etat == ParcoursupProposition.ETAT_REFUSEE:
+					continue
+
+				# On importe l'étudiant qui n'existait pas encore
+				etudiant = Etudiant(dossier_parcoursup=code)
+				self.etudiants_crees.append(etudiant)
+				self.nb_nouveaux += 1
+			else:
+				if self._inchange(etudiant, admission):
+					self.nb_inchanges += 1
+					if psup_prop.etat in self.ETATS:
+						self.codes_admis.add(code)
+					continue
+				self.nb_modifies += 1
+
+			# On enregistre les coordonnées de l'étudiant, elles
+			# peuvent avoir été mises à jour par rapport à ce qui était
+			# dans la base de données.
+			self._maj_coordonnees(etudiant, psup_etudiant)
+			etudiant.empreinte_parcoursup = admission['empreinte']
+			self._modifie(etudiant)
+
+			if psup_prop.etat == ParcoursupProposition.ETAT_REFUSEE:
+				self._demission(etudiant, psup_prop.date, actions)
+				continue
+
+			etat_prop = self.ETATS.get(psup_prop.etat)
+			classe = self.classes.get(psup_prop.code_formation)
+			if etat_prop is None or classe is None:
+				continue
+
+			proposition = Proposition(
+				classe=classe,
+				etudiant=etudiant,
+				date_proposition=psup_prop.date,
+				internat=psup_prop.internat,
+				cesure=psup_prop.cesure,
+				etat=etat_prop)
+			self._nouvelle_proposition(etudiant, proposition, actions)
+			self.codes_admis.add(code)
+
+		self._ecrit()
+
+	@transaction.atomic
+	def _ecrit(self):
+		"""
+		Écriture dans la base de données des modifications calculées
+		pour le lot en cours.
+		"""
+		Etudiant.objects.bulk_create(self.etudiants_crees,
+				batch_size=self.TAILLE_LOT)
+
+		# bulk_create ne renseigne la clé primaire des objets créés que
+		# sur PostgreSQL. Ailleurs, on enregistre les propositions une à
+		# une car on a besoin de leur clé primaire juste après.
+		if connection.vendor == 'postgresql':
+			Proposition.objects.bulk_create(self.propositions_creees,
+					batch_size=self.TAILLE_LOT)
+		else:
+			for proposition in self.propositions_creees:
+				proposition.save()
+
+		# Les propositions ont maintenant une clé primaire : on la
+		# recopie dans les objets qui leur ont été rattachés. Les
+		# étudiants, déjà créés, doivent alors être mis à jour.
+		for objet, champ, proposition in self.rattachements:
+			setattr(objet, champ, proposition)
+			if isinstance(objet, Etudiant):
+				self.modifies[Etudiant][objet.pk] = objet
+
+		Etudiant.objects.bulk_update(self.modifies[Etudiant].values(),
+				fields=self.CHAMPS_ETUDIANT,
+				batch_size=self.TAILLE_LOT)
+		Proposition.objects.bulk_update(self.modifies[Proposition].values(),
+				fields=['etat', 'date_demission'],
+				batch_size=self.TAILLE_LOT)
+		Action.objects.bulk_update(self.modifies[Action].values(),
+				fields=['etat', 'date_fait', 'proposition'],
+				batch_size=self.TAILLE_LOT)
+		Action.objects.bulk_create(self.actions_creees,
+				batch_size=self.TAILLE_LOT)
+
+		VersionDonnees.incremente()
+		Classe.objects.ajuste_compteurs(self.compteurs_avant,
+			Classe.objects.compteurs(itertools.chain(
+				self.propositions_prechargees, self.propositions_creees)))
@@ -18,6 +18,1932 @@
 
 from __future__ import unicode_literals
 
-from django.test import TestCase
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from datetime import date, datetime, timedelta
+import base64
+import gzip
+import io
+import json
+import locale
+import os
+import tempfile
+import threading
+import time
+from unittest import mock
+from urllib.parse import parse_qs, urlsplit
+from xml.etree import ElementTree
+import zipfile
 
-# Create your tests here.
+import bs4
+import requests
+try:
+	import pypdf
+except ImportError:
+	pypdf = None
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command, CommandError
+from django.db import connection, IntegrityError, transaction
+from django.db.models.query import QuerySet
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, \
+		override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from parcoursup import odf_liste, pdf_adresses as pdf_adresses_module
+from parcoursup.admission import TraitementAdmission, \
+		traite_file_admissions
+from parcoursup.cache_exports import CacheExports
+from parcoursup.client_http import SessionParcoursup
+from parcoursup.exports import demande_export, traite_file_exports
+from parcoursup.extraction_html import EXTRACTEURS, ExtracteurSoup
+from parcoursup.import_parcoursup import enregistre_coordonnees, \
+		Parcoursup
+from parcoursup.management.commands.archive_messages_recus import \
+		Command as ArchiveMessagesRecus
+from parcoursup.models import Action, Classe, Commune, Etudiant, \
+		ParcoursupMessageRecuLog, ParcoursupUser, Proposition, \
+		TacheExport, VersionDonnees
+from parcoursup.pdf_adresses import pdf_adresses, pdf_etiquettes_adresses
+from parcoursup.parcoursup_rest import confirme_inscriptions, \
+		ParcoursupRest, ParcoursupCandidat, ParcoursupProposition, \
+		ResultatInscription
+from parcoursup.synchro import SynchroLot
+from parcoursup.tools.bench_dates import ancienne_date_francaise, \
+		ancienne_date_numerique
+from parcoursup.tools.bench_pdf import EtudiantFictif
+from parcoursup.utils import iter_tableau_json, parse_date_francaise, \
+		parse_datetime, PARIS_TZ
+from parcoursup.views.parcoursup import AdmissionView
+
+PAGES_PARCOURSUP = os.path.join(os.path.dirname(__file__), 'fixtures',
+		'pages')
+
+def date_paris(*args):
+	return timezone.make_aware(datetime(*args))
+
+def admission_json(code, formation, situation, internat=False,
+		date_reponse='14/06/2019 10:30'):
+	"""
+	Données d'un candidat telles que renvoyées par getCandidatsAdmis
+	"""
+	return {
+		'codeCandidat': str(code), 'nom': 'NOM{}'.format(code),
+		'prenom': 'Prénom', 'mail': 'candidat{}@example.org'.format(code),
+		'dateNaissance': '14/07/2001', 'ine': '{:011d}'.format(code),
+		'telfixe': '', 'telmobile': '0600000000', 'sexe': 'F',
+		'codeFormationPsup': str(formation),
+		'codeEtablissementAffectation': '0740003B', 'cesure': '0',
+		'internat': '1' if internat else '0', 'dateReponse': date_reponse,
+		'codeSituation': str(situation), 'codecommune': '74010',
+		'adresse1': '{} rue du Lac'.format(code), 'codepostal': '74000',
+	}
+
+class FauxParcoursup(BaseHTTPRequestHandler):
+	"""
+	Serveur HTTP local qui imite l'API REST de Parcoursup. Les réponses
+	à renvoyer sont placées dans l'attribut reponses du serveur, sous
+	forme de couples (code HTTP, données JSON).
+	"""
+	protocol_version = 'HTTP/1.1'
+
+	def do_POST(self):
+		longueur = int(self.headers.get('Content-Length', 0))
+		self.server.requetes.append((self.path,
+			json.loads(self.rfile.read(longueur).decode('utf-8'))))
+		self.repond()
+
+	def do_GET(self):
+		self.server.requetes.append((self.path, None))
+		self.repond()
+
+	def repond(self):
+		code, donnees = self.server.reponses.pop(0)
+		corps = json.dumps(donnees).encode('utf-8')
+		self.send_response(code)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(corps)))
+		self.end_headers()
+		self.wfile.write(corps)
+
+	def log_message(self, *args):
+		pass
+
+class ParcoursupRestMixin:
+	"""
+	Démarre un faux serveur Parcoursup pour chaque test, et fournit un
+	objet ParcoursupRest qui s'y connecte.
+	"""
+	def setUp(self):
+		super().setUp()
+		self.serveur = ThreadingHTTPServer(('127.0.0.1', 0), FauxParcoursup)
+		self.serveur.requetes = []
+		self.serveur.reponses = []
+		threading.Thread(target=self.serveur.serve_forever,
+				daemon=True).start()
+
+		self.session = SessionParcoursup(taille_pool=2, timeout=5,
+				tentatives=2, backoff=0)
+		self.psup = ParcoursupRest(login='login', password='mdp',
+				code_etablissement='0740003B', session=self.session,
+				endpoint='http://127.0.0.1:{}/ApiRest/'.format(
+					self.serveur.server_address[1]))
+
+	def tearDown(self):
+		self.session.close()
+		self.serveur.shutdown()
+		self.serveur.server_close()
+		super().tearDown()
+
+	def candidat(self):
+		return ParcoursupCandidat(code=42, nom="Minet", prenom="Bernard",
+				date_naissance=date(2001, 7, 14), ine="0123456789A")
+
+class ClientHttpTest(ParcoursupRestMixin, SimpleTestCase):
+	def test_reutilisation_connexion(self):
+		self.serveur.reponses = [(200, {'retour': 'OK'})] * 3
+		for _ in range(3):
+			req = self.psup.maj_inscription(self.candidat(), 1234,
+					ParcoursupRest.INSCRIPTION_PRINCIPALE)
+			self.assertEqual(req.request.json()['retour'], 'OK')
+
+		self.assertEqual(self.session.statistiques(), {
+			'requetes': 3, 'connexions': 1, 'reutilisations': 2})
+		self.assertEqual(self.serveur.requetes[0][0],
+				'/ApiRest/majInscriptionAdministrative')
+		self.assertEqual(self.serveur.requetes[0][1]['identifiant'],
+				{'login': 'login', 'pwd': 'mdp'})
+
+	def test_post_non_renvoye(self):
+		"""
+		Une requête POST n'est pas renvoyée après une erreur du serveur
+		: elle a pu être traitée.
+		"""
+		self.serveur.reponses = [(503, {}), (200, {'retour': 'OK'})]
+		req = self.psup.maj_inscription(self.candidat(), 1234,
+				ParcoursupRest.INSCRIPTION_PRINCIPALE)
+		self.assertEqual(req.request.status_code, 503)
+		self.assertEqual(len(self.serveur.requetes), 1)
+
+	def test_nouvelle_tentative_get(self):
+		self.serveur.reponses = [(503, {}), (200, {'retour': 'OK'})]
+		reponse = self.session.get(self.psup.endpoint + 'test')
+		self.assertEqual(reponse.status_code, 200)
+		self.assertEqual(len(self.serveur.requetes), 2)
+
+	def test_abandon_apres_tentatives(self):
+		self.serveur.reponses = [(500, {})] * 3
+		reponse = self.session.get(self.psup.endpoint + 'test')
+		self.assertEqual(reponse.status_code, 500)
+		self.assertEqual(len(self.serveur.requetes), 3)
+
+	def test_nouvelle_tentative_connexion(self):
+		"""
+		Les requêtes POST sont retentées si la connexion a échoué, car
+		elles n'ont alors pas été envoyées.
+		"""
+		retry = self.session.adaptateur.max_retries
+		self.assertEqual(retry.connect, None)
+		self.assertEqual(retry.total, 2)
+		self.assertFalse(retry.is_retry('POST', 503))
+		self.assertTrue(retry.is_retry('GET', 503))
+
+	def test_maj_inscriptions_reponse_invalide(self):
+		"""
+		Une réponse JSON qui n'est pas un objet est une erreur pour ce
+		candidat seulement.
+		"""
+		self.serveur.reponses = [(200, ['OK']), (200, 'OK'),
+				(200, {'retour': 'OK'})]
+		resultats = self.psup.maj_inscriptions(
+				[(self.candidat(), 1234,
+					ParcoursupRest.INSCRIPTION_PRINCIPALE)] * 3,
+				parallelisme=1)
+		self.assertEqual([r.succes for r in resultats],
+				[False, False, True])
+		self.assertIn("Réponse inattendue", resultats[0].message)
+
+class CandidatsAdmisTest(ParcoursupRestMixin, TestCase):
+	def test_lecture_candidats_admis(self):
+		Commune.objects.create(insee='74010', libelle='Annecy')
+		self.serveur.reponses = [(200, [{
+			'codeCandidat': str(code), 'nom': 'NOM', 'prenom': 'Prénom',
+			'mail': 'candidat@example.org', 'dateNaissance': '14/07/2001',
+			'ine': '0123456789A', 'telfixe': '', 'telmobile': '0600000000',
+			'sexe': 'F', 'codeFormationPsup': '1234',
+			'codeEtablissementAffectation': '0740003B', 'cesure': '0',
+			'internat': '1', 'dateReponse': '14/06/2019 10:30',
+			'codeSituation': '1', 'codecommune': '74010',
+			'adresse1': '1 rue du Lac', 'codepostal': '74000',
+		} for code in range(1, 4)])]
+
+		admissions = list(self.psup.iter_candidats_admis())
+
+		self.assertEqual([a['candidat'].code for a in admissions],
+				['1', '2', '3'])
+		self.assertEqual(admissions[0]['candidat'].adresse,
+				'1 rue du Lac\n74000 Annecy')
+		self.assertTrue(admissions[0]['proposition'].internat)
+		self.assertEqual(self.serveur.requetes[0][1]['codeEtablissement'],
+				'0740003B')
+
+class NombreRequetesTest(TestCase):
+	"""
+	Le nombre de requêtes des pages qui listent les étudiants ne doit
+	pas dépendre du nombre d'étudiants affichés.
+	"""
+	def setUp(self):
+		self.classe = Classe.objects.create(nom="MPSI", slug='mpsi',
+				code_parcoursup=1234, groupe_parcoursup=1, capacite=48)
+		self.client.force_login(User.objects.create_user('secretariat'))
+		self.nb_etudiants = 0
+
+	def ajoute_etudiants(self, nombre):
+		for _ in range(nombre):
+			self.nb_etudiants += 1
+			etudiant = Etudiant.objects.create(
+					dossier_parcoursup=self.nb_etudiants, nom="NOM",
+					prenom="Prénom", sexe=Etudiant.SEXE_FEMME)
+			etudiant.nouvelle_proposition(Proposition(classe=self.classe,
+				etudiant=etudiant, date_proposition=timezone.now(),
+				internat=self.nb_etudiants % 2 == 0, cesure=False,
+				etat=Proposition.ETAT_OUI))
+
+	def verifie_requetes(self, url, nombre):
+		for nb_etudiants in (1, 10):
+			self.ajoute_etudiants(nb_etudiants)
+			with self.assertNumQueries(nombre):
+				self.assertEqual(self.client.get(url).status_code, 200)
+
+	def test_detail_classe(self):
+		self.verifie_requetes(reverse('classe.details',
+			args=[self.classe.slug]), 5)
+
+	def test_liste_actions(self):
+		self.verifie_requetes(reverse('action.liste'), 4)
+
+class EnvoisEnAttenteTest(TestCase):
+	def setUp(self):
+		classe = Classe.objects.create(nom="MPSI", slug='mpsi',
+				code_parcoursup=1234, groupe_parcoursup=1, capacite=48)
+		for dossier, etat in ((1, Proposition.ETAT_OUI),
+				(2, Proposition.ETAT_OUIMAIS)):
+			etudiant = Etudiant.objects.create(dossier_parcoursup=dossier,
+					nom="NOM{}".format(dossier), prenom="Prénom",
+					sexe=Etudiant.SEXE_HOMME, adresse="1 rue\n69001 LYON")
+			etudiant.nouvelle_proposition(Proposition(classe=classe,
+				etudiant=etudiant, date_proposition=timezone.now(),
+				internat=True, cesure=False, etat=etat))
+			Action.objects.create(etudiant=etudiant,
+					proposition=etudiant.proposition_actuelle,
+					categorie=Action.ENVOI_DOSSIER_INTERNAT,
+					date=timezone.now())
+
+	def test_etudiants_distincts(self):
+		with self.assertNumQueries(1):
+			etudiants = list(Etudiant.objects.envois_en_attente())
+		self.assertEqual([e.pk for e in etudiants], [1, 2])
+		self.assertEqual([e.pk for e in
+			Etudiant.objects.envois_en_attente(definitif=True)], [1])
+
+		# Les champs imprimés sont lus par la même requête
+		with self.assertNumQueries(0):
+			self.assertEqual(etudiants[0].civilite() + " " +
+					str(etudiants[0]), "M. NOM1 Prénom")
+			self.assertEqual(etudiants[0].adresse, "1 rue\n69001 LYON")
+
+def contenu_tables():
+	"""
+	Contenu des tables des étudiants, propositions, actions et compteurs
+	des classes, sans les clés primaires générées : une proposition est
+	désignée par son étudiant, sa classe et sa date.
+	"""
+	propositions = {p.pk: (p.etudiant_id, p.classe_id, p.date_proposition)
+			for p in Proposition.objects.all()}
+	return {
+		'etudiants': [(e.pk, e.nom, e.prenom, e.email, e.adresse,
+			e.telephone, e.telephone_mobile, e.sexe, e.date_naissance,
+			e.ine, propositions.get(e.proposition_actuelle_id))
+			for e in Etudiant.objects.order_by('pk')],
+		'propositions': sorted(((propositions[p.pk], p.etat, p.internat,
+			p.cesure, p.date_demission, propositions.get(p.remplace_id),
+			p.inscription) for p in Proposition.objects.all()), key=repr),
+		'actions': sorted(((a.etudiant_id, a.categorie, a.etat, a.date,
+			a.date_fait, propositions.get(a.proposition_id), a.message)
+			for a in Action.objects.all()), key=repr),
+		'classes': list(Classe.objects.order_by('pk').values_list('pk',
+			*Classe.objects.CHAMPS_COMPTEURS)),
+	}
+
+class SynchroLotTest(TestCase):
+	"""
+	L'enregistrement par lots doit donner les mêmes étudiants,
+	propositions et actions que l'enregistrement candidat par candidat
+	avec Etudiant.nouvelle_proposition et Etudiant.demission.
+	"""
+	OUI = ParcoursupProposition.ETAT_ACCEPTEE
+	OUIMAIS = ParcoursupProposition.ETAT_ACCEPTEE_AUTRES_VOEUX
+	REFUS = ParcoursupProposition.ETAT_REFUSEE
+
+	def setUp(self):
+		Commune.objects.create(insee='74010', libelle='Annecy')
+		self.mpsi = Classe.objects.create(nom="MPSI", slug='mpsi',
+				code_parcoursup=1234, groupe_parcoursup=1, capacite=48)
+		self.pcsi = Classe.objects.create(nom="PCSI", slug='pcsi',
+				code_parcoursup=5678, groupe_parcoursup=1, capacite=48)
+		self.date_fin = date_paris(2019, 6, 20)
+
+		psup = ParcoursupRest(login='login', password='mdp',
+				code_etablissement='0740003B')
+		self.admissions = [psup.parse_parcoursup_admission(donnees)
+			for donnees in (
+				# Nouveaux candidats (le second a refusé : il est ignoré)
+				admission_json(1, 1234, self.OUI, internat=True),
+				admission_json(6, 1234, self.REFUS),
+				admission_json(11, 5678, self.OUIMAIS),
+				# Demande d'internat après l'envoi du dossier
+				admission_json(2, 1234, self.OUI, internat=True),
+				# Changement de classe
+				admission_json(3, 5678, self.OUI),
+				# Démission
+				admission_json(4, 1234, self.REFUS),
+				# Seul l'état change
+				admission_json(7, 1234, self.OUI, internat=True),
+				# Renoncement à l'internat
+				admission_json(8, 1234, self.OUI),
+				# Nouvelle proposition après une démission
+				admission_json(9, 5678, self.OUI),
+				# Formation inconnue : le candidat démissionne à la fin
+				admission_json(10, 9999, self.OUI),
+			)]
+
+	def etudiants_existants(self):
+		"""
+		Étudiants déjà enregistrés avant la synchronisation. Le 5 n'est
+		plus dans la liste des admis et démissionne à la fin.
+		"""
+		for code, classe, etat, internat in (
+				(2, self.mpsi, Proposition.ETAT_OUIMAIS, False),
+				(3, self.mpsi, Proposition.ETAT_OUI, False),
+				(4, self.mpsi, Proposition.ETAT_OUI, True),
+				(5, self.pcsi, Proposition.ETAT_OUI, False),
+				(7, self.mpsi, Proposition.ETAT_OUIMAIS, True),
+				(8, self.mpsi, Proposition.ETAT_OUI, True),
+				(9, self.mpsi, Proposition.ETAT_OUI, False),
+				(10, self.pcsi, Proposition.ETAT_OUI, False)):
+			etudiant = Etudiant.objects.create(dossier_parcoursup=code,
+					nom="ANCIEN", prenom="Prénom")
+			etudiant.nouvelle_proposition(Proposition(classe=classe,
+				etudiant=etudiant, date_proposition=date_paris(2019, 5, 20),
+				internat=internat, cesure=False, etat=etat))
+
+		Action.objects.filter(etudiant=2, categorie=Action.ENVOI_DOSSIER
+				).update(etat=Action.ETAT_FAIT, date_fait=date_paris(2019, 5, 25))
+		Etudiant.objects.get(pk=9).demission(date_paris(2019, 6, 1))
+
+	def import_par_lots(self):
+		synchro = SynchroLot()
+		synchro.enregistre(self.admissions)
+		Etudiant.objects.demission_lot(Etudiant.objects.exclude(
+			dossier_parcoursup__in=synchro.codes_admis), self.date_fin)
+
+	def import_par_objet(self):
+		codes_admis = []
+		for admission in self.admissions:
+			psup_etudiant = admission['candidat']
+			psup_prop = admission['proposition']
+			code = int(psup_etudiant.code)
+			try:
+				etudiant = Etudiant.objects.get(pk=code)
+			except Etudiant.DoesNotExist:
+				if psup_prop.etat == self.REFUS:
+					continue
+				etudiant = Etudiant(dossier_parcoursup=code)
+
+			etudiant.nom = psup_etudiant.nom
+			etudiant.prenom = psup_etudiant.prenom
+			etudiant.email = psup_etudiant.email
+			etudiant.adresse = psup_etudiant.adresse
+			etudiant.telephone = psup_etudiant.telephone_fixe or ''
+			etudiant.telephone_mobile = psup_etudiant.telephone_mobile or ''
+			etudiant.sexe = psup_etudiant.sexe
+			etudiant.date_naissance = psup_etudiant.date_naissance
+			etudiant.ine = psup_etudiant.ine
+			etudiant.save()
+
+			if psup_prop.etat == self.REFUS:
+				etudiant.demission(psup_prop.date)
+				continue
+
+			classe = Classe.objects.filter(
+					code_parcoursup=psup_prop.code_formation).first()
+			if classe is None:
+				continue
+			etudiant.nouvelle_proposition(Proposition(classe=classe,
+				etudiant=etudiant, date_proposition=psup_prop.date,
+				internat=psup_prop.internat, cesure=psup_prop.cesure,
+				etat=SynchroLot.ETATS[psup_prop.etat]))
+			codes_admis.append(code)
+
+		for etudiant in Etudiant.objects.exclude(
+				dossier_parcoursup__in=codes_admis):
+			etudiant.demission(self.date_fin)
+
+	def etat_base(self, importe):
+		"""
+		Applique la synchronisation donnée aux étudiants existants, puis
+		renvoie le contenu des tables (voir contenu_tables). Les
+		modifications sont ensuite annulées.
+		"""
+		with transaction.atomic():
+			self.etudiants_existants()
+			importe()
+
+			etat = contenu_tables()
+			transaction.set_rollback(True)
+		return etat
+
+	def test_meme_resultat(self):
+		par_lots = self.etat_base(self.import_par_lots)
+		par_objet = self.etat_base(self.import_par_objet)
+		for table in par_objet:
+			self.assertEqual(par_lots[table], par_objet[table], table)
+
+		# Quelques vérifications pour s'assurer que tous les cas ont bien
+		# été rencontrés.
+		etudiants = {e[0]: e for e in par_lots['etudiants']}
+		self.assertEqual(sorted(etudiants), [1, 2, 3, 4, 5, 7, 8, 9, 10, 11])
+		self.assertIsNone(etudiants[4][-1])
+		self.assertIsNone(etudiants[5][-1])
+		self.assertIsNone(etudiants[10][-1])
+		self.assertEqual(etudiants[3][-1][1], self.pcsi.pk)
+		categories = [(a[0], a[1]) for a in par_lots['actions']]
+		self.assertIn((2, Action.ENVOI_DOSSIER_INTERNAT), categories)
+		self.assertIn((3, Action.INSCRIPTION), categories)
+		self.assertIn((5, Action.DEMISSION), categories)
+
+
+	def test_modification_manuelle(self):
+		"""
+		Un candidat modifié à la main est traité de nouveau par la
+		synchronisation suivante, même si Parcoursup renvoie les mêmes
+		données.
+		"""
+		admissions = [a for a in self.admissions
+				if a['candidat'].code == '3']
+		SynchroLot().enregistre(admissions)
+		synchro = SynchroLot()
+		synchro.enregistre(admissions)
+		self.assertEqual(synchro.nb_inchanges, 1)
+
+		etudiant = Etudiant.objects.get(pk=3)
+		etudiant.nouvelle_proposition(Proposition(classe=self.mpsi,
+			etudiant=etudiant, date_proposition=self.date_fin,
+			internat=False, cesure=False, etat=Proposition.ETAT_OUI))
+		self.assertEqual(Etudiant.objects.get(pk=3).empreinte_parcoursup, '')
+
+		synchro = SynchroLot()
+		synchro.enregistre(admissions)
+		self.assertEqual(synchro.nb_modifies, 1)
+		self.assertEqual(Etudiant.objects.get(pk=3
+			).proposition_actuelle.classe, self.pcsi)
+
+		# Même chose après une démission saisie à la main
+		Etudiant.objects.get(pk=3).demission(self.date_fin)
+		self.assertEqual(Etudiant.objects.get(pk=3).empreinte_parcoursup, '')
+
+class DemissionLotTest(TestCase):
+	def setUp(self):
+		self.classe = Classe.objects.create(nom="MPSI", slug='mpsi',
+				code_parcoursup=1234, groupe_parcoursup=1, capacite=48)
+		self.date = date_paris(2019, 6, 20)
+
+	def ajoute_etudiants(self, nombre):
+		"""
+		Ajoute des étudiants admis (un sur deux à l'internat), plus un
+		étudiant qui a déjà démissionné et un étudiant sans proposition.
+		"""
+		debut = Etudiant.objects.count() + 1
+		for code in range(debut, debut + nombre):
+			etudiant = Etudiant.objects.create(dossier_parcoursup=code,
+					nom="NOM", prenom="Prénom")
+			etudiant.nouvelle_proposition(Proposition(classe=self.classe,
+				etudiant=etudiant, date_proposition=date_paris(2019, 5, 20),
+				internat=code % 2 == 0, cesure=False,
+				etat=Proposition.ETAT_OUI))
+		Etudiant.objects.get(pk=debut).demission(date_paris(2019, 6, 1))
+		Etudiant.objects.create(dossier_parcoursup=debut + nombre,
+				nom="NOM", prenom="Prénom")
+
+	def etat_base(self, demission):
+		with transaction.atomic():
+			self.ajoute_etudiants(4)
+			demission()
+			etat = contenu_tables()
+			transaction.set_rollback(True)
+		return etat
+
+	def test_meme_resultat(self):
+		"""
+		demission_lot donne le même résultat que Etudiant.demission
+		appelée pour chaque étudiant.
+		"""
+		par_lot = self.etat_base(lambda: Etudiant.objects.demission_lot(
+			Etudiant.objects.all(), self.date))
+		par_objet = self.etat_base(lambda: [etudiant.demission(self.date)
+			for etudiant in Etudiant.objects.all()])
+		for table in par_objet:
+			self.assertEqual(par_lot[table], par_objet[table], table)
+		self.assertEqual(par_lot['classes'], [(self.classe.pk, 0, 0, 0, 0, 0)])
+
+	def test_nombre_requetes(self):
+		nb_requetes = []
+		for nombre in (2, 11):
+			with transaction.atomic():
+				self.ajoute_etudiants(nombre)
+				with CaptureQueriesContext(connection) as requetes:
+					self.assertEqual(Etudiant.objects.demission_lot(
+						Etudiant.objects.all(), self.date), nombre - 1)
+				nb_requetes.append(len(requetes))
+				transaction.set_rollback(True)
+		self.assertEqual(nb_requetes[0], nb_requetes[1])
+
+class CompteursClassesTest(TestCase):
+	"""
+	Les compteurs d'admissions ajustés à chaque modification doivent
+	rester égaux à ceux que donne un recalcul complet.
+	"""
+	def setUp(self):
+		self.mpsi = Classe.objects.create(nom="MPSI", slug='mpsi',
+				code_parcoursup=1234, groupe_parcoursup=1, capacite=48)
+		self.pcsi = Classe.objects.create(nom="PCSI", slug='pcsi',
+				code_parcoursup=5678, groupe_parcoursup=1, capacite=48)
+		self.etudiant = Etudiant.objects.create(dossier_parcoursup=1,
+				nom="NOM", prenom="Prénom")
+
+	def compteurs(self, classe):
+		return Classe.objects.filter(pk=classe.pk).values_list(
+				*Classe.objects.CHAMPS_COMPTEURS).get()
+
+	def assertCompteursExacts(self):
+		ajustes = list(Classe.objects.order_by('pk').values_list(
+			*Classe.objects.CHAMPS_COMPTEURS))
+		Classe.objects.maj_compteurs()
+		self.assertEqual(ajustes, list(Classe.objects.order_by('pk'
+			).values_list(*Classe.objects.CHAMPS_COMPTEURS)))
+
+	def proposition(self, classe, etat, internat=False, jour=20,
+			etudiant=None):
+		etudiant = etudiant or Etudiant.objects.get(pk=self.etudiant.pk)
+		etudiant.nouvelle_proposition(Proposition(classe=classe,
+			etudiant=etudiant, date_proposition=date_paris(2019, 5, jour),
+			internat=internat, cesure=False, etat=etat))
+		self.assertCompteursExacts()
+
+	def test_proposition_et_demission(self):
+		# Acceptation, changement d'état puis remplacement
+		self.proposition(self.mpsi, Proposition.ETAT_OUIMAIS, internat=True)
+		self.assertEqual(self.compteurs(self.mpsi), (0, 1, 0, 1, 0))
+		self.proposition(self.mpsi, Proposition.ETAT_OUI, internat=True,
+				jour=21)
+		self.assertEqual(self.compteurs(self.mpsi), (1, 0, 1, 0, 0))
+		self.proposition(self.mpsi, Proposition.ETAT_OUI, jour=22)
+		self.assertEqual(self.compteurs(self.mpsi), (1, 0, 0, 0, 0))
+		self.proposition(self.pcsi, Proposition.ETAT_OUI, jour=23)
+		self.assertEqual(self.compteurs(self.mpsi), (0, 0, 0, 0, 0))
+		self.assertEqual(self.compteurs(self.pcsi), (1, 0, 0, 0, 0))
+
+		# Démission, répétée sans effet, puis nouvelle proposition
+		proposition = Etudiant.objects.get(pk=1).proposition_actuelle
+		Etudiant.objects.get(pk=1).demission(date_paris(2019, 6, 1))
+		self.assertCompteursExacts()
+		proposition.refresh_from_db()
+		proposition.demission(date_paris(2019, 6, 2))
+		self.assertCompteursExacts()
+		self.assertEqual(self.compteurs(self.pcsi), (0, 0, 0, 0, 0))
+		self.proposition(self.pcsi, Proposition.ETAT_OUIMAIS, jour=24)
+		self.assertEqual(self.compteurs(self.pcsi), (0, 1, 0, 0, 0))
+
+	def test_inscription(self):
+		self.proposition(self.mpsi, Proposition.ETAT_OUI)
+		self.client.force_login(User.objects.create_user('secretariat'))
+		reponse = mock.Mock()
+		reponse.request.json.return_value = {'retour': 'OK'}
+		with mock.patch.object(ParcoursupRest, 'maj_inscription',
+				return_value=reponse):
+			self.client.post(reverse('etudiant.inscription', args=[1]))
+		self.assertCompteursExacts()
+		self.assertEqual(self.compteurs(self.mpsi), (1, 0, 0, 0, 1))
+
+		# Seule une inscription qui n'était pas encore réalisée compte
+		for code in (2, 3):
+			self.proposition(self.mpsi, Proposition.ETAT_OUI,
+				etudiant=Etudiant.objects.create(dossier_parcoursup=code,
+					nom="NOM", prenom="Prénom"))
+		with mock.patch.object(ParcoursupRest, 'maj_inscriptions',
+				side_effect=lambda inscriptions, parallelisme: [
+					ResultatInscription(candidat, candidat.code != 3, '')
+					for candidat, _, _ in inscriptions]):
+			confirme_inscriptions(Etudiant.objects.all())
+		self.assertCompteursExacts()
+		self.assertEqual(self.compteurs(self.mpsi), (3, 0, 0, 0, 2))
+
+	def test_demission_lot(self):
+		for code in (2, 3):
+			self.proposition(self.mpsi, Proposition.ETAT_OUIMAIS,
+				internat=True, etudiant=Etudiant.objects.create(
+					dossier_parcoursup=code, nom="NOM", prenom="Prénom"))
+		self.proposition(self.pcsi, Proposition.ETAT_OUI)
+		Etudiant.objects.get(pk=2).demission(date_paris(2019, 6, 1))
+
+		Etudiant.objects.demission_lot(Etudiant.objects.filter(pk__lte=2),
+				date_paris(2019, 6, 20))
+		self.assertCompteursExacts()
+		self.assertEqual(self.compteurs(self.mpsi), (0, 1, 0, 1, 0))
+		self.assertEqual(self.compteurs(self.pcsi), (0, 0, 0, 0, 0))
+
+	def test_synchronisation(self):
+		self.proposition(self.mpsi, Proposition.ETAT_OUIMAIS)
+		Etudiant.objects.create(dossier_parcoursup=2, nom="NOM",
+				prenom="Prénom")
+		psup = ParcoursupRest(login='login', password='mdp',
+				code_etablissement='0740003B')
+		Commune.objects.create(insee='74010', libelle='Annecy')
+		SynchroLot().enregistre([psup.parse_parcoursup_admission(donnees)
+			for donnees in (
+				admission_json(1, 5678, ParcoursupProposition.ETAT_ACCEPTEE),
+				admission_json(2, 1234, ParcoursupProposition.ETAT_ACCEPTEE,
+					internat=True),
+				admission_json(3, 5678,
+					ParcoursupProposition.ETAT_ACCEPTEE_AUTRES_VOEUX),
+			)])
+		self.assertCompteursExacts()
+		self.assertEqual(self.compteurs(self.mpsi), (1, 0, 1, 0, 0))
+		self.assertEqual(self.compteurs(self.pcsi), (1, 1, 0, 0, 0))
+
+	def test_administration(self):
+		self.proposition(self.mpsi, Proposition.ETAT_OUI, internat=True)
+		proposition = Etudiant.objects.get(pk=1).proposition_actuelle
+		autre = Etudiant.objects.create(dossier_parcoursup=2, nom="NOM",
+				prenom="Prénom")
+		self.client.force_login(User.objects.create_superuser('admin',
+			'admin@example.org', 'mdp'))
+
+		# Passage à l'état « oui mais » et rattachement à un autre
+		# étudiant, dans une autre classe
+		reponse = self.client.post(reverse(
+			'admin:parcoursup_proposition_change', args=[proposition.pk]), {
+				'classe': self.pcsi.pk, 'etudiant': autre.pk,
+				'date_proposition_0': '2019-05-20',
+				'date_proposition_1': '10:00:00',
+				'internat': 'on', 'etat': Proposition.ETAT_OUIMAIS,
+				'inscription': 'on'})
+		self.assertEqual(reponse.status_code, 302)
+		self.assertCompteursExacts()
+		self.assertEqual(self.compteurs(self.mpsi), (0, 0, 0, 0, 0))
+		self.assertEqual(self.compteurs(self.pcsi), (0, 1, 0, 1, 1))
+
+		self.client.post(reverse('admin:parcoursup_etudiant_changelist'), {
+			'action': 'delete_selected', '_selected_action': [autre.pk],
+			'post': 'yes'})
+		self.assertFalse(Etudiant.objects.filter(pk=autre.pk).exists())
+		self.assertCompteursExacts()
+		self.assertEqual(self.compteurs(self.pcsi), (0, 0, 0, 0, 0))
+
+	def test_sans_verrou(self):
+		"""
+		Les modifications ajustent les compteurs sans verrouiller les
+		classes ni recompter leurs propositions.
+		"""
+		self.proposition(self.mpsi, Proposition.ETAT_OUI)
+		with CaptureQueriesContext(connection) as requetes:
+			Etudiant.objects.get(pk=1).demission(date_paris(2019, 6, 1))
+		sql = [requete['sql'] for requete in requetes.captured_queries]
+		self.assertFalse([requete for requete in sql
+			if 'COUNT(' in requete or 'FOR UPDATE' in requete])
+		self.assertTrue([requete for requete in sql
+			if '"nb_oui" = MAX(' in requete])
+
+class IterTableauJsonTest(SimpleTestCase):
+	DONNEES = [
+		{'nom': 'Éloïse "la \\ grande"', 'adresse': '1 rue\n74000 Annecy',
+			'ville': '\u00c9vian', 'vide': ''},
+		[1, [2, [3, []]], {'a': [{}]}],
+		-12.5e3, 0, True, None, "]", "[,",
+	]
+
+	def decoupe(self, texte, taille):
+		octets = texte.encode('utf-8')
+		return [octets[i:i + taille] for i in range(0, len(octets), taille)]
+
+	def test_morceaux(self):
+		"""
+		Le résultat ne dépend pas du découpage des données, même au
+		milieu d'une chaine, d'une séquence d'échappement, d'un nombre
+		ou d'un caractère UTF-8.
+		"""
+		texte = ' [ ' + ' , '.join(json.dumps(element, ensure_ascii=False)
+				for element in self.DONNEES) + ' ] '
+		for taille in range(1, len(texte.encode('utf-8')) + 1):
+			self.assertEqual(list(iter_tableau_json(self.decoupe(texte,
+				taille))), self.DONNEES, taille)
+
+	def test_tableau_vide(self):
+		for texte in ('[]', ' [ \n ] '):
+			self.assertEqual(list(iter_tableau_json(self.decoupe(texte, 1))),
+					[])
+
+	def test_donnees_incompletes(self):
+		texte = json.dumps(self.DONNEES)
+		for fin in (0, 1, 10, len(texte) - 1):
+			with self.assertRaises(ValueError, msg=texte[:fin]):
+				list(iter_tableau_json(self.decoupe(texte[:fin], 3)))
+
+	def test_donnees_invalides(self):
+		for texte in ('{"a": 1}', '[1 2]', '[1,,2]', '[1,]'):
+			with self.assertRaises(ValueError, msg=texte):
+				list(iter_tableau_json(self.decoupe(texte, 2)))
+
+
+class CommuneCacheTest(TestCase):
+	def setUp(self):
+		# Le cache est partagé par tout le processus.
+		Commune.objects.vide_cache()
+		self.addCleanup(Commune.objects.vide_cache)
+		Commune.objects.create(insee='74010', libelle='Annecy')
+		Commune.objects.create(insee='74011', libelle='Annecy-le-Vieux')
+
+	def test_une_requete_par_lot(self):
+		with self.assertNumQueries(1):
+			self.assertEqual(Commune.objects.libelles(['74010', '74011',
+				'74010', '99999']), {'74010': 'Annecy',
+					'74011': 'Annecy-le-Vieux', '99999': None})
+		with self.assertNumQueries(0):
+			self.assertEqual(Commune.objects.libelle('74011'),
+					'Annecy-le-Vieux')
+		with self.assertNumQueries(1):
+			self.assertEqual(Commune.objects.libelles(['74010', '74012']),
+					{'74010': 'Annecy', '74012': None})
+
+	def test_commune_inconnue(self):
+		"""
+		Une commune inconnue est trouvée dès qu'elle est ajoutée, même
+		sans signal (ajout par un autre processus).
+		"""
+		self.assertIsNone(Commune.objects.libelle('74012'))
+		Commune.objects.bulk_create([Commune(insee='74012',
+			libelle='Alby-sur-Chéran')])
+		self.assertEqual(Commune.objects.libelle('74012'),
+				'Alby-sur-Chéran')
+
+	def test_invalidation(self):
+		self.assertEqual(Commune.objects.libelle('74010'), 'Annecy')
+		commune = Commune.objects.get(pk='74010')
+		commune.libelle = 'Annecy (nouvelle commune)'
+		commune.save()
+		self.assertEqual(Commune.objects.libelle('74010'),
+				'Annecy (nouvelle commune)')
+		commune.delete()
+		self.assertIsNone(Commune.objects.libelle('74010'))
+
+	def test_taille_limitee(self):
+		with mock.patch.object(Commune.objects, 'TAILLE_CACHE', 1):
+			Commune.objects.libelle('74010')
+			Commune.objects.libelle('74011')
+			self.assertEqual(Commune.objects._libelles,
+					{'74011': 'Annecy-le-Vieux'})
+
+class FauxPagesCandidats(Parcoursup):
+	"""
+	Pages des candidats simulées, rendues d'autant plus tard qu'elles
+	ont été demandées tôt : en parallèle, elles arrivent dans le
+	désordre. Chaque page contient les candidats donnés par
+	CANDIDATS[code de la classe, liste].
+	"""
+	CANDIDATS = {
+		(1234, 'prop_acc'): [(1, False), (2, True), (3, False)],
+		(1234, 'prop_acc_att'): [(2, False), (4, False)],
+		(1234, 'ref'): [(5, False)],
+		(5678, 'prop_acc'): [(1, True), (4, True), (5, False)],
+		(5678, 'prop_acc_att'): [(3, True)],
+		(5678, 'ref'): [(1, False), (6, False)],
+	}
+
+	def __init__(self, parallelisme):
+		super().__init__(parallelisme=parallelisme)
+		self.reponses = []
+		self.verrou = threading.Lock()
+
+	def telecharge(self, url, **kwargs):
+		parametres = parse_qs(urlsplit(url).query)
+		page = (int(parametres['cx_g_ta_cod'][0]), parametres['liste'][0])
+		rang = list(self.CANDIDATS).index(page)
+		time.sleep(0.01 * (len(self.CANDIDATS) - rang))
+		with self.verrou:
+			self.reponses.append(rang)
+
+		lignes = ''.join('<tr><td>10 juin</td><td>12 juin 2019 08:00</td>'
+			'<td>{0}</td><td>NOM{0} Prénom</td><td>Oui</td>'
+			'<td>{1}</td></tr>'.format(code,
+				"Avec internat" if internat else "Sans internat")
+			for code, internat in self.CANDIDATS[page])
+		return mock.Mock(text='<table id="listeCandidats"><thead><tr>'
+			'<th>Date de la proposition</th><th>Date de la réponse</th>'
+			'<th>N° dossier</th><th>Nom et prénom</th><th>Etat</th>'
+			'<th>Internat</th></tr></thead><tbody>{}</tbody></table>'.format(
+				lignes))
+
+class RecupereToutTest(SimpleTestCase):
+	def test_parallelisme(self):
+		"""
+		Le résultat ne dépend pas de l'ordre d'arrivée des pages.
+		"""
+		mpsi = Classe(nom="MPSI", code_parcoursup=1234, groupe_parcoursup=1)
+		pcsi = Classe(nom="PCSI", code_parcoursup=5678, groupe_parcoursup=1)
+
+		sequentiel = FauxPagesCandidats(parallelisme=1)
+		reference = sequentiel.recupere_tout([mpsi, pcsi])
+		self.assertEqual(sequentiel.reponses, list(range(6)))
+
+		parallele = FauxPagesCandidats(parallelisme=6)
+		candidats = parallele.recupere_tout([mpsi, pcsi])
+		self.assertNotEqual(parallele.reponses, list(range(6)))
+
+		self.assertEqual(candidats, reference)
+		self.assertEqual(list(candidats), list(reference))
+		self.assertEqual(sorted(candidats), [1, 2, 3, 4, 5, 6])
+		# À état égal, c'est la première page (dans l'ordre des classes
+		# puis des états) qui l'emporte.
+		self.assertIs(candidats[1].classe, mpsi)
+		self.assertFalse(candidats[1].internat)
+		self.assertIs(candidats[3].classe, pcsi)
+		self.assertIs(candidats[4].classe, mpsi)
+		self.assertEqual(candidats[6].etat, Parcoursup.ETAT_DEMISSION)
+
+class ExtracteursHtmlTest(SimpleTestCase):
+	"""
+	Les extracteurs HTML doivent tous donner le résultat de l'analyse de
+	la page entière avec BeautifulSoup, sur les pages anonymisées de
+	fixtures/pages.
+	"""
+	def page(self, entete):
+		return '<table id="listeCandidats"><thead><tr>{}<th>Z</th></tr>' \
+			'</thead><tbody><tr><td>1</td></tr></tbody></table>'.format(
+					entete)
+
+	def compare(self, html):
+		reference = ExtracteurSoup('html.parser', filtre=False).extrait(html)
+		for nom, creation in EXTRACTEURS.items():
+			with self.subTest(extracteur=nom):
+				try:
+					self.assertEqual(creation().extrait(html), reference)
+				except bs4.FeatureNotFound:
+					self.skipTest("{} n'est pas installé".format(nom))
+		return reference
+
+	def test_pages(self):
+		noms = sorted(os.listdir(PAGES_PARCOURSUP))
+		self.assertTrue(noms)
+		for nom in noms:
+			with open(os.path.join(PAGES_PARCOURSUP, nom),
+					encoding='utf-8') as fichier:
+				html = fichier.read()
+			with self.subTest(page=nom):
+				libelles, lignes = self.compare(html)
+				self.assertEqual(libelles[1:5], ['Date de la proposition',
+					'Date de la réponse', 'N° dossier', 'Nom et prénom'])
+				self.assertEqual(libelles[7], 'Etat')
+				self.assertEqual(libelles[9], 'Internat')
+				self.assertGreaterEqual(len(lignes), 8)
+				self.assertEqual(lignes[1][4], 'MARTIN-LEROY Paul Henri')
+
+	def test_entetes_balises_imbriquees(self):
+		entetes = {
+			'<th>Nom</th>': 'Nom',
+			'<th><a><b> Nom </b></a></th>': 'Nom',
+			'<th> <a>Nom</a> </th>': None,
+			'<th>Etat <span>(tri)</span></th>': None,
+			'<th>Nom<br></th>': None,
+			'<th><img src="x"></th>': None,
+			'<th></th>': None,
+			'<th>  </th>': '',
+			'<th><!--x--></th>': 'x',
+			'<th><!--x-->Nom</th>': None,
+			'<th><table><tr><td>X</td></tr></table></th>': 'X',
+		}
+		for entete, libelle in entetes.items():
+			with self.subTest(entete=entete):
+				libelles, _ = self.compare(self.page(entete))
+				self.assertEqual(libelles, [libelle, 'Z'])
+
+class DatesTest(SimpleTestCase):
+	"""
+	Comparaison de parse_datetime et parse_date_francaise avec les
+	anciennes fonctions, qui utilisaient datetime.strptime.
+	"""
+	DATES_NUMERIQUES = ['12/06/2019 14:30', '03/01/2019 08:05',
+		'1/2/2019 8:5', '31/12/2019 23:59', '29/02/2020 00:00',
+		'12/06/2019  14:30']
+	DATES_NUMERIQUES_INVALIDES = ['', '12/06/2019', '12/06/19 14:30',
+		'32/01/2019 10:00', '12/13/2019 10:00', '29/02/2019 10:00',
+		'12/06/2019 24:00', '12/06/2019 14:30:00', '12-06-2019 14:30',
+		'12/06/2019 14:30\n', 'lundi 12/06/2019 14:30']
+
+	DATES_FRANCAISES = {
+		'12 juin 2019 14:30': (2019, 6, 12, 14, 30),
+		'3 janv. 2019 08:05': (2019, 1, 3, 8, 5),
+		'28 août 2019 23:59': (2019, 8, 28, 23, 59),
+		'1 déc. 2019 00:00': (2019, 12, 1, 0, 0),
+		'14 février 2019 12:00': (2019, 2, 14, 12, 0),
+		'14 févr. 2019 12:00': (2019, 2, 14, 12, 0),
+		'7 Juillet 2019 9:15': (2019, 7, 7, 9, 15),
+		'30 sept. 2019 18:45': (2019, 9, 30, 18, 45),
+	}
+	DATES_FRANCAISES_INVALIDES = ['', '12 juin', '12 june 2019 14:30',
+		'31 juin 2019 14:30', '12 juin 2019', '12/06/2019 14:30',
+		'12 juin 2019 14h30']
+
+	def test_parse_datetime(self):
+		for texte in self.DATES_NUMERIQUES:
+			with self.subTest(texte=texte):
+				self.assertEqual(parse_datetime(texte),
+						ancienne_date_numerique(texte))
+				self.assertIs(parse_datetime(texte).tzinfo, PARIS_TZ)
+
+	def test_parse_datetime_invalide(self):
+		for texte in self.DATES_NUMERIQUES_INVALIDES:
+			with self.subTest(texte=texte):
+				with self.assertRaises(ValueError):
+					ancienne_date_numerique(texte)
+				with self.assertRaises(ValueError):
+					parse_datetime(texte)
+
+	def test_parse_date_francaise(self):
+		for texte, attendu in self.DATES_FRANCAISES.items():
+			with self.subTest(texte=texte):
+				self.assertEqual(parse_date_francaise(texte),
+						datetime(*attendu, tzinfo=PARIS_TZ))
+		for texte in self.DATES_FRANCAISES_INVALIDES:
+			with self.subTest(texte=texte):
+				self.assertIsNone(parse_date_francaise(texte))
+
+	def test_parse_date_francaise_sans_annee(self):
+		self.assertEqual(parse_date_francaise(' 12 juin ', annee=2019),
+				datetime(2019, 6, 12, tzinfo=PARIS_TZ))
+		self.assertEqual(parse_date_francaise('3 janv.', annee=2020),
+				datetime(2020, 1, 3, tzinfo=PARIS_TZ))
+		self.assertEqual(parse_date_francaise('12 juin 2019 14:30',
+			annee=2020), datetime(2019, 6, 12, 14, 30, tzinfo=PARIS_TZ))
+		self.assertIsNone(parse_date_francaise('29 févr.', annee=2019))
+
+	def test_ancienne_date_francaise(self):
+		try:
+			ancienne_date_francaise(next(iter(self.DATES_FRANCAISES)))
+		except locale.Error:
+			self.skipTest("La locale fr_FR.UTF-8 n'est pas installée")
+		for texte in list(self.DATES_FRANCAISES) + \
+				self.DATES_FRANCAISES_INVALIDES:
+			with self.subTest(texte=texte):
+				self.assertEqual(parse_date_francaise(texte),
+						ancienne_date_francaise(texte))
+
+class EnregistreCoordonneesTest(TestCase):
+	def setUp(self):
+		for code in range(1, 5):
+			Etudiant.objects.create(dossier_parcoursup=code, nom="NOM",
+					prenom="Prénom", empreinte_parcoursup='empreinte')
+
+	def test_consommation_par_paquets(self):
+		"""
+		Les coordonnées sont enregistrées par paquets, au fil de la
+		lecture de l'itérable : le premier paquet est déjà en base
+		lorsque l'on lit le suivant.
+		"""
+		lus = []
+		def coordonnees():
+			for code in (1, 2, 99, 3, 1):
+				if code == 99:
+					self.assertEqual(Etudiant.objects.get(pk=1).email,
+							'1@example.org')
+				lus.append(code)
+				yield code, {'email': '{}@example.org'.format(len(lus)),
+						'telephone': '0102030405'}
+
+		self.assertEqual(enregistre_coordonnees(coordonnees(),
+			taille_lot=2), 4)
+		self.assertEqual(lus, [1, 2, 99, 3, 1])
+		self.assertEqual(dict(Etudiant.objects.values_list('pk', 'email')),
+				{1: '5@example.org', 2: '2@example.org',
+					3: '4@example.org', 4: ''})
+		self.assertFalse(Etudiant.objects.filter(pk__in=(1, 2, 3),
+			empreinte_parcoursup='empreinte').exists())
+		self.assertEqual(Etudiant.objects.get(pk=4).empreinte_parcoursup,
+				'empreinte')
+
+	def test_sans_modification(self):
+		enregistre_coordonnees([(1, {'email': 'a@example.org'})])
+		with self.assertNumQueries(1):
+			self.assertEqual(enregistre_coordonnees(
+				iter([(1, {'email': 'a@example.org'})])), 0)
+
+class FauxFichiersAdmissions(Parcoursup):
+	"""
+	Fichiers d'admissions simulés : la classe n contient les candidats
+	100 * n à 100 * n + 9, sauf la classe 0 dont le fichier est
+	illisible.
+	"""
+	def fichier_admissions(self, classe):
+		if classe == 0:
+			raise requests.ConnectionError("Fichier illisible")
+		for code in range(100 * classe, 100 * classe + 10):
+			yield code, {'email': '{}@example.org'.format(code)}
+
+class CoordonneesClassesTest(SimpleTestCase):
+	def test_toutes_classes(self):
+		psup = FauxFichiersAdmissions(parallelisme=2)
+		coordonnees = list(psup.coordonnees_classes([1, 2, 3],
+			taille_lot=3))
+		self.assertEqual(sorted(code for code, _ in coordonnees),
+				[code for classe in (1, 2, 3)
+					for code in range(100 * classe, 100 * classe + 10)])
+
+	def test_erreur_telechargement(self):
+		psup = FauxFichiersAdmissions(parallelisme=2)
+		lus = []
+		with self.assertRaises(requests.ConnectionError):
+			for code, _ in psup.coordonnees_classes([1, 0, 2],
+					taille_lot=3):
+				lus.append(code)
+		self.assertEqual(len(lus), 20)
+
+	def test_abandon(self):
+		"""
+		Les téléchargements ne restent pas bloqués sur la file pleine
+		lorsque le générateur est abandonné.
+		"""
+		psup = FauxFichiersAdmissions(parallelisme=1)
+		coordonnees = psup.coordonnees_classes(range(1, 20), taille_lot=1)
+		next(coordonnees)
+		fil = threading.Thread(target=coordonnees.close)
+		fil.start()
+		fil.join(5)
+		self.assertFalse(fil.is_alive())
+
+class TraiteFileAdmissionsTest(TestCase):
+	def setUp(self):
+		self.mpsi = Classe.objects.create(nom="MPSI", slug='mpsi',
+				code_parcoursup=1234, groupe_parcoursup=1, capacite=48)
+		self.pcsi = Classe.objects.create(nom="PCSI", slug='pcsi',
+				code_parcoursup=5678, groupe_parcoursup=2, capacite=48)
+		Commune.objects.create(insee='74010', libelle='Annecy')
+
+	def message(self, code, formation, situation, date_reponse):
+		donnees = admission_json(code, formation, situation,
+				date_reponse=date_reponse)
+		return ParcoursupMessageRecuLog.objects.create(
+				date=timezone.now(), ip_source='127.0.0.1',
+				endpoint='admissionCandidat', succes=True,
+				message="Requete enregistree",
+				etat=ParcoursupMessageRecuLog.ETAT_EN_ATTENTE,
+				code_candidat=code,
+				contenu=json.dumps(donnees).encode('utf-8'))
+
+	def en_attente(self):
+		return list(ParcoursupMessageRecuLog.objects.filter(
+			etat=ParcoursupMessageRecuLog.ETAT_EN_ATTENTE).order_by(
+				'pk').values_list('pk', flat=True))
+
+	def messages_candidat_1(self):
+		"""
+		Le candidat 1 accepte la MPSI, y démissionne puis accepte la
+		PCSI : seul l'ordre de réception donne le bon résultat.
+		"""
+		return [self.message(1, 1234, 1, '10/06/2019 10:00'),
+			self.message(1, 1234, 3, '11/06/2019 10:00'),
+			self.message(1, 5678, 2, '12/06/2019 10:00')]
+
+	def verifie_candidat_1(self):
+		etudiant = Etudiant.objects.get(pk=1)
+		self.assertEqual(etudiant.proposition_actuelle.classe, self.pcsi)
+		self.assertEqual(etudiant.proposition_actuelle.etat,
+				Proposition.ETAT_OUIMAIS)
+		self.assertIsNotNone(Proposition.objects.get(etudiant=etudiant,
+			classe=self.mpsi).date_demission)
+
+	def test_ordre(self):
+		messages = self.messages_candidat_1()
+		message_2 = self.message(2, 5678, 1, '10/06/2019 11:00')
+
+		self.assertEqual(traite_file_admissions(taille_lot=2), 2)
+		self.assertEqual(self.en_attente(), [messages[2].pk, message_2.pk])
+		self.assertEqual(traite_file_admissions(taille_lot=2), 2)
+		self.assertEqual(traite_file_admissions(taille_lot=2), 0)
+
+		self.verifie_candidat_1()
+		self.assertEqual(Etudiant.objects.get(pk=2)
+				.proposition_actuelle.classe, self.pcsi)
+		self.assertFalse(ParcoursupMessageRecuLog.objects.filter(
+			succes=False).exists())
+
+	def test_erreur(self):
+		"""
+		Un message en erreur est marqué comme traité sans succès, sans
+		empêcher le traitement des suivants.
+		"""
+		erreur = self.message(1, 9999, 1, '10/06/2019 10:00')
+		self.message(2, 1234, 1, '10/06/2019 11:00')
+
+		with self.assertLogs('parcoursup.admission', 'ERROR'):
+			self.assertEqual(traite_file_admissions(), 2)
+		self.assertEqual(self.en_attente(), [])
+		erreur.refresh_from_db()
+		self.assertFalse(erreur.succes)
+		self.assertIsNotNone(erreur.date_traitement)
+		self.assertFalse(Etudiant.objects.filter(pk=1).exists())
+		self.assertTrue(Etudiant.objects.get(pk=2).proposition_set.exists())
+
+	def test_candidat_bloque(self):
+		"""
+		Lorsqu'un autre processus a verrouillé un message d'un candidat,
+		les messages suivants de ce candidat attendent le prochain appel,
+		mais ceux qui le précèdent et ceux des autres candidats sont
+		traités.
+		"""
+		messages = self.messages_candidat_1()
+		message_2 = self.message(2, 5678, 1, '10/06/2019 11:00')
+
+		# Simulation du verrou de l'autre processus : SKIP LOCKED ignore
+		# le message verrouillé.
+		select_for_update = QuerySet.select_for_update
+		def verrouille(queryset, **kwargs):
+			return select_for_update(queryset.exclude(pk=messages[1].pk),
+					**kwargs)
+
+		with mock.patch.object(QuerySet, 'select_for_update', verrouille):
+			self.assertEqual(traite_file_admissions(), 2)
+		self.assertEqual(self.en_attente(), [messages[1].pk,
+			messages[2].pk])
+		self.assertEqual(Etudiant.objects.get(pk=1)
+				.proposition_actuelle.classe, self.mpsi)
+
+		self.assertEqual(traite_file_admissions(), 2)
+		self.assertEqual(self.en_attente(), [])
+		self.verifie_candidat_1()
+		self.assertTrue(Etudiant.objects.get(pk=2).proposition_set.exists())
+
+@override_settings(PASSWORD_HASHERS=[
+	'django.contrib.auth.hashers.MD5PasswordHasher'])
+class IdentificationCacheTest(TestCase):
+	def setUp(self):
+		cache.clear()
+		self.user = ParcoursupUser.objects.create(username='psup',
+				password=make_password('secret'))
+
+	def authentifie(self, password):
+		"""
+		Identification qui renvoie l'utilisateur (ou None en cas
+		d'échec) et le nombre de vérifications complètes du mot de
+		passe.
+		"""
+		with mock.patch.object(ParcoursupUser, 'check_password',
+				autospec=True,
+				side_effect=ParcoursupUser.check_password) as verification:
+			try:
+				user = ParcoursupUser.objects.authenticate('psup', password)
+			except ParcoursupUser.DoesNotExist:
+				user = None
+		return user, verification.call_count
+
+	def test_succes_en_cache(self):
+		self.assertEqual(self.authentifie('secret'), (self.user, 1))
+		self.assertEqual(self.authentifie('secret'), (self.user, 0))
+
+	def test_echec_hors_cache(self):
+		self.assertEqual(self.authentifie('faux'), (None, 1))
+		self.assertEqual(self.authentifie('faux'), (None, 1))
+		self.assertEqual(self.authentifie('secret'), (self.user, 1))
+		self.assertEqual(self.authentifie('faux'), (None, 1))
+
+	def test_changement_mot_de_passe(self):
+		self.assertEqual(self.authentifie('secret'), (self.user, 1))
+		self.user.password = make_password('nouveau')
+		self.user.save()
+		self.assertEqual(self.authentifie('secret'), (None, 1))
+		self.assertEqual(self.authentifie('nouveau'), (self.user, 1))
+		self.assertEqual(self.authentifie('nouveau'), (self.user, 0))
+
+	def test_utilisateur_inconnu(self):
+		with self.assertRaises(ParcoursupUser.DoesNotExist):
+			ParcoursupUser.objects.authenticate('inconnu', 'secret')
+
+	@override_settings(PARCOURSUP_IDENTIFICATION_CACHE=0)
+	def test_cache_desactive(self):
+		self.assertEqual(self.authentifie('secret'), (self.user, 1))
+		self.assertEqual(self.authentifie('secret'), (self.user, 1))
+
+	def test_cle_sans_mot_de_passe(self):
+		cle = ParcoursupUser.objects._cle_cache('psup', 'secret')
+		self.assertNotIn('secret', cle)
+		self.assertNotEqual(cle,
+				ParcoursupUser.objects._cle_cache('psup', 'secreT'))
+		self.assertNotEqual(cle,
+				ParcoursupUser.objects._cle_cache('psupsecret', ''))
+
+@override_settings(PASSWORD_HASHERS=[
+	'django.contrib.auth.hashers.MD5PasswordHasher'])
+class AdmissionViewTest(TestCase):
+	IDENTIFIANT = {'login': 'psup', 'pwd': 'secret'}
+
+	def setUp(self):
+		cache.clear()
+		self.user = ParcoursupUser.objects.create(username='psup',
+				password=make_password('secret'))
+		self.mpsi = Classe.objects.create(nom="MPSI", slug='mpsi',
+				code_parcoursup=1234, groupe_parcoursup=1, capacite=48)
+		self.pcsi = Classe.objects.create(nom="PCSI", slug='pcsi',
+				code_parcoursup=5678, groupe_parcoursup=2, capacite=48)
+		Commune.objects.create(insee='74010', libelle='Annecy')
+
+	def admission(self, code, situation=1, formation=1234,
+			date_reponse='14/06/2019 10:30', identifiant=None, **kwargs):
+		donnees = admission_json(code, formation, situation,
+				date_reponse=date_reponse, **kwargs)
+		donnees['identifiant'] = self.IDENTIFIANT if identifiant is None \
+				else identifiant
+		return donnees
+
+	def poste(self, donnees):
+		return self.client.post(reverse('parcoursup_admission'),
+				json.dumps(donnees), content_type='application/json')
+
+	def test_doublon(self):
+		self.assertEqual(self.poste(self.admission(1)).json()['message'],
+				"Requete correctement traitee")
+		self.assertEqual(self.poste(self.admission(1)).json()['message'],
+				"Requete deja recue")
+
+		original, doublon = ParcoursupMessageRecuLog.objects.order_by('pk')
+		self.assertIsNone(original.doublon_de)
+		self.assertEqual(doublon.doublon_de, original)
+		self.assertEqual(doublon.code_candidat, 1)
+		self.assertIsNone(doublon.contenu)
+		self.assertEqual(Proposition.objects.count(), 1)
+
+	def test_doublon_simultane(self):
+		"""
+		Un message identique enregistré par une autre requête entre la
+		recherche des doublons et l'enregistrement du journal est
+		détecté grâce à la contrainte d'unicité.
+		"""
+		original = ParcoursupMessageRecuLog.objects.create(
+				date=timezone.now(), ip_source='127.0.0.1',
+				endpoint=AdmissionView.endpoint, succes=True,
+				message="Requete correctement traitee", code_candidat=1,
+				empreinte=TraitementAdmission.empreinte(self.admission(1)))
+
+		doublon = AdmissionView.doublon
+		appels = []
+		def doublon_manque(vue, msg_log):
+			appels.append(msg_log)
+			return len(appels) > 1 and doublon(vue, msg_log)
+
+		with mock.patch.object(AdmissionView, 'doublon', doublon_manque):
+			reponse = self.poste(self.admission(1))
+		self.assertEqual(len(appels), 2)
+		self.assertEqual(reponse.json()['message'], "Requete deja recue")
+		self.assertFalse(Etudiant.objects.exists())
+		self.assertEqual(ParcoursupMessageRecuLog.objects.get(
+			doublon_de__isnull=False).doublon_de, original)
+
+	def test_contrainte_empreinte(self):
+		def journal(**kwargs):
+			kwargs.setdefault('succes', True)
+			return ParcoursupMessageRecuLog.objects.create(
+					date=timezone.now(), ip_source='127.0.0.1',
+					endpoint=AdmissionView.endpoint, message='', **kwargs)
+
+		original = journal(empreinte='abc')
+		journal(empreinte='abc', succes=False)
+		journal(empreinte='abc', doublon_de=original)
+		journal(empreinte='')
+		journal(empreinte='')
+		with self.assertRaises(IntegrityError), transaction.atomic():
+			journal(empreinte='abc')
+
+	def test_lot(self):
+		reponse = self.poste([self.admission(1), self.admission(2),
+			self.admission(3, formation=9999)])
+		self.assertEqual(reponse.status_code, 200)
+		self.assertEqual(reponse.json()['retour'], 'NOK')
+		self.assertEqual([(resultat['codeCandidat'], resultat['retour'])
+			for resultat in reponse.json()['resultats']],
+			[('1', 'OK'), ('2', 'OK'), ('3', 'NOK')])
+
+		lot = ParcoursupMessageRecuLog.objects.get(code_candidat=None)
+		self.assertIsNone(lot.contenu)
+		self.assertEqual(list(ParcoursupMessageRecuLog.objects.exclude(
+			pk=lot.pk).order_by('pk').values_list('code_candidat',
+				'succes')), [(1, True), (2, True), (3, False)])
+		self.assertEqual(sorted(Etudiant.objects.values_list('pk',
+			flat=True)), [1, 2])
+
+	def test_lot_meme_resultat(self):
+		"""
+		Un tableau de messages donne le même résultat que les mêmes
+		messages envoyés un par un, y compris lorsqu'un candidat déjà
+		connu démissionne puis accepte une autre proposition dans le
+		même tableau.
+		"""
+		avant = [self.admission(1, 1, 1234, '10/06/2019 10:00'),
+			self.admission(2, 2, 1234, '10/06/2019 11:00')]
+		messages = [
+			self.admission(1, 3, 1234, '11/06/2019 10:00'),
+			self.admission(1, 2, 5678, '12/06/2019 10:00'),
+			self.admission(2, 3, 1234, '12/06/2019 11:00'),
+			self.admission(2, 1, 1234, '13/06/2019 11:00', internat=True),
+			self.admission(3, 1, 5678, '13/06/2019 12:00'),
+		]
+
+		def etat_base(envoi):
+			with transaction.atomic():
+				for donnees in avant:
+					self.poste(donnees)
+				envoi()
+				etat = contenu_tables()
+				transaction.set_rollback(True)
+			return etat
+
+		par_lot = etat_base(lambda: self.poste(messages))
+		un_par_un = etat_base(lambda: [self.poste(donnees)
+			for donnees in messages])
+		self.assertEqual(par_lot, un_par_un)
+
+		# La proposition en PCSI du candidat 1 ne remplace pas la MPSI,
+		# dont il avait déjà démissionné.
+		self.assertIn(((1, self.pcsi.pk, date_paris(2019, 6, 12, 10)),
+			Proposition.ETAT_OUIMAIS, False, False, None, None, False),
+			par_lot['propositions'])
+
+	def test_lot_identifiants_differents(self):
+		autre = ParcoursupUser.objects.create(username='autre',
+				password=make_password('autre'))
+		for identifiant in ({'login': 'autre', 'pwd': 'autre'},
+				{'login': 'psup', 'pwd': 'faux'}, {}):
+			with self.subTest(identifiant=identifiant):
+				reponse = self.poste([self.admission(1),
+					self.admission(2, identifiant=identifiant)])
+				self.assertEqual(reponse.json()['message'],
+						"Données d'identification incorrectes")
+		self.assertFalse(Etudiant.objects.exists())
+		self.assertFalse(ParcoursupMessageRecuLog.objects.filter(
+			user=autre).exists())
+
+class RejoueMessagesRecusTest(TestCase):
+	def setUp(self):
+		Classe.objects.create(nom="MPSI", slug='mpsi',
+				code_parcoursup=1234, groupe_parcoursup=1, capacite=48)
+		Commune.objects.create(insee='74010', libelle='Annecy')
+		for code, situation in ((1, 1), (2, 2), (1, 3)):
+			donnees = admission_json(code, 1234, situation)
+			ParcoursupMessageRecuLog.objects.create(date=timezone.now(),
+					ip_source='127.0.0.1', endpoint='admissionCandidat',
+					succes=True, message="Requete correctement traitee",
+					code_candidat=code,
+					contenu=json.dumps(donnees).encode('utf-8'))
+
+	def rejoue(self, **options):
+		sortie = io.StringIO()
+		call_command('rejoue_messages_recus', stdout=sortie,
+				stderr=io.StringIO(), **options)
+		return sortie.getvalue()
+
+	def test_destination_obligatoire(self):
+		with self.assertRaises(CommandError):
+			self.rejoue()
+		with self.assertRaises(CommandError):
+			self.rejoue(destination='inconnue')
+
+	def test_base_production(self):
+		with self.assertRaisesMessage(CommandError, "base de production"):
+			self.rejoue(destination='default')
+		self.assertFalse(Etudiant.objects.exists())
+
+	@override_settings(PARCOURSUP_BASE_PRODUCTION='production')
+	def test_annulation_par_defaut(self):
+		avant = contenu_tables()
+		sortie = self.rejoue(destination='default')
+		self.assertIn("3 message(s) rejoué(s), 0 en erreur", sortie)
+		self.assertIn("(annulées)", sortie)
+		self.assertIn("étudiants : 0 -> 2", sortie)
+		self.assertEqual(contenu_tables(), avant)
+
+	@override_settings(PARCOURSUP_BASE_PRODUCTION='production')
+	def test_commit(self):
+		sortie = self.rejoue(destination='default', commit=True)
+		self.assertNotIn("(annulées)", sortie)
+		self.assertEqual(sorted((etudiant.pk,
+			etudiant.proposition_actuelle_id is None)
+			for etudiant in Etudiant.objects.all()),
+			[(1, True), (2, False)])
+
+	@override_settings(PARCOURSUP_BASE_PRODUCTION='production')
+	def test_messages_refuses(self):
+		ParcoursupMessageRecuLog.objects.create(date=timezone.now(),
+				ip_source='127.0.0.1', endpoint='admissionCandidat',
+				succes=False, message="Donnees incorrectes",
+				code_candidat=3,
+				contenu=json.dumps(admission_json(3, 1234, 1)).encode('utf-8'))
+		sortie = self.rejoue(destination='default', commit=True)
+		self.assertIn("3 message(s) rejoué(s), 0 en erreur", sortie)
+		self.assertFalse(Etudiant.objects.filter(pk=3).exists())
+
+class ArchiveMessagesRecusTest(TestCase):
+	def setUp(self):
+		self.dossier = tempfile.TemporaryDirectory()
+		self.addCleanup(self.dossier.cleanup)
+		self.ancien = timezone.now() - timedelta(days=100)
+		self.recent = timezone.now() - timedelta(days=10)
+
+	def message(self, date, contenu=b'{}', **kwargs):
+		return ParcoursupMessageRecuLog.objects.create(date=date,
+				ip_source='127.0.0.1', endpoint='admissionCandidat',
+				succes=True, message="Requete correctement traitee",
+				contenu=contenu, **kwargs)
+
+	def archive(self, **options):
+		options.setdefault('dossier', self.dossier.name)
+		sortie = io.StringIO()
+		call_command('archive_messages_recus', jours=90, stdout=sortie,
+				**options)
+		return sortie.getvalue()
+
+	def lit_archive(self):
+		fichiers = os.listdir(self.dossier.name)
+		self.assertEqual(len(fichiers), 1)
+		with gzip.open(os.path.join(self.dossier.name, fichiers[0]), 'rt',
+				encoding='utf-8') as archive:
+			return [json.loads(ligne) for ligne in archive]
+
+	def restants(self):
+		return sorted(ParcoursupMessageRecuLog.objects.values_list('pk',
+			flat=True))
+
+	def test_dossier_obligatoire(self):
+		with self.assertRaises(CommandError):
+			self.archive(dossier=None)
+
+	def test_archive(self):
+		texte = self.message(self.ancien, code_candidat=1,
+				contenu='{"nom": "Élise"}'.encode('utf-8'))
+		binaire = self.message(self.ancien, contenu=b'\xff\xfe')
+		recent = self.message(self.recent)
+
+		sortie = self.archive()
+
+		self.assertIn("2 message(s) supprimé(s)", sortie)
+		self.assertEqual(self.restants(), [recent.pk])
+		enregistrements = self.lit_archive()
+		self.assertEqual([e['id'] for e in enregistrements],
+				[texte.pk, binaire.pk])
+		self.assertEqual(enregistrements[0]['payload'], '{"nom": "Élise"}')
+		self.assertEqual(enregistrements[0]['code_candidat'], 1)
+		self.assertEqual(enregistrements[0]['date'], self.ancien.isoformat())
+		self.assertNotIn('payload', enregistrements[1])
+		self.assertEqual(base64.b64decode(
+			enregistrements[1]['payload_base64']), b'\xff\xfe')
+
+	def test_par_lots(self):
+		anciens = [self.message(self.ancien) for i in range(5)]
+		with mock.patch.object(ArchiveMessagesRecus, 'TAILLE_LOT', 2), \
+				CaptureQueriesContext(connection) as requetes:
+			sortie = self.archive()
+		self.assertIn("5 message(s) supprimé(s)", sortie)
+		self.assertEqual(self.restants(), [])
+		self.assertEqual([e['id'] for e in self.lit_archive()],
+				[message.pk for message in anciens])
+		# Trois lots, et donc trois suppressions
+		self.assertEqual(len([requete for requete in requetes
+			if requete['sql'].startswith('DELETE')]), 3)
+
+	def test_sans_archive(self):
+		for i in range(3):
+			self.message(self.ancien)
+		recent = self.message(self.recent)
+		with mock.patch.object(ArchiveMessagesRecus, 'TAILLE_LOT', 2):
+			sortie = self.archive(dossier=None, sans_archive=True)
+		self.assertIn("3 message(s) supprimé(s)", sortie)
+		self.assertEqual(self.restants(), [recent.pk])
+		self.assertEqual(os.listdir(self.dossier.name), [])
+
+	def test_en_attente_conserves(self):
+		en_attente = self.message(self.ancien,
+				etat=ParcoursupMessageRecuLog.ETAT_EN_ATTENTE)
+		self.message(self.ancien)
+		self.archive()
+		self.assertEqual(self.restants(), [en_attente.pk])
+
+	def test_doublons_recents(self):
+		# L'original est conservé tant que l'un de ses doublons l'est ;
+		# les doublons anciens peuvent être supprimés seuls.
+		original = self.message(self.ancien, empreinte='a')
+		self.message(self.ancien, contenu=None, empreinte='a',
+				doublon_de=original)
+		doublons = [self.message(self.recent, contenu=None, empreinte='a',
+			doublon_de=original) for i in range(2)]
+		self.archive()
+		self.assertEqual(self.restants(),
+				[original.pk] + [doublon.pk for doublon in doublons])
+		self.assertEqual(ParcoursupMessageRecuLog.objects.filter(
+			doublon_de=original).count(), 2)
+
+	def test_doublon_recent_unique(self):
+		original = self.message(self.ancien, empreinte='a')
+		doublon = self.message(self.recent, contenu=None, empreinte='a',
+				doublon_de=original)
+		self.archive(dossier=None, sans_archive=True)
+		doublon.refresh_from_db()
+		self.assertEqual(doublon.doublon_de, original)
+
+	def test_doublons_anciens(self):
+		# Les doublons sont supprimés avec leur original, même s'ils
+		# n'appartiennent pas au même lot.
+		original = self.message(self.ancien, empreinte='a')
+		for i in range(3):
+			self.message(self.ancien)
+		doublons = [self.message(self.ancien, contenu=None, empreinte='a',
+			doublon_de=original) for i in range(2)]
+		with mock.patch.object(ArchiveMessagesRecus, 'TAILLE_LOT', 1):
+			sortie = self.archive()
+		self.assertIn("6 message(s) supprimé(s)", sortie)
+		self.assertEqual(self.restants(), [])
+		self.assertEqual([e['id'] for e in self.lit_archive()][:3],
+				[original.pk] + [doublon.pk for doublon in doublons])
+
+	def test_contenu(self):
+		donnees = json.dumps({'codeCandidat': 1}).encode('utf-8') * 10
+		message = self.message(self.recent, contenu=donnees)
+		message = ParcoursupMessageRecuLog.objects.get(pk=message.pk)
+		self.assertTrue(message.payload_compresse)
+		self.assertLess(len(message.payload), len(donnees))
+		self.assertEqual(message.contenu, donnees)
+
+		message.contenu = None
+		message.save()
+		message = ParcoursupMessageRecuLog.objects.get(pk=message.pk)
+		self.assertFalse(message.payload_compresse)
+		self.assertIsNone(message.contenu)
+
+		# Messages enregistrés avant la compression des données
+		ParcoursupMessageRecuLog.objects.filter(pk=message.pk).update(
+				payload=donnees)
+		message = ParcoursupMessageRecuLog.objects.get(pk=message.pk)
+		self.assertEqual(message.contenu, donnees)
+
+class ExportOdsTest(TestCase):
+	TABLE = '{urn:oasis:names:tc:opendocument:xmlns:table:1.0}'
+	TEXTE = '{urn:oasis:names:tc:opendocument:xmlns:text:1.0}'
+
+	def setUp(self):
+		self.mpsi = Classe.objects.create(nom="MPSI", slug='mpsi',
+				code_parcoursup=1234, groupe_parcoursup=1, capacite=48)
+		for code, nom in ((1, "DUPONT"), (2, "ÉLOI & FILS")):
+			etudiant = Etudiant.objects.create(dossier_parcoursup=code,
+					nom=nom, prenom="Prénom", date_naissance=date(2001, 7, 14))
+			etudiant.nouvelle_proposition(Proposition(classe=self.mpsi,
+				etudiant=etudiant, date_proposition=date_paris(2019, 5, 20),
+				internat=code == 2, cesure=False, etat=Proposition.ETAT_OUI))
+
+	def lignes(self, feuille):
+		return [[''.join(cellule.itertext())
+			for cellule in ligne.iter(self.TABLE + 'table-cell')]
+			for ligne in feuille.iter(self.TABLE + 'table-row')]
+
+	def test_archive(self):
+		fichier = io.BytesIO()
+		odf_liste.par_classe([self.mpsi], fichier)
+		donnees = fichier.getvalue()
+
+		# Entrée mimetype en tête, non compressée, sans descripteur de
+		# données ni champ supplémentaire : le type MIME commence à
+		# l'octet 38.
+		self.assertEqual(donnees[30:38], b'mimetype')
+		self.assertEqual(donnees[38:38 + len(odf_liste.MIMETYPE)],
+				odf_liste.MIMETYPE.encode('ascii'))
+
+		with zipfile.ZipFile(io.BytesIO(donnees)) as archive:
+			self.assertIsNone(archive.testzip())
+			mimetype = archive.infolist()[0]
+			self.assertEqual(mimetype.filename, 'mimetype')
+			self.assertEqual(mimetype.compress_type, zipfile.ZIP_STORED)
+			self.assertEqual(mimetype.flag_bits & 0x08, 0)
+			self.assertEqual(mimetype.extra, b'')
+			self.assertEqual(archive.read('mimetype'),
+					odf_liste.MIMETYPE.encode('ascii'))
+			self.assertEqual(archive.namelist(), ['mimetype',
+				'META-INF/manifest.xml', 'content.xml'])
+			contenu = ElementTree.fromstring(archive.read('content.xml'))
+
+		feuilles = list(contenu.iter(self.TABLE + 'table'))
+		self.assertEqual([feuille.get(self.TABLE + 'name')
+			for feuille in feuilles], ["MPSI", "Infirmerie"])
+		self.assertEqual(self.lignes(feuilles[0])[2:], [
+			['', "DUPONT", "Prénom", '2001-07-14', '',
+				"Oui définitif", '', '', ''],
+			['', "ÉLOI & FILS", "Prénom", '2001-07-14', "Interne",
+				"Oui définitif", '', '', ''],
+		])
+		self.assertEqual(self.lignes(feuilles[1])[2:], [
+			['', "DUPONT", "Prénom", "MPSI", '2001-07-14', ''],
+			['', "ÉLOI & FILS", "Prénom", "MPSI", '2001-07-14', "Interne"],
+		])
+
+class CacheExportsTest(SimpleTestCase):
+	def setUp(self):
+		self.dossier = tempfile.TemporaryDirectory()
+		self.addCleanup(self.dossier.cleanup)
+		self.cache = CacheExports(self.dossier.name, taille_max=25)
+
+	def fichiers(self, nature='classes'):
+		return sorted(os.listdir(os.path.join(self.dossier.name, nature)))
+
+	def ecrit(self, nature, version, donnees=b'0123456789'):
+		with self.cache.ecrit(nature, version,
+				lambda fichier: fichier.write(donnees)) as fichier:
+			return fichier.read()
+
+	def test_meme_version(self):
+		self.assertIsNone(self.cache.ouvre('classes', 3))
+		self.assertEqual(self.ecrit('classes', 3), b'0123456789')
+		with self.cache.ouvre('classes', 3) as fichier:
+			self.assertEqual(fichier.read(), b'0123456789')
+		self.assertIsNone(self.cache.ouvre('classes', 4))
+
+	def test_versions_precedentes(self):
+		self.ecrit('classes', 3)
+		self.ecrit('adresses', 3)
+		self.ecrit('classes', 5)
+		self.assertEqual(self.fichiers(), ['5'])
+		self.assertEqual(self.fichiers('adresses'), ['3'])
+
+	def test_purge(self):
+		"""
+		Les fichiers utilisés le moins récemment sont supprimés, sauf
+		celui qu'on vient d'enregistrer.
+		"""
+		self.cache.taille_max = 100
+		for i, nature in enumerate(('a', 'b', 'c')):
+			self.ecrit(nature, 1)
+			os.utime(self.cache.chemin(nature, 1), (1000 + i, 1000 + i))
+		# Le fichier le plus ancien est utilisé de nouveau.
+		self.cache.ouvre('a', 1).close()
+
+		self.cache.taille_max = 25
+		self.ecrit('d', 1, b'x' * 15)
+		self.assertEqual([nature for nature in 'abcd'
+			if self.cache.ouvre(nature, 1) is not None], ['a', 'd'])
+
+		# Le fichier à garder dépasse à lui seul la limite.
+		self.cache.taille_max = 5
+		self.cache.purge(garde=self.cache.chemin('a', 1))
+		self.assertEqual(self.fichiers('a'), ['1'])
+		self.assertEqual(self.fichiers('d'), [])
+
+	def test_flux(self):
+		flux = self.cache.ecrit_flux('classes', 2, iter([b'abc', b'def']))
+		self.assertEqual(b''.join(flux), b'abcdef')
+		self.assertEqual(self.fichiers(), ['2'])
+
+	def test_flux_abandonne(self):
+		"""
+		L'export n'est pas conservé, et le fichier temporaire est
+		supprimé, si le flux est abandonné en cours de route.
+		"""
+		flux = self.cache.ecrit_flux('classes', 2, iter([b'abc', b'def']))
+		self.assertEqual(next(flux), b'abc')
+		self.assertEqual(len(self.fichiers()), 1)
+		self.assertTrue(self.fichiers()[0].startswith('.'))
+		flux.close()
+		self.assertEqual(self.fichiers(), [])
+
+		def morceaux():
+			yield b'abc'
+			raise ValueError
+		with self.assertRaises(ValueError):
+			list(self.cache.ecrit_flux('classes', 2, morceaux()))
+		self.assertEqual(self.fichiers(), [])
+		self.assertIsNone(self.cache.ouvre('classes', 2))
+
+	def test_temporaires_abandonnes(self):
+		"""
+		Les fichiers temporaires laissés par un processus interrompu
+		pendant un export sont supprimés par la purge.
+		"""
+		flux = self.cache.ecrit_flux('classes', 2, iter([b'abc', b'def']))
+		next(flux)
+		temporaire = os.path.join(self.dossier.name, 'classes',
+				self.fichiers()[0])
+		self.cache.purge()
+		self.assertTrue(os.path.exists(temporaire))
+
+		ancien = time.time() - CacheExports.DELAI_TEMPORAIRES - 1
+		os.utime(temporaire, (ancien, ancien))
+		self.ecrit('classes', 1)
+		self.assertEqual(self.fichiers(), ['1'])
+
+class VersionDonneesTest(TransactionTestCase):
+	"""
+	VersionDonnees.incremente n'agit qu'à la validation de la
+	transaction : ces tests ne peuvent pas s'exécuter dans la
+	transaction de TestCase.
+	"""
+	def test_signaux(self):
+		version = VersionDonnees.actuelle()
+		classe = Classe.objects.create(nom="MPSI", slug='mpsi',
+				code_parcoursup=1234, groupe_parcoursup=1, capacite=48)
+		self.assertEqual(VersionDonnees.actuelle(), version + 1)
+
+		with transaction.atomic():
+			etudiant = Etudiant.objects.create(dossier_parcoursup=1,
+					nom="NOM", prenom="Prénom")
+			etudiant.nouvelle_proposition(Proposition(classe=classe,
+				etudiant=etudiant, date_proposition=date_paris(2019, 5, 20),
+				internat=False, cesure=False, etat=Proposition.ETAT_OUI))
+			self.assertEqual(VersionDonnees.actuelle(), version + 1)
+		self.assertGreater(VersionDonnees.actuelle(), version + 1)
+
+		# Modification annulée
+		version = VersionDonnees.actuelle()
+		with transaction.atomic():
+			etudiant.nom = "AUTRE"
+			etudiant.save()
+			transaction.set_rollback(True)
+		self.assertEqual(VersionDonnees.actuelle(), version)
+
+		# Modification en masse
+		Etudiant.objects.demission_lot(Etudiant.objects.all(),
+				date_paris(2019, 6, 1))
+		self.assertGreater(VersionDonnees.actuelle(), version)
+
+		version = VersionDonnees.actuelle()
+		Action.objects.all().delete()
+		self.assertGreater(VersionDonnees.actuelle(), version)
+
+	def test_cache_exports(self):
+		"""
+		Un export enregistré dans le cache n'est plus servi une fois les
+		données modifiées.
+		"""
+		dossier = tempfile.TemporaryDirectory()
+		self.addCleanup(dossier.cleanup)
+		cache = CacheExports(dossier.name)
+		cache.ecrit('classes', VersionDonnees.actuelle(),
+				lambda fichier: fichier.write(b'export')).close()
+		with cache.ouvre('classes', VersionDonnees.actuelle()) as fichier:
+			self.assertEqual(fichier.read(), b'export')
+
+		Classe.objects.create(nom="MPSI", slug='mpsi',
+				code_parcoursup=1234, groupe_parcoursup=1, capacite=48)
+		self.assertIsNone(cache.ouvre('classes', VersionDonnees.actuelle()))
+
+class ExportsArrierePlanTest(TestCase):
+	def setUp(self):
+		dossier = tempfile.TemporaryDirectory()
+		self.addCleanup(dossier.cleanup)
+		reglages = override_settings(PARCOURSUP_EXPORTS_ARRIERE_PLAN=True,
+				PARCOURSUP_EXPORTS_CACHE=None,
+				PARCOURSUP_EXPORTS_TACHES=dossier.name)
+		reglages.enable()
+		self.addCleanup(reglages.disable)
+
+		classe = Classe.objects.create(nom="MPSI", slug='mpsi',
+				code_parcoursup=1234, groupe_parcoursup=1, capacite=48)
+		etudiant = Etudiant.objects.create(dossier_parcoursup=1,
+				nom="DUPONT", prenom="Prénom")
+		etudiant.nouvelle_proposition(Proposition(classe=classe,
+			etudiant=etudiant, date_proposition=date_paris(2019, 5, 20),
+			internat=False, cesure=False, etat=Proposition.ETAT_OUI))
+		self.client.force_login(User.objects.create_user('secretariat'))
+
+	def test_demande_et_telechargement(self):
+		reponse = self.client.get(reverse('classes.odf'))
+		self.assertRedirects(reponse, reverse('export.liste'))
+		self.client.get(reverse('classes.odf'))
+		tache = TacheExport.objects.get()
+		self.assertEqual(tache.etat, TacheExport.ETAT_EN_ATTENTE)
+		self.assertTrue(self.client.get(reverse('export.liste')
+			).context['en_cours'])
+		self.assertEqual(self.client.get(reverse('export.telecharge',
+			args=[tache.pk])).status_code, 404)
+
+		self.assertEqual(traite_file_exports(), tache)
+		self.assertIsNone(traite_file_exports())
+		tache.refresh_from_db()
+		self.assertEqual(tache.etat, TacheExport.ETAT_TERMINE)
+		self.assertEqual(tache.version, VersionDonnees.actuelle())
+		self.assertIsNotNone(tache.date_fin)
+
+		reponse = self.client.get(reverse('export.telecharge',
+			args=[tache.pk]))
+		with zipfile.ZipFile(io.BytesIO(b''.join(
+				reponse.streaming_content))) as archive:
+			self.assertIn(b'DUPONT', archive.read('content.xml'))
+		self.assertFalse(self.client.get(reverse('export.liste')
+			).context['en_cours'])
+
+		# Une fois l'export terminé, une nouvelle demande est enregistrée.
+		self.assertNotEqual(demande_export(TacheExport.NATURE_CLASSES), tache)
+
+	def test_echec(self):
+		tache = demande_export(TacheExport.NATURE_CLASSES)
+		with mock.patch('parcoursup.exports.par_classe',
+				side_effect=ValueError("erreur")), \
+				self.assertLogs('parcoursup.exports', 'ERROR'):
+			traite_file_exports()
+		tache.refresh_from_db()
+		self.assertEqual(tache.etat, TacheExport.ETAT_ECHEC)
+		self.assertEqual(tache.message, "erreur")
+		self.assertFalse(os.path.exists(tache.chemin()))
+		self.assertEqual(os.listdir(settings.PARCOURSUP_EXPORTS_TACHES), [])
+
+	@override_settings(PARCOURSUP_EXPORTS_TACHES_DUREE_MAX=30)
+	def test_export_interrompu(self):
+		"""
+		Un export resté en cours trop longtemps (processus arrêté) ne
+		bloque pas les nouvelles demandes.
+		"""
+		tache = demande_export(TacheExport.NATURE_CLASSES)
+		TacheExport.objects.filter(pk=tache.pk).update(
+				etat=TacheExport.ETAT_EN_COURS,
+				date_debut=timezone.now() - timedelta(minutes=20))
+		self.assertEqual(demande_export(TacheExport.NATURE_CLASSES), tache)
+
+		TacheExport.objects.filter(pk=tache.pk).update(
+				date_debut=timezone.now() - timedelta(minutes=40))
+		nouvelle = demande_export(TacheExport.NATURE_CLASSES)
+		self.assertNotEqual(nouvelle, tache)
+		tache.refresh_from_db()
+		self.assertEqual(tache.etat, TacheExport.ETAT_ECHEC)
+		self.assertIsNotNone(tache.date_fin)
+
+		self.assertEqual(traite_file_exports(), nouvelle)
+		nouvelle.refresh_from_db()
+		self.assertEqual(nouvelle.etat, TacheExport.ETAT_TERMINE)
+
+class PdfAdressesTest(SimpleTestCase):
+	"""
+	Le PDF assemblé à partir des rendus de plusieurs processus doit
+	avoir la même structure et le même texte que celui produit dans un
+	seul processus.
+	"""
+	def rendu(self, fonction, etudiants, processus):
+		tampon = io.BytesIO()
+		fonction(etudiants, tampon, processus=processus)
+		return tampon.getvalue()
+
+	def textes(self, document):
+		if pypdf is None:
+			return None
+		lecteur = pypdf.PdfReader(io.BytesIO(document), strict=True)
+		return [page.extract_text() for page in lecteur.pages]
+
+	def test_processus(self):
+		etudiants = [EtudiantFictif(i) for i in range(40)]
+		for fonction, nb_pages in ((pdf_adresses, 40),
+				(pdf_etiquettes_adresses, 3)):
+			with self.subTest(fonction=fonction.__name__):
+				seul = self.rendu(fonction, etudiants, 1)
+				with mock.patch.object(pdf_adresses_module, 'logger') as logger:
+					parallele = self.rendu(fonction, etudiants, 3)
+				logger.warning.assert_not_called()
+				self.assertNotEqual(parallele, seul)
+				self.assertEqual(pdf_adresses_module._verifie(seul), nb_pages)
+				# _verifie contrôle aussi les positions de la table xref.
+				self.assertEqual(pdf_adresses_module._verifie(parallele),
+						nb_pages)
+				self.assertEqual(self.textes(parallele), self.textes(seul))
+				if pypdf is not None:
+					self.assertIn("M. Prénom39 NOM39",
+							self.textes(parallele)[-1])
+
+	def test_assemblage_impossible(self):
+		"""
+		Si l'assemblage échoue, le PDF est produit dans un seul
+		processus.
+		"""
+		etudiants = [EtudiantFictif(i) for i in range(10)]
+		for erreur in (AttributeError, IndexError, KeyError, TypeError,
+				ValueError):
+			with self.subTest(erreur=erreur), \
+					mock.patch.object(pdf_adresses_module, '_concatene',
+						side_effect=erreur), \
+					self.assertLogs('parcoursup.pdf_adresses', 'WARNING'):
+				document = self.rendu(pdf_adresses, etudiants, 2)
+			self.assertEqual(pdf_adresses_module._verifie(document), 10)
+
+		with self.assertRaises(ValueError):
+			pdf_adresses_module._verifie(document.replace(b'2 0 obj',
+				b'2  0 obj'))
@@ -0,0 +1,85 @@
+#!env python
+# -*- coding: utf-8 -*-
+
+"""
+Compare la durée d'analyse des dates de Parcoursup avec les fonctions
+de parcoursup.utils et avec les anciennes méthodes, qui utilisaient
+datetime.strptime (en changeant la locale pour les noms des mois en
+français).
+
+Les anciennes méthodes servent aussi de référence aux tests de
+parcoursup.tests.
+
+À lancer depuis la racine du projet :
+
+	python -m parcoursup.tools.bench_dates [nombre de répétitions]
+"""
+
+import datetime
+import locale
+import sys
+import timeit
+
+from dateutil.tz import gettz
+
+from parcoursup.utils import parse_date_francaise, parse_datetime
+
+DATES_FRANCAISES = ['12 juin 2019 14:30', '3 janv. 2019 08:05',
+		'28 août 2019 23:59', '1 déc. 2019 00:00']
+DATES_NUMERIQUES = ['12/06/2019 14:30', '03/01/2019 08:05',
+		'28/08/2019 23:59', '01/12/2019 00:00']
+
+def ancienne_date_francaise(texte):
+	paris_tz = gettz('Europe/Paris')
+	old_loc = locale.getlocale(locale.LC_TIME)
+	locale.setlocale(locale.LC_TIME, 'fr_FR.UTF-8')
+	try:
+		date = datetime.datetime.strptime(texte,
+				"%d %B %Y %H:%M").replace(tzinfo=paris_tz)
+	except ValueError:
+		try:
+			date = datetime.datetime.strptime(texte,
+					"%d %b %Y %H:%M").replace(tzinfo=paris_tz)
+		except ValueError:
+			date = None
+	locale.setlocale(locale.LC_TIME, old_loc)
+	return date
+
+def ancienne_date_numerique(texte):
+	paris_tz = gettz('Europe/Paris')
+	return datetime.datetime.strptime(texte,
+			"%d/%m/%Y %H:%M").replace(tzinfo=paris_tz)
+
+def mesure(fonction, dates, repetitions):
+	duree = min(timeit.repeat(lambda: [fonction(d) for d in dates],
+		number=repetitions, repeat=3))
+	return duree / (repetitions * len(dates)) * 1e6
+
+def affiche(libelle, ancienne, nouvelle):
+	if ancienne is None:
+		print("{:<22} {:>12} {:>12.2f}".format(libelle, "indisponible",
+			nouvelle))
+	else:
+		print("{:<22} {:>12.2f} {:>12.2f}  (x{:.1f})".format(libelle,
+			ancienne, nouvelle, ancienne / nouvelle))
+
+if __name__ == '__main__':
+	repetitions = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+
+	try:
+		ancienne = mesure(ancienne_date_francaise, DATES_FRANCAISES,
+				repetitions)
+		if [ancienne_date_francaise(d) for d in DATES_FRANCAISES] != \
+				[parse_date_francaise(d) for d in DATES_FRANCAISES]:
+			print("Attention : résultats différents pour les dates en français")
+	except locale.Error:
+		# La locale fr_FR.UTF-8 n'est pas installée sur ce système
+		ancienne = None
+
+	print("{:<22} {:>12} {:>12}".format("Format (µs par date)", "Ancienne",
+		"Nouvelle"))
+	affiche("JJ mois AAAA HH:MM", ancienne,
+			mesure(parse_date_francaise, DATES_FRANCAISES, repetitions))
+	affiche("JJ/MM/AAAA HH:MM",
+			mesure(ancienne_date_numerique, DATES_NUMERIQUES, repetitions),
+			mesure(parse_datetime, DATES_NUMERIQUES, repetitions))
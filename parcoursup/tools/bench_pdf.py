@@ -0,0 +1,77 @@
+#!env python
+# -*- coding: utf-8 -*-
+
+"""
+Mesure la durée de production des PDF d'adresses (une page par
+étudiant) et des planches d'étiquettes pour des étudiants fictifs, en
+un seul processus puis en répartissant les pages entre plusieurs
+processus.
+
+À lancer depuis la racine du projet :
+
+	python -m parcoursup.tools.bench_pdf [nombre d'étudiants] [processus...]
+
+Par défaut, les mesures sont faites avec 1, 2, 4... processus jusqu'au
+nombre de cœurs de la machine.
+"""
+
+import io
+import os
+import re
+import sys
+import time
+
+from parcoursup.pdf_adresses import NB_COLONNES, NB_LIGNES, \
+		pdf_adresses, pdf_etiquettes_adresses
+
+class EtudiantFictif:
+	def __init__(self, numero):
+		self.nom = "NOM{}".format(numero)
+		self.prenom = "Prénom{}".format(numero)
+		self.adresse = "{} rue de la République\nBâtiment {}\n" \
+				"69001 LYON".format(numero % 200 + 1, numero % 7 + 1)
+
+	def civilite(self):
+		return "M."
+
+	def __str__(self):
+		return "{} {}".format(self.prenom, self.nom)
+
+def mesure(fonction, etudiants, processus):
+	tampon = io.BytesIO()
+	debut = time.perf_counter()
+	fonction(etudiants, tampon, processus=processus)
+	duree = time.perf_counter() - debut
+	return duree, len(re.findall(rb'/Type /Page\n', tampon.getvalue()))
+
+if __name__ == '__main__':
+	nb_etudiants = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+	etudiants = [EtudiantFictif(i) for i in range(nb_etudiants)]
+
+	nb_coeurs = os.cpu_count() or 1
+	if len(sys.argv) > 2:
+		liste_processus = [int(n) for n in sys.argv[2:]]
+	else:
+		liste_processus = [1]
+		while liste_processus[-1] * 2 <= nb_coeurs:
+			liste_processus.append(liste_processus[-1] * 2)
+		if liste_processus[-1] != nb_coeurs:
+			liste_processus.append(nb_coeurs)
+
+	print("{} étudiants, {} cœur(s)".format(nb_etudiants, nb_coeurs))
+	for libelle, fonction, pages in (
+			("Adresses", pdf_adresses, nb_etudiants),
+			("Étiquettes", pdf_etiquettes_adresses,
+				-(-nb_etudiants // (NB_LIGNES * NB_COLONNES)))):
+		print("\n{:<12} {:>10} {:>10} {:>8}".format(libelle, "Processus",
+			"Durée (s)", "Gain"))
+		reference = None
+		for processus in liste_processus:
+			duree, nb_pages = mesure(fonction, etudiants, processus)
+			if reference is None:
+				reference = duree
+			print("{:<12} {:>10} {:>10.2f} {:>7.1f}x".format("", processus,
+				duree, reference / duree))
+			if nb_pages != pages:
+				print("Attention : {} pages au lieu de {}".format(nb_pages,
+					pages))
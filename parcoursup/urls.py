@@ -44,6 +44,8 @@ urlpatterns = [
 	path('action/pdf_adresses/', views.export_pdf_adresses, name='action.export_pdf_adresses'),
 	path('action/pdf_adresses/etiquettes', views.export_etiquettes_adresses, name='action.export_pdf_etiquettes_adresses'),
 	path('action/pdf_adresses/definitif', views.export_pdf_adresses_definitif, name='action.export_pdf_adresses_definitif'),
+	path('export/', views.ExportListView.as_view(), name='export.liste'),
+	path('export/<int:pk>/telecharger', views.export_telecharge, name='export.telecharge'),
 
 	path('parcoursup/', include(rest_parcoursup_urlpatterns)),
 ]
@@ -16,7 +16,10 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import codecs
 import datetime
+import hashlib
+import json
 import re
 from dateutil.tz import gettz
 
@@ -41,15 +44,193 @@ def format_adresse_pays(**parts):
 		res = autre.format(**parts)
 	return re.sub(r'\n+', '\n', res)
 
+# Les heures de Parcoursup sont à l'heure légale française. Le fuseau
+# horaire est chargé une fois pour toutes.
+PARIS_TZ = gettz('Europe/Paris')
+
+# Comme le faisait datetime.strptime, on accepte plusieurs espaces entre
+# la date et l'heure, mais rien après les minutes (pas même un retour à
+# la ligne, d'où \Z au lieu de $).
+datetime_re = re.compile(r'(?P<day>\d{1,2})/(?P<month>\d{1,2})/(?P<year>\d{4})\s+(?P<hour>\d{1,2}):(?P<minute>\d{1,2})\Z')
 def parse_datetime(date):
 	"""
 	Renvoie un objet datetime.datetime à partir d'une chaine au format
 	"JJ/MM/AAAA HH:MM". Le fuseau horaire est fixé comme étant celui de
 	Paris.
 
+	Lève l'exception ValueError si la chaine ne respecte pas ce format.
+
 	Franchement, Parcoursup, vous devriez savoir qu'il existe une norme
 	ISO pour les dates et heures, cela nous éviterait toutes ces
 	bizarreries.
 	"""
-	paris_tz = gettz('Europe/Paris')
-	return datetime.datetime.strptime(date, "%d/%m/%Y %H:%M").replace(tzinfo=paris_tz)
+	match = datetime_re.match(date)
+	if not match:
+		raise ValueError("Date et heure invalides : {}".format(date))
+	kw = {k: int(v) for k, v in match.groupdict().items()}
+	return datetime.datetime(tzinfo=PARIS_TZ, **kw)
+
+# Numéros des mois d'après leurs noms en français, complets ou abrégés
+# (tels que les écrit la locale fr_FR), avec ou sans accents.
+MOIS_FRANCAIS = {}
+for numero, noms in enumerate((
+		('janvier', 'janv'),
+		('février', 'févr', 'fevrier', 'fevr'),
+		('mars',),
+		('avril', 'avr'),
+		('mai',),
+		('juin',),
+		('juillet', 'juil'),
+		('août', 'aout'),
+		('septembre', 'sept'),
+		('octobre', 'oct'),
+		('novembre', 'nov'),
+		('décembre', 'déc', 'decembre', 'dec'),
+	), start=1):
+	for nom in noms:
+		MOIS_FRANCAIS[nom] = numero
+
+date_francaise_re = re.compile(r'\s*(?P<day>\d{1,2})\s+(?P<month>[^\W\d_]+)\.?'
+	r'(?:\s+(?P<year>\d{4})\s+(?P<hour>\d{1,2}):(?P<minute>\d{1,2}))?\s*$')
+def parse_date_francaise(date, annee=None):
+	"""
+	Renvoie un objet datetime.datetime à partir d'une chaine de la
+	forme "12 juin 2019 14:30", où le mois est écrit en français en
+	toutes lettres ou abrégé ("12 janv. 2019 14:30"). Le fuseau horaire
+	est fixé comme étant celui de Paris.
+
+	Si le paramètre annee est donné, on accepte aussi les chaines de la
+	forme "12 juin", qui sont alors datées de cette année, à minuit.
+
+	Renvoie None si la chaine ne correspond à aucun de ces formats.
+
+	Contrairement à datetime.strptime, cette fonction ne dépend pas de
+	la locale du processus, et peut donc être utilisée depuis plusieurs
+	threads.
+	"""
+	match = date_francaise_re.match(date)
+	if not match:
+		return None
+
+	mois = MOIS_FRANCAIS.get(match.group('month').lower())
+	if mois is None:
+		return None
+
+	if match.group('year'):
+		kw = {k: int(match.group(k)) for k in ('year', 'hour', 'minute')}
+	elif annee is not None:
+		kw = {'year': annee}
+	else:
+		return None
+
+	try:
+		return datetime.datetime(day=int(match.group('day')), month=mois,
+				tzinfo=PARIS_TZ, **kw)
+	except ValueError:
+		return None
+
+def par_paquets(iterable, taille):
+	"""
+	Découpe un itérable en listes successives d'au plus taille
+	éléments.
+	"""
+	paquet = []
+	for element in iterable:
+		paquet.append(element)
+		if len(paquet) >= taille:
+			yield paquet
+			paquet = []
+	if paquet:
+		yield paquet
+
+def empreinte_json(donnees):
+	"""
+	Calcule une empreinte (SHA-256 en hexadécimal) de données JSON. Les
+	données sont normalisées au préalable : les clés sont mises en
+	minuscules (Parcoursup n'est pas constant sur la casse) et triées.
+	"""
+	normalise = {str(cle).lower(): valeur for cle, valeur in donnees.items()}
+	texte = json.dumps(normalise, sort_keys=True, separators=(',', ':'),
+			ensure_ascii=False)
+	return hashlib.sha256(texte.encode('utf-8')).hexdigest()
+
+blancs_json_re = re.compile(r'[ \t\n\r]*')
+def iter_tableau_json(morceaux, encodage='utf-8'):
+	"""
+	Décode au fil de l'eau un tableau JSON reçu par morceaux d'octets
+	(par exemple avec Response.iter_content() du module requests) et
+	renvoie un à un ses éléments, sans jamais conserver en mémoire plus
+	que l'élément en cours de lecture.
+
+	Lève l'exception ValueError si les données ne forment pas un
+	tableau JSON.
+	"""
+	morceaux = iter(morceaux)
+	decodeur_texte = codecs.getincrementaldecoder(encodage)()
+	decodeur_json = json.JSONDecoder()
+	tampon = ''
+	position = 0
+	epuise = False
+
+	# Ce que l'on attend ensuite dans le tableau : son ouverture, un
+	# élément (ou la fin du tableau s'il est vide) ou bien un séparateur
+	# (ou la fin du tableau).
+	ATTENTE_OUVERTURE, ATTENTE_ELEMENT, ATTENTE_SEPARATEUR = range(3)
+	attente = ATTENTE_OUVERTURE
+	premier = True
+
+	while True:
+		position = blancs_json_re.match(tampon, position).end()
+
+		# On lit la suite des données quand le tampon est vide ou quand
+		# l'élément qu'il contient est incomplet.
+		besoin_suite = position == len(tampon)
+		if not besoin_suite and attente == ATTENTE_ELEMENT and \
+				not (premier and tampon[position] == ']'):
+			try:
+				element, fin = decodeur_json.raw_decode(tampon, position)
+				# Un nombre peut être coupé entre deux morceaux, y
+				# compris juste après son point ou son exposant ("12."
+				# puis "5"), et le décodeur s'arrête alors avant la
+				# coupure. Avant la fin des données, on n'accepte donc
+				# pas un élément suivi d'un caractère qui pourrait
+				# prolonger un nombre, ni un élément en fin de tampon.
+				besoin_suite = not epuise and (fin == len(tampon) or
+						tampon[fin] in '0123456789+-.eE')
+			except json.JSONDecodeError:
+				if epuise:
+					raise
+				besoin_suite = True
+
+		if besoin_suite:
+			if epuise:
+				raise ValueError("Tableau JSON incomplet")
+			try:
+				texte = decodeur_texte.decode(next(morceaux))
+			except StopIteration:
+				texte = decodeur_texte.decode(b'', final=True)
+				epuise = True
+			tampon = tampon[position:] + texte
+			position = 0
+			continue
+
+		caractere = tampon[position]
+		if attente == ATTENTE_OUVERTURE:
+			if caractere != '[':
+				raise ValueError("Les données ne sont pas un tableau JSON")
+			position += 1
+			attente = ATTENTE_ELEMENT
+		elif attente == ATTENTE_ELEMENT:
+			if premier and caractere == ']':
+				return
+			position = fin
+			premier = False
+			attente = ATTENTE_SEPARATEUR
+			yield element
+		else:
+			if caractere == ']':
+				return
+			if caractere != ',':
+				raise ValueError("Séparateur attendu dans le tableau JSON")
+			position += 1
+			attente = ATTENTE_ELEMENT
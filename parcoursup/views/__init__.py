@@ -21,20 +21,22 @@ from __future__ import unicode_literals
 import datetime
 
 from django.shortcuts import render, get_object_or_404, redirect
-from django.http import HttpResponse
+from django.conf import settings
+from django.http import HttpResponse, StreamingHttpResponse, FileResponse, \
+        Http404
 from django.views import generic
 from django.urls import reverse
-from django.db.models import Count, Q, F
+from django.db.models import Count, F
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.views.decorators.http import require_POST
 
 from parcoursup.models import Classe, Etudiant, Action, Proposition, \
-        ParcoursupSynchro
+        ParcoursupSynchro, TacheExport, VersionDonnees
+from parcoursup.cache_exports import CacheExports
+from parcoursup.exports import EXPORTS, demande_export
 from parcoursup.forms import PropositionForm, ParcoursupImportForm
-from parcoursup.pdf_adresses import pdf_adresses, \
-	pdf_etiquettes_adresses
-from parcoursup.odf_liste import par_classe as odf_par_classe
+from parcoursup.pdf_adresses import pdf_adresses
 from parcoursup.parcoursup_rest import auto_import_rest, \
 		ParcoursupRest, ParcoursupCandidat
 
@@ -42,21 +44,13 @@ from . import parcoursup
 
 @login_required
 def index(request):
-    classe_list = Classe.objects.all().annotate(
-            num_admis=Count('proposition',
-                filter=Q(proposition__date_demission__isnull=True,
-                    proposition__remplacee_par__isnull=True)))
-    props_internat = Proposition.objects.filter(
-            remplacee_par__isnull=True,
-            date_demission__isnull=True,
-            internat=True
-            )
-
-    num_internat = props_internat.count()
-    num_internat_oui = \
-            props_internat.filter(etat=Proposition.ETAT_OUI).count()
-    num_internat_ouimais = \
-            props_internat.filter(etat=Proposition.ETAT_OUIMAIS).count()
+    # Les effectifs sont lus dans les compteurs de chaque classe, tenus
+    # à jour à chaque modification des propositions.
+    classe_list = list(Classe.objects.all())
+    num_internat_oui = sum(classe.nb_internat_oui for classe in classe_list)
+    num_internat_ouimais = sum(classe.nb_internat_ouimais
+            for classe in classe_list)
+    num_internat = num_internat_oui + num_internat_ouimais
 
     synchro_list = ParcoursupSynchro.objects.all().order_by('-date_debut')[:5].annotate(duree=F('date_fin')
             - F('date_debut'))
@@ -74,8 +68,7 @@ class ClasseDetailView(LoginRequiredMixin, generic.DetailView):
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        classe = self.get_object()
-        context['etudiant_list'] = classe.admissions().order_by('nom')
+        context['etudiant_list'] = self.object.admissions().order_by('nom')
         return context
 
 class EtudiantDetailView(LoginRequiredMixin, generic.DetailView):
@@ -112,7 +105,8 @@ def etudiant_demission(request, pk):
 class ActionTodoListView(LoginRequiredMixin, generic.ListView):
     queryset = Action.objects.filter(
             etat = Action.ETAT_TODO).order_by('proposition__etat',
-                    'proposition__etudiant__nom')
+                    'proposition__etudiant__nom').select_related(
+                            'proposition__classe', 'proposition__etudiant')
 
 class ActionDetailView(LoginRequiredMixin, generic.DetailView):
     model = Action
@@ -173,30 +167,54 @@ def parcoursup_auto_import(request):
     auto_import_rest()
     return redirect('index')
 
-@login_required
-def export_pdf_adresses(request):
-    etudiants = Etudiant.objects.filter(
-            proposition__action__etat=Action.ETAT_TODO,
-            proposition__action__categorie__in=(Action.ENVOI_DOSSIER,
-                Action.ENVOI_DOSSIER_INTERNAT)).order_by('nom')
-    response = HttpResponse(content_type='application/pdf')
-    response['Content-Disposition'] = 'attachment; filename="adresses_parcoursup.pdf"'
-    pdf_adresses(etudiants, response)
+def export_en_cache(request, nature):
+    """
+    Réponse qui contient l'export désigné par nature (voir
+    parcoursup.exports), lu dans le cache des exports s'il a déjà été
+    produit pour la version actuelle des données.
+
+    Sinon, lorsque PARCOURSUP_EXPORTS_ARRIERE_PLAN est activé, l'export
+    est demandé à la commande traite_exports et l'utilisateur est
+    redirigé vers la page des exports. Dans le cas contraire, il est
+    produit immédiatement (au fil de l'eau s'il le permet).
+    """
+    export = EXPORTS[nature]
+    cache = CacheExports()
+    version = VersionDonnees.actuelle()
+    fichier = cache.ouvre(nature, version) if cache.actif else None
+    if fichier is not None:
+        return FileResponse(fichier, as_attachment=True,
+                filename=export.nom_fichier, content_type=export.content_type)
+
+    if getattr(settings, 'PARCOURSUP_EXPORTS_ARRIERE_PLAN', False):
+        demande_export(nature, request.user)
+        return redirect('export.liste')
+
+    if export.flux is not None:
+        flux = export.flux()
+        if cache.actif:
+            flux = cache.ecrit_flux(nature, version, flux)
+        response = StreamingHttpResponse(flux,
+                content_type=export.content_type)
+    elif cache.actif:
+        return FileResponse(cache.ecrit(nature, version, export.ecrit),
+                as_attachment=True, filename=export.nom_fichier,
+                content_type=export.content_type)
+    else:
+        response = HttpResponse(content_type=export.content_type)
+        export.ecrit(response)
 
+    response['Content-Disposition'] = \
+            'attachment; filename="{}"'.format(export.nom_fichier)
     return response
 
 @login_required
-def export_pdf_adresses_definitif(request):
-    etudiants = Etudiant.objects.filter(
-            proposition__etat=Proposition.ETAT_OUI,
-            proposition__action__etat=Action.ETAT_TODO,
-            proposition__action__categorie__in=(Action.ENVOI_DOSSIER,
-                Action.ENVOI_DOSSIER_INTERNAT))
-    response = HttpResponse(content_type='application/pdf')
-    response['Content-Disposition'] = 'attachment; filename="adresses_parcoursup.pdf"'
-    pdf_adresses(etudiants, response)
+def export_pdf_adresses(request):
+    return export_en_cache(request, TacheExport.NATURE_ADRESSES)
 
-    return response
+@login_required
+def export_pdf_adresses_definitif(request):
+    return export_en_cache(request, TacheExport.NATURE_ADRESSES_DEFINITIF)
 
 @login_required
 def export_pdf_adresse_etudiant(request, pk):
@@ -209,16 +227,32 @@ def export_pdf_adresse_etudiant(request, pk):
 
 @login_required
 def export_etiquettes_adresses(request):
-    etudiants = Etudiant.objects.filter(
-            proposition__etat=Proposition.ETAT_OUI,
-            proposition__action__etat=Action.ETAT_TODO,
-            proposition__action__categorie__in=(Action.ENVOI_DOSSIER,
-                Action.ENVOI_DOSSIER_INTERNAT))
-    response = HttpResponse(content_type='application/pdf')
-    response['Content-Disposition'] = 'attachment; filename="etiquettes_adresses_parcoursup.pdf"'
-    pdf_etiquettes_adresses(etudiants, response)
+    return export_en_cache(request, TacheExport.NATURE_ETIQUETTES)
 
-    return response
+class ExportListView(LoginRequiredMixin, generic.ListView):
+    queryset = TacheExport.objects.order_by('-date_demande')[:20]
+    template_name = 'parcoursup/export_list.html'
+
+    def get_context_data(self, **kwargs):
+        # Les exports interrompus ne doivent pas rester affichés en
+        # cours (la page serait rechargée indéfiniment).
+        TacheExport.abandonne_interrompues()
+        context = super().get_context_data(**kwargs)
+        context['en_cours'] = any(tache.en_cours()
+                for tache in context['object_list'])
+        return context
+
+@login_required
+def export_telecharge(request, pk):
+    tache = get_object_or_404(TacheExport, pk=pk,
+            etat=TacheExport.ETAT_TERMINE)
+    export = EXPORTS[tache.nature]
+    try:
+        fichier = open(tache.chemin(), 'rb')
+    except FileNotFoundError:
+        raise Http404("Le fichier de cet export a été supprimé")
+    return FileResponse(fichier, as_attachment=True,
+            filename=export.nom_fichier, content_type=export.content_type)
 
 @login_required
 def internat_detail(request):
@@ -249,10 +283,7 @@ def internat_detail(request):
 
 @login_required
 def export_odf_classes(request):
-    response = HttpResponse(content_type='application/vnd.oasis.opendocument.spreadsheet')
-    response['Content-Disposition'] = 'attachment; filename="liste_classes.ods"'
-    odf_par_classe(Classe.objects.all().order_by('nom'), response)
-    return response
+    return export_en_cache(request, TacheExport.NATURE_CLASSES)
 
 @login_required
 @require_POST
@@ -260,19 +291,19 @@ def etudiant_inscription(request, pk):
 	etudiant = get_object_or_404(Etudiant, pk=pk)
 	if etudiant.proposition_actuelle is not None:
 		psup = ParcoursupRest()
-		candidat = ParcoursupCandidat(code=etudiant.dossier_parcoursup,
-				nom=etudiant.nom,
-				prenom=etudiant.prenom,
-				date_naissance=etudiant.date_naissance,
-				ine=etudiant.ine)
+		candidat = ParcoursupCandidat.depuis_etudiant(etudiant)
 		req = psup.maj_inscription(candidat,
 				etudiant.proposition_actuelle.classe.code_parcoursup,
 				ParcoursupRest.INSCRIPTION_PRINCIPALE)
 
 		response = req.request.json()
 		if response['retour'] == 'OK':
-			etudiant.proposition_actuelle.inscription = True
-			etudiant.proposition_actuelle.save()
+			proposition = etudiant.proposition_actuelle
+			compteurs_avant = Classe.objects.compteurs([proposition])
+			proposition.inscription = True
+			proposition.save()
+			Classe.objects.ajuste_compteurs(compteurs_avant,
+					Classe.objects.compteurs([proposition]))
 
 		return redirect('classe.details',
 				slug=etudiant.proposition_actuelle.classe.slug)
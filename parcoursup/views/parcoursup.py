@@ -18,6 +18,8 @@
 
 import json
 
+from django.conf import settings
+from django.db import IntegrityError, transaction
 from django.http import JsonResponse
 from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_exempt
@@ -26,10 +28,8 @@ from django.utils import timezone
 
 import requests
 
-from parcoursup.models import ParcoursupUser, ParcoursupMessageRecuLog, \
-		Etudiant, Classe, Proposition
-import parcoursup.utils as utils
-from parcoursup.parcoursup_rest import ParcoursupRest
+from parcoursup.admission import TraitementAdmission
+from parcoursup.models import ParcoursupUser, ParcoursupMessageRecuLog
 
 class ParcoursupClientView(View):
 	"""
@@ -43,6 +43,10 @@ class ParcoursupClientView(View):
 	Le traitement de la requête elle-même est délégué à la méthode
 	self.parcoursup(), qui peut se servir notamment de l'attribut
 	self.json, qui contient les données JSON décodées.
+
+	Les données peuvent être un objet JSON ou un tableau d'objets JSON :
+	self.json est alors une liste. Dans ce cas, chaque objet doit
+	contenir les mêmes données d'identification.
 	"""
 	http_method_names = ['post']
 	endpoint = "undef"
@@ -55,12 +59,19 @@ class ParcoursupClientView(View):
 	def identification(self):
 		"""
 		Vérifie que la requête possède bien les données
-		d'identification.
+		d'identification. Un tableau dont les objets ne contiennent pas
+		tous les mêmes données d'identification est refusé.
 		"""
+		liste = self.json if isinstance(self.json, list) else [self.json]
 		try:
+			identifiants = {(donnees['identifiant']['login'],
+				donnees['identifiant']['pwd']) for donnees in liste}
+			if len(identifiants) != 1:
+				return False
+
+			login, pwd = identifiants.pop()
 			self.user = ParcoursupUser.objects.authenticate(
-				username=self.json['identifiant']['login'],
-				password=self.json['identifiant']['pwd'])
+				username=login, password=pwd)
 			return True
 		except:
 			return False
@@ -74,18 +85,31 @@ class ParcoursupClientView(View):
 
 		try:
 			psup_json = json.loads(self.request.body.decode('utf-8'))
-			self.json = requests.utils.CaseInsensitiveDict(data=psup_json)
-			return True
 		except (json.JSONDecodeError, UnicodeDecodeError):
 			return False
 
-	def json_response(self, ok, msg_log=None, message=None, status_code=None):
+		if isinstance(psup_json, dict):
+			self.json = requests.utils.CaseInsensitiveDict(data=psup_json)
+			return True
+
+		if isinstance(psup_json, list) and psup_json and \
+				all(isinstance(donnees, dict) for donnees in psup_json):
+			self.json = [requests.utils.CaseInsensitiveDict(data=donnees)
+					for donnees in psup_json]
+			return True
+
+		return False
+
+	def json_response(self, ok, msg_log=None, message=None, status_code=None,
+			donnees=None):
 		"""
 		Construction d'une réponse pour Parcoursup
+
+		Le dictionnaire donnees, s'il est donné, est ajouté aux données
+		de la réponse.
 		"""
-		data = {
-			'message': message
-		}
+		data = dict(donnees or {})
+		data['message'] = message
 
 		if ok:
 			data['retour'] = 'OK'
@@ -143,7 +167,7 @@ class ParcoursupClientView(View):
 		msg_log = ParcoursupMessageRecuLog(date=timezone.now(),
 				ip_source=self.get_ip_source(),
 				endpoint=self.endpoint,
-				payload=self.request.body)
+				contenu=self.request.body)
 
 		if not self.entree_json():
 			msg_log.succes = False
@@ -175,70 +199,130 @@ class AdmissionView(ParcoursupClientView):
 	endpoint = "admissionCandidat"
 
 	def parcoursup(self, msg_log=None):
+		if isinstance(self.json, list):
+			return self.parcoursup_lot(msg_log)
+
 		#donnees = self.json['donneesCandidat']
-		donnees = self.json
+		with transaction.atomic():
+			succes, message = self.admission(self.json, msg_log,
+					TraitementAdmission())
+		return self.json_response(succes, msg_log=msg_log, message=message,
+				status_code=None if succes else 400)
 
-		try:
-			adresse = ParcoursupRest.formate_adresse(donnees)
-		except:
-			adresse = '(Inconnue)'
-
-		etudiant, _ = Etudiant.objects.update_or_create(
-			dossier_parcoursup = donnees['codeCandidat'],
-			defaults={
-				'nom': donnees['nom'],
-				'prenom': donnees['prenom'],
-				'date_naissance': utils.parse_french_date(donnees['dateNaissance']),
-				'email': donnees.get('mail'),
-				'telephone': donnees.get('telfixe', ''),
-				'telephone_mobile': donnees.get('telmobile', ''),
-				'adresse': adresse,
-				'sexe': Etudiant.SEXE_HOMME if donnees['sexe'] == 'M' \
-						else Etudiant.SEXE_FEMME
-			})
+	def parcoursup_lot(self, msg_log):
+		"""
+		Traitement d'un tableau de messages d'admission
 
-		# On détermine la proposition à laquelle fait référence le
-		# message actuel.
-		classe = Classe.objects.get(code_parcoursup=donnees['codeFormationPsup'])
-		date_reponse = utils.parse_datetime(donnees['dateReponse'])
-		proposition = Proposition(
-			etudiant=etudiant,
-			classe=classe,
-			date_proposition=date_reponse,
-			cesure=donnees.get('cesure', '0') == '1',
-			internat=donnees.get('internat', '0') == '1',
-			inscription=donnees.get('etatInscription', '0') == '1',
-		)
-
-		# Le candidat n'a pas encore répondu
-		if donnees['codeSituation'] == '0':
-			# On n'enregistre dans la base de données que les candidats
-			# qui ont accepté la formation. Ce message provenant de
-			# Parcoursup est donc ignoré. La proposition sera
-			# enregistrée lorsque Parcoursup nous enverra la réponse
-			# positive.
-			pass
-
-		# Proposition acceptée définitivement
-		if donnees['codeSituation'] == '1':
-			proposition.etat = Proposition.ETAT_OUI
-			etudiant.nouvelle_proposition(proposition)
-
-		# Proposition acceptée avec autres vœux en attente
-		if donnees['codeSituation'] == '2':
-			proposition.etat = Proposition.ETAT_OUIMAIS
-			etudiant.nouvelle_proposition(proposition)
-
-		# Proposition refusée
-		if donnees['codeSituation'] == '3':
+		Les classes, communes et étudiants nécessaires sont recherchés
+		en une seule fois. Chaque message est ensuite traité dans son
+		propre point de sauvegarde, et enregistré dans une entrée
+		distincte du journal. La réponse indique le résultat de chaque
+		message, dans l'ordre du tableau reçu.
+		"""
+		traitement = TraitementAdmission()
+		traitement.precharge(self.json)
+
+		resultats = []
+		for donnees in self.json:
+			log = ParcoursupMessageRecuLog(date=msg_log.date,
+					ip_source=msg_log.ip_source, user=self.user,
+					endpoint=self.endpoint,
+					contenu=json.dumps(dict(donnees)).encode('utf-8'))
 			try:
-				proposition = Proposition.objects.get(
-					etudiant=etudiant, classe=classe,
-					cesure=proposition.cesure,
-					internat=proposition.internat,
-					date_demission__isnull=True)
-				proposition.demission(date_reponse)
-			except Proposition.DoesNotExist:
-				pass
-
-		return self.json_response(True, msg_log=msg_log)
+				with transaction.atomic():
+					succes, message = self.admission(donnees, log,
+							traitement)
+			except Exception:
+				traitement.oublie(donnees)
+				succes, message = False, "Erreur lors du traitement"
+
+			log.succes = succes
+			log.message = message
+			log.save()
+
+			resultats.append({
+				'codeCandidat': donnees.get('codeCandidat'),
+				'retour': 'OK' if succes else 'NOK',
+				'message': message,
+			})
+
+		# Les données de chaque message sont conservées dans leur propre
+		# entrée du journal.
+		msg_log.contenu = None
+		nb_erreurs = sum(1 for resultat in resultats
+				if resultat['retour'] != 'OK')
+		return self.json_response(nb_erreurs == 0, msg_log=msg_log,
+				message="{} requetes traitees, {} en erreur".format(
+					len(resultats), nb_erreurs),
+				status_code=200, donnees={'resultats': resultats})
+
+	def admission(self, donnees, msg_log, traitement):
+		"""
+		Traitement d'un message d'admission, avec l'instance de
+		TraitementAdmission donnée en paramètre. Les informations sur le
+		message sont ajoutées à l'entrée msg_log du journal.
+
+		Renvoie le couple (succès, message pour Parcoursup). Les
+		exceptions levées lors de l'application du message sont
+		transmises à l'appelant.
+		"""
+		# Parcoursup renvoie parfois un message déjà reçu. S'il avait été
+		# accepté, on répond OK sans le traiter à nouveau, et le journal
+		# fait seulement référence au premier exemplaire.
+		msg_log.empreinte = TraitementAdmission.empreinte(donnees)
+		if self.doublon(msg_log):
+			return True, "Requete deja recue"
+
+		try:
+			msg_log.code_candidat = TraitementAdmission.valide(donnees)
+		except (KeyError, TypeError, ValueError):
+			return False, "Donnees du candidat incompletes ou invalides"
+
+		asynchrone = getattr(settings, 'PARCOURSUP_ADMISSION_ASYNCHRONE',
+				False)
+		if asynchrone:
+			msg_log.etat = ParcoursupMessageRecuLog.ETAT_EN_ATTENTE
+
+		# L'entrée du journal est enregistrée avant d'appliquer le
+		# message, dans la transaction de l'appelant. Si une requête
+		# identique est traitée en même temps, la contrainte d'unicité
+		# sur l'empreinte fait échouer l'une des deux insertions, qui
+		# devient alors un doublon de l'autre.
+		msg_log.succes = True
+		try:
+			with transaction.atomic():
+				msg_log.save()
+		except IntegrityError:
+			msg_log.pk = None
+			msg_log.etat = ParcoursupMessageRecuLog.ETAT_TRAITE
+			if self.doublon(msg_log):
+				return True, "Requete deja recue"
+			raise
+
+		if not asynchrone:
+			traitement.traite(donnees)
+			msg_log.date_traitement = timezone.now()
+			return True, "Requete correctement traitee"
+
+		# En mode asynchrone, le message est seulement enregistré dans le
+		# journal. Il sera appliqué par la commande traite_admissions.
+		return True, "Requete enregistree"
+
+	def doublon(self, msg_log):
+		"""
+		Recherche le premier exemplaire accepté du message dont
+		l'empreinte est celle de msg_log. S'il existe, msg_log en
+		devient un doublon et la méthode renvoie True.
+		"""
+		original = ParcoursupMessageRecuLog.objects.filter(
+				endpoint=self.endpoint, empreinte=msg_log.empreinte,
+				succes=True, doublon_de__isnull=True).only(
+				'pk', 'code_candidat').order_by('pk').first()
+		if original is None:
+			return False
+
+		msg_log.doublon_de = original
+		msg_log.code_candidat = original.code_candidat
+		msg_log.contenu = None
+		msg_log.date_traitement = timezone.now()
+		return True